@@ -2,6 +2,7 @@ from modules.auth import auth
 from modules.backup import backup
 from classes.server import Server
 from classes.s3 import s3
+from core.bootstrap import initialization
 from helpers import today24Format, timeSince, bytes_to
 from constant import BQ_PATH, STORAGE_CONFIG_PATH, SITE_CONFIG_PATH, VERSION, CONFIG_PATH
 import sys, os, ruamel.yaml as rYaml
@@ -123,7 +124,7 @@ def save_setup():
         # Test connection    
         try:
             _s3 = s3(storage_name=request.form.get('name'))
-            _s3.list()
+            next(_s3.list(), None)
         except Exception as e:
             print(e)
             return jsonify(message="Failed to connect to your s3 account"), 500
@@ -212,80 +213,6 @@ def time_since(unix):
     from helpers import time_since
     return time_since(unix)
 
-def initialization():
-    from models import database
-    from models.log import Log
-    from models.notification_log import NotificationLog
-    db_path = os.path.join(BQ_PATH, 'database', 'bqckup.db')
-    
-    if not os.path.exists(db_path):
-        for folder in ['config', 'database', 'sites']:
-            if not os.path.exists(os.path.join(BQ_PATH, folder)):
-                os.makedirs(os.path.join(BQ_PATH, folder))
-
-        os.system(f"touch {db_path}")
-        os.system(f"chmod 755 {db_path}")
-        
-        
-    database.connect()
-    if not database.table_exists('log'):
-        database.create_tables([Log])
-    if not database.table_exists('notification_logs'):
-        database.create_tables([NotificationLog])
-    database.close()
-        
-        
-    
-    
-
-    dummy_storge_config = STORAGE_CONFIG_PATH.replace('.yml', '.yml.example')
-    dummy_site_config = os.path.join(SITE_CONFIG_PATH, 'domain.yml.example')
-
-    if not os.path.exists(dummy_site_config):
-        with open(dummy_site_config, 'w+') as stream:
-            _yaml = rYaml.YAML()
-            _yaml.indent(sequence=4, offset=2)
-            _yaml.dump({
-                "bqckup": {
-                    "name": "domain",
-                    "path": ['/var/www/html'],
-                    "database": {
-                        "type": "mysql",
-                        "host": "localhost",
-                        "port": 3306,
-                        "user": "root",
-                        "password": "root",
-                        "name": "database"
-                    },
-                    "options": {
-                        "storage": "dummy",
-                        "interval": "daily",
-                        "retention": "7",
-                        "save_locally": "no",
-                        "save_locally_path": os.path.join(BQ_PATH, 'tmp'),
-                        "notification_email": "email@example.com",
-                        "provider": "s3"
-                    }
-                }
-            }, stream)
-        
-    if not os.path.exists(dummy_storge_config):
-        with open(dummy_storge_config, 'w+') as stream:
-            _yaml = rYaml.YAML()
-            _yaml.indent(sequence=4, offset=2)
-            _yaml.dump({
-                "storages": {
-                    "dummy": {
-                        "bucket": "dummy",
-                        "access_key_id": "dummy",
-                        "secret_access_key": "dummy",
-                        "region": "dummy",
-                        "endpoint": "dummy",
-                        "primary": "no"
-                    }
-                }
-            }, stream)
-
 if __name__ == "__main__":
     initialization()
     app.run(host="0.0.0.0", debug=True, port=9393)
@@ -0,0 +1,45 @@
+import os, subprocess, sys
+
+"""
+    Startup budget of the CLI: what `bqckup <command>` imports before the
+    command runs (bqckup.py and the initialization) is timed in a fresh
+    interpreter, the best of a few runs has to fit the budget.
+    The heavy dependencies must not be imported at all, whatever the timing.
+    python -X importtime -c "import bqckup" shows where the time goes.
+"""
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+# Milliseconds, IMPORT_BUDGET_MS overrides it on slow machines
+BUDGET_MS = int(os.environ.get('IMPORT_BUDGET_MS', 200))
+RUNS = int(os.environ.get('IMPORT_RUNS', 5))
+ENTRY = ('bqckup', 'core.bootstrap', 'models.migrations')
+# Only imported by the commands using them
+LAZY = ('boto3', 'botocore', 'rich', 'requests', 'ruamel', 'flask', 'gevent')
+
+def measure() -> tuple:
+    code = (
+        "import sys, time\n"
+        "started_at = time.perf_counter()\n"
+        f"for module in {ENTRY!r}: __import__(module)\n"
+        "print((time.perf_counter() - started_at) * 1000)\n"
+        f"print(','.join(sorted(set(name.split('.')[0] for name in sys.modules) & set({LAZY!r}))))\n"
+    )
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+    elapsed, loaded = result.stdout.split('\n')[:2]
+    return float(elapsed), [name for name in loaded.split(',') if name]
+
+if __name__ == "__main__":
+    timings = []
+    for _ in range(RUNS):
+        elapsed, loaded = measure()
+        timings.append(elapsed)
+
+    print(f"CLI import time: best {min(timings):.1f}ms, worst {max(timings):.1f}ms over {RUNS} runs (budget {BUDGET_MS}ms)")
+
+    if loaded:
+        print(f"FAIL, imported at startup: {', '.join(loaded)}")
+        sys.exit(1)
+    if min(timings) > BUDGET_MS:
+        print("FAIL, over budget")
+        sys.exit(1)
+    print("OK")
@@ -1,24 +1,20 @@
 import getpass
 import typer
 import os
-import requests
 import re
-import ruamel.yaml as yaml
-from classes.bqckup import Bqckup
-from classes.database import Database
-from classes.config import Config
-from classes.storage import Storage
-from classes.s3 import s3
 from pathlib import Path
 from typing import List
 from constant import VERSION, SITE_CONFIG_PATH, BQ_PATH
-from rich import print
-from rich.console import Group, Console
-from rich.table import Table
-from rich.panel import Panel
+
+# Only what every command needs is imported here, boto3, rich, requests, yaml
+# and the Flask app are imported by the commands using them (see make import-time)
 
 bq_cli = typer.Typer()
 
+def print(*args, **kwargs):
+    from rich import print as rich_print
+    rich_print(*args, **kwargs)
+
 # @bq_cli.command()
 # def test():
 
@@ -41,7 +37,9 @@ def add_site(
         interval: str = typer.Option(default='daily'),
         retention: int = typer.Option(default=7),
         save_locally: bool = typer.Option(default=False),
-        save_locally_path: str = typer.Option(default=os.path.join(BQ_PATH, 'tmp'))
+        save_locally_path: str = typer.Option(default=os.path.join(BQ_PATH, 'tmp')),
+        compression: str = typer.Option(default='gzip'),
+        compression_level: int = typer.Option(default=None)
 ):
     # Check if path is empty
     if save_locally_path != os.path.join(BQ_PATH, 'tmp') and not os.path.exists(save_locally_path):
@@ -60,6 +58,7 @@ def add_site(
             raise typer.Exit(code=1)
 
     # Check Database Connection
+    from classes.database import Database
     Database().test_connection({
         "user": db_user,
         "password": db_pass,
@@ -67,6 +66,14 @@ def add_site(
         "name": db_name
     })
 
+    # Compression only gzip, zstd, lz4
+    from classes.codec import get_codec, CodecException
+    try:
+        get_codec(compression, compression_level).check()
+    except CodecException as e:
+        print(str(e))
+        raise typer.Exit(code=1)
+
     # Interval only daily, weekly, monthly
     if interval not in ['daily', 'weekly', 'monthly']:
         print("Interval should be daily, weekly or monthly")
@@ -91,11 +98,16 @@ def add_site(
                 'save_locally': 'yes' if save_locally else 'no',
                 'save_locally_path': save_locally_path,
                 'notification_email': 'email@example.com',
-                'provider': 's3'
+                'provider': 's3',
+                'compression': compression
             }
         }
     }
 
+    if compression_level is not None:
+        config['bqckup']['options']['compression_level'] = compression_level
+
+    import ruamel.yaml as yaml
     try:
         with open(os.path.join(SITE_CONFIG_PATH, f"{name}.yml"), "w") as file:
             yml = yaml.YAML()
@@ -110,6 +122,8 @@ def add_site(
 
 @ bq_cli.command()
 def get_information():
+    from rich.console import Group
+    from rich.panel import Panel
     content = Group(
         Panel("Version  : %s" % VERSION),
         Panel("Github   : https://github.com/bqckup/bqckup"),
@@ -121,6 +135,9 @@ def get_information():
 
 @ bq_cli.command()
 def test_config():
+    from rich.console import Console
+    from rich.table import Table
+    from classes.bqckup import Bqckup
     sites = Bqckup().list()
     if not sites:
         print("No site found")
@@ -141,13 +158,100 @@ def test_config():
 
 
 @ bq_cli.command()
-def run(force: bool = False):
-    Bqckup().backup(force=force)
+def run(force: bool = False, workers: int = None):
+    from classes.bqckup import Bqckup
+    Bqckup().backup(force=force, workers=workers)
+
+
+@ bq_cli.command()
+def daemon(workers: int = None):
+    from classes.bqckup import Bqckup
+    from classes.scheduler import Scheduler
+    Scheduler(Bqckup(), workers).run()
+
+
+@ bq_cli.command()
+def prune(name: str = None, dry_run: bool = False):
+    from classes.bqckup import Bqckup
+
+    try:
+        results = Bqckup().prune(name, dry_run)
+    except Exception as e:
+        print(f"[red] Failed to apply the retention, {str(e)} [/red]")
+        raise typer.Exit(code=1)
+
+    for site, result in results.items():
+        if dry_run or not (result['artifacts'] or result['promoted']):
+            kept = ", ".join(f"{runs} {tier}" for tier, runs in result['kept'].items())
+            print(
+                f"{site}: keeps {kept or 'every run'}, {result['artifacts']} expired backup(s), {result['bytes'] / (1024 * 1024):.2f} MB"
+                + (" would be deleted" if dry_run else "")
+                + (f", {result['promoted']} would move to a colder storage class" if result['promoted'] else "")
+            )
+
+
+@ bq_cli.command()
+def capture_binlog(name: str):
+    from classes.bqckup import Bqckup
+    node = Bqckup().detail(name)
+    if not node:
+        print(f"[red] Backup for {name} not found [/red]")
+        raise typer.Exit(code=1)
+
+    if not (node.get('database') or {}).get('binlog'):
+        print(f"[red] Binary log backups are not enabled for {name} (database.binlog) [/red]")
+        raise typer.Exit(code=1)
+
+    if Bqckup().do_backup(node['file_name'], database_only=True) is False:
+        raise typer.Exit(code=1)
+
+
+@ bq_cli.command()
+def restore_database(name: str, to: str = None):
+    from datetime import datetime
+    from classes.bqckup import Bqckup
+
+    if to:
+        try:
+            datetime.strptime(to, '%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            print("[red] --to should be formatted as 'YYYY-MM-DD HH:MM:SS' [/red]")
+            raise typer.Exit(code=1)
+
+    try:
+        Bqckup().restore_database(name, to)
+    except Exception as e:
+        print(f"[red] Failed to restore database, {str(e)} [/red]")
+        raise typer.Exit(code=1)
+
+
+@ bq_cli.command()
+def restore(name: str, run: int = None, output: str = None, files: bool = True, database: bool = True, database_name: str = None):
+    from classes.bqckup import Bqckup
+
+    try:
+        Bqckup().restore(name, run, output, files=files, database=database, database_name=database_name)
+    except Exception as e:
+        print(f"[red] Failed to restore {name}, {str(e)} [/red]")
+        raise typer.Exit(code=1)
+
+
+@ bq_cli.command()
+def restore_file(name: str, path: str, output: str = None):
+    from classes.bqckup import Bqckup
+
+    try:
+        Bqckup().restore_file(name, path, output)
+    except Exception as e:
+        print(f"[red] Failed to restore {path}, {str(e)} [/red]")
+        raise typer.Exit(code=1)
 
 
 @ bq_cli.command()
 def gui_active():
     from gevent.pywsgi import WSGIServer
+    from app import app
+    from classes.config import Config
 
     try:
         port = int(Config().read('web', 'port'))
@@ -171,6 +275,9 @@ def upload_file(storage: str, file: str, save_as: str = None):
     if not save_as:
         save_as = os.path.basename(file)
 
+    from classes.storage import Storage
+    from classes.s3 import s3
+
     try:
         # Check if storage exists
         Storage().get_storage_detail(storage)
@@ -185,6 +292,8 @@ def upload_file(storage: str, file: str, save_as: str = None):
 def generate_link(storage: str, key: str, expire: int = 86400):
     from humanfriendly import format_timespan
     from helpers import generate_short_link
+    from classes.storage import Storage
+    from classes.s3 import s3
 
     try:
         # Check if storage exists
@@ -215,51 +324,58 @@ def generate_link(storage: str, key: str, expire: int = 86400):
 
 
 @ bq_cli.command()
-def get_list(name: str, json: bool = False):
+def get_list(name: str, json: bool = False, refresh: bool = False, storage: str = None):
+    from datetime import datetime
+    from rich.console import Console
+    from rich.table import Table
+    from classes.bqckup import Bqckup
+    from classes.s3 import s3
     node = Bqckup().detail(name)
 
     if not node:
         print(f"[red] Backup for {name} not found [/red]")
         return None
 
-    _s3 = s3(node['options']['storage'])
-    backups = _s3.list(f"{_s3.root_folder_name}/{node['name']}")
+    # The first storage of the site unless another one of options.storages is asked for
+    storage = storage or Bqckup.get_storages(node)[0]
+    _s3 = s3(storage)
+    # Answered from the local catalog, --refresh lists the bucket again
+    backups = list(_s3.catalog_list(f"{_s3.root_folder_name}/{node['name']}/", refresh))
 
-    if not backups or not backups.get('Contents'):
+    if not backups:
         print(f"[red] No backup found for {name} [/red]")
         return None
 
     table = Table("#", "Key", "Created at")
 
     if json:
-        contents = backups.get('Contents')
         results = []
-        for content in contents:
+        for backup in backups:
             result = {
-                "key": content.get('Key').replace('bqckup/', ''),
-                "date": content.get('LastModified').strftime("%d %b %Y %H:%M:%S"),
-                "size": content.get('Size')
+                "key": backup.key.replace('bqckup/', ''),
+                "date": datetime.fromtimestamp(backup.last_modified).strftime("%d %b %Y %H:%M:%S"),
+                "size": backup.size
             }
             results.append(result)
         print(results)
     else:
-        for i, backup in enumerate(backups.get('Contents')):
-            backup['Key'] = backup['Key'].replace('bqckup/', '')
+        for i, backup in enumerate(backups):
             table.add_row(
-                str(i+1), backup['Key'], backup['LastModified'].strftime("%d %b %Y %H:%M:%S"))
+                str(i+1), backup.key.replace('bqckup/', ''), datetime.fromtimestamp(backup.last_modified).strftime("%d %b %Y %H:%M:%S"))
 
         Console().print(table)
 
         print("\n[yellow]Tips: [/yellow]")
         print("You can generate a download link by running this command:\n")
-        print(f"bqckup generate-link {node['options']['storage']} <Key>\n")
+        print(f"bqckup generate-link {storage} <Key>\n")
         print("Example:")
         print(
-            f"bqckup generate-link {node['options']['storage']} '{backups.get('Contents')[0].get('Key')}'\n")
+            f"bqckup generate-link {storage} '{backups[0].key}'\n")
 
 
 @ bq_cli.command()
 def check_update(update: bool = False):
+    import requests
     import wget
     from packaging import version
     try:
@@ -305,7 +421,7 @@ if __name__ == "__main__":
     if getpass.getuser() != 'root':
         print("Please run this script as root user")
     else:
-        from app import initialization
+        from core.bootstrap import initialization
         try:
             initialization()
         except Exception as e:
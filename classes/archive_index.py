@@ -0,0 +1,132 @@
+import bisect, gzip, json, os, tarfile
+
+INDEX_VERSION = 1
+# Index object stored next to its archive
+INDEX_SUFFIX = '.index.gz'
+TYPES = {tarfile.REGTYPE: 'file', tarfile.AREGTYPE: 'file', tarfile.DIRTYPE: 'dir', tarfile.SYMTYPE: 'symlink', tarfile.LNKTYPE: 'hardlink'}
+
+# TarFile writing the (uncompressed) offset of every member data as it goes
+class IndexingTarFile(tarfile.TarFile):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # [name, type, size, mtime, mode, data offset, link name]
+        self.entries = []
+
+    def addfile(self, tarinfo, fileobj=None):
+        super().addfile(tarinfo, fileobj)
+        # Header(s) then the data padded to 512 bytes, the data starts that far before the end
+        data_size = 0
+        if tarinfo.isreg():
+            blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+            data_size = (blocks + (1 if remainder else 0)) * tarfile.BLOCKSIZE
+        self.entries.append([tarinfo.name, TYPES.get(tarinfo.type, 'other'), tarinfo.size, int(tarinfo.mtime), tarinfo.mode, self.offset - data_size, tarinfo.linkname or None])
+
+"""
+    Where every member of a tar compressed by ParallelCompressor starts, so
+    one file can be restored from a few independently compressed blocks
+    (fetched with ranged reads) instead of the whole archive.
+    members: name => [type, size, mtime, mode, block, offset in block, link name]
+    blocks: [raw offset, compressed offset, compressed size]
+"""
+class ArchiveIndex:
+    def __init__(self, codec: str, blocks: list, members: dict, archive: str = None):
+        self.codec = codec
+        self.blocks = [list(block) for block in blocks]
+        self.members = members
+        self.archive = archive
+        self._raw_offsets = [block[0] for block in self.blocks]
+
+    @classmethod
+    def build(cls, codec: str, blocks: list, entries: list, archive: str = None) -> 'ArchiveIndex':
+        raw_offsets = [block[0] for block in blocks]
+        members = {}
+        for name, kind, size, mtime, mode, offset, linkname in entries:
+            block = max(bisect.bisect_right(raw_offsets, offset) - 1, 0)
+            members[name] = [kind, size, mtime, mode, block, offset - (raw_offsets[block] if raw_offsets else 0), linkname]
+        return cls(codec, blocks, members, archive)
+
+    def save(self, path: str) -> None:
+        with gzip.open(path, 'wt') as f:
+            json.dump({"version": INDEX_VERSION, "archive": self.archive, "codec": self.codec, "blocks": self.blocks, "members": self.members}, f, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, path: str) -> 'ArchiveIndex':
+        with gzip.open(path, 'rt') as f:
+            data = json.load(f)
+        return cls(data['codec'], data['blocks'], data['members'], data.get('archive'))
+
+    # Members named path or below it, in archive order
+    def find(self, path: str) -> list:
+        path = path.strip('/')
+        return sorted(
+            (name for name in self.members if name == path or name.startswith(path + '/')),
+            key=lambda name: (self.members[name][4], self.members[name][5])
+        )
+
+    # (first block, last block) holding the data of a member
+    def block_span(self, name: str) -> tuple:
+        kind, size, _, _, block, offset, _ = self.members[name]
+        start = self._raw_offsets[block] + offset
+        end = start + max(size, 1) - 1 if kind == 'file' else start
+        last = max(bisect.bisect_right(self._raw_offsets, end) - 1, block)
+        return block, last
+
+    # Compressed byte ranges (start, end inclusive, first block, last block) to fetch for names, adjacent blocks merged
+    def ranges(self, names: list) -> list:
+        wanted = set()
+        for name in names:
+            if self.members[name][0] != 'file' or not self.members[name][1]:
+                continue
+            first, last = self.block_span(name)
+            wanted.update(range(first, last + 1))
+
+        ranges = []
+        for block in sorted(wanted):
+            if ranges and ranges[-1][3] == block - 1:
+                ranges[-1][1] = self.blocks[block][1] + self.blocks[block][2] - 1
+                ranges[-1][3] = block
+            else:
+                ranges.append([self.blocks[block][1], self.blocks[block][1] + self.blocks[block][2] - 1, block, block])
+        return [tuple(r) for r in ranges]
+
+    # Data of a member, piece by piece, from the decompressed blocks (block number => bytes)
+    def read(self, name: str, blocks: dict):
+        _, size, _, _, block, offset, _ = self.members[name]
+        while size > 0:
+            piece = blocks[block][offset:offset + size]
+            yield piece
+            size -= len(piece)
+            block, offset = block + 1, 0
+
+    # Writes the members to folder (archive paths kept), blocks as in read
+    def extract(self, names: list, blocks: dict, folder: str) -> int:
+        # classes.restore imports classes.tar, which imports this module
+        from classes.restore import _inside
+        restored = 0
+        for name in names:
+            kind, size, mtime, mode, _, _, linkname = self.members[name]
+            target = os.path.join(folder, name)
+            # Symlinks resolved, one extracted earlier can't lead a later member out of folder
+            if not _inside(folder, name):
+                print(f"Skipped {name}, outside of {folder}")
+                continue
+            if kind == 'dir':
+                os.makedirs(target, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+            if kind == 'symlink':
+                if os.path.lexists(target):
+                    os.unlink(target)
+                os.symlink(linkname, target)
+                restored += 1
+                continue
+            if kind != 'file':
+                print(f"Skipped {name}, {kind} members are not restored one by one")
+                continue
+            with open(target, 'wb') as f:
+                for piece in self.read(name, blocks):
+                    f.write(piece)
+            os.chmod(target, mode)
+            os.utime(target, (mtime, mtime))
+            restored += 1
+        return restored
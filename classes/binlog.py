@@ -0,0 +1,199 @@
+import json, os, shlex, shutil, subprocess, tarfile, tempfile, time
+from io import BytesIO
+from classes.codec import Codec, Gzip, get_codec
+from classes.compressor import ParallelCompressor
+from classes.database import DatabaseException
+from classes.mysqldump import MANIFEST_NAME, _CountingWriter, binlog_position, connect
+
+BUNDLE_VERSION = 1
+# Events of a binary log start after its 4 bytes magic number
+FIRST_EVENT = 4
+
+# The binary logs to capture are gone (purged), a new full dump is needed
+class BinlogException(DatabaseException): pass
+
+"""
+    Binary log backups between two full dumps (MysqlDump with binlog).
+    A capture rotates the binary log so every file written since the last one
+    is closed, fetches them with mysqlbinlog --read-from-remote-server --raw and
+    writes them compressed into an uncompressed tar next to a manifest of the
+    positions, like a MysqlDump. Binary logs hold every database of the server,
+    replay keeps the site one only.
+    Needs log_bin and the RELOAD, REPLICATION CLIENT and REPLICATION SLAVE privileges.
+"""
+class Binlog:
+    def __init__(self, credentials: dict, codec: Codec = None, tmp_path: str = None):
+        self.credentials = credentials
+        self.codec = codec or Gzip()
+        self.tmp_path = tmp_path
+        # Manifest of the last capture
+        self.result = None
+        self.stats = {}
+
+    def _client_options(self) -> str:
+        host = self.credentials.get('host') or 'localhost'
+        port = int(self.credentials.get('port') or 3306)
+        password = shlex.quote(str(self.credentials.get('password') or ''))
+        return f"-h {shlex.quote(host)} -P {port} -u {shlex.quote(str(self.credentials.get('user')))} -p{password}"
+
+    def _run(self, command: str, action: str) -> None:
+        result = subprocess.run(f"set -o pipefail; {command}", shell=True, executable='/bin/bash', stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise DatabaseException(f"Failed to {action}, {result.stderr.decode(errors='replace').strip()}")
+
+    @staticmethod
+    def _binary_logs(cursor) -> dict:
+        cursor.execute("SHOW BINARY LOGS")
+        return {row[0]: int(row[1]) for row in cursor.fetchall()}
+
+    # Whether anything was written since (file, position), raises BinlogException when file was purged
+    def changed(self, file: str, position: int) -> bool:
+        connection = connect(self.credentials)
+        cursor = connection.cursor()
+        try:
+            if file not in self._binary_logs(cursor):
+                raise BinlogException(f"Binary log {file} was purged before being captured")
+            return binlog_position(cursor) != (file, position)
+        finally:
+            cursor.close()
+            connection.close()
+
+    # Captures from start (file, position) up to now, output is a path or a writable file-like object
+    def capture(self, start: tuple, output) -> int:
+        started_at = time.time()
+        connection = connect(self.credentials)
+        cursor = connection.cursor()
+        try:
+            cursor.execute("FLUSH BINARY LOGS")
+            captured_at = int(time.time())
+            next_position = binlog_position(cursor)
+            sizes = self._binary_logs(cursor)
+        finally:
+            cursor.close()
+            connection.close()
+
+        names = list(sizes)
+        if start[0] not in sizes:
+            raise BinlogException(f"Binary log {start[0]} was purged before being captured")
+        files = names[names.index(start[0]):names.index(next_position[0])]
+
+        folder = tempfile.mkdtemp(prefix='bqckup-binlog-', dir=self.tmp_path)
+        try:
+            self._run(
+                f"mysqlbinlog --read-from-remote-server --raw {self._client_options()} "
+                f"--result-file={shlex.quote(folder + os.sep)} {' '.join(shlex.quote(file) for file in files)}",
+                "fetch the binary logs"
+            )
+
+            segments = []
+            for file in files:
+                member = f"{file}.{self.codec.extension}"
+                with open(os.path.join(folder, file), 'rb') as source, open(os.path.join(folder, member), 'wb') as f, ParallelCompressor(f, 1, codec=self.codec) as writer:
+                    shutil.copyfileobj(source, writer, 1024 * 1024)
+                segments.append({
+                    "file": file,
+                    "member": member,
+                    "start_position": start[1] if file == start[0] else FIRST_EVENT,
+                    "end_position": sizes[file],
+                    "size": writer.bytes_out,
+                })
+
+            manifest = {
+                "version": BUNDLE_VERSION,
+                "database": self.credentials.get('name'),
+                "codec": self.codec.name,
+                "captured_at": captured_at,
+                "next": {"file": next_position[0], "position": next_position[1]},
+                "files": segments,
+            }
+
+            if isinstance(output, str):
+                archive = tarfile.open(output, 'w')
+                counter = None
+            else:
+                counter = _CountingWriter(output)
+                archive = tarfile.open(fileobj=counter, mode='w|')
+            with archive:
+                content = json.dumps(manifest, indent=1).encode()
+                info = tarfile.TarInfo(MANIFEST_NAME)
+                info.size = len(content)
+                info.mtime = captured_at
+                archive.addfile(info, BytesIO(content))
+                for segment in segments:
+                    archive.add(os.path.join(folder, segment['member']), segment['member'])
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+        written = os.stat(output).st_size if counter is None else counter.written
+        elapsed = max(time.time() - started_at, 0.001)
+        raw_size = sum(segment['end_position'] - segment['start_position'] for segment in segments)
+        self.result = manifest
+        self.stats = {"files": len(segments), "raw_size": raw_size, "size": written, "elapsed": elapsed}
+        print(f"Captured {len(segments)} binary log(s), {raw_size / (1024 * 1024):.2f} MB of changes in {elapsed:.2f}s")
+        return written
+
+    def _gtid_mode(self) -> bool:
+        import mysql.connector
+        connection = connect(self.credentials)
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SELECT @@GLOBAL.gtid_mode")
+            return str(cursor.fetchone()[0]).upper().startswith('ON')
+        except mysql.connector.Error:
+            # MariaDB, GTIDs don't stop a replay there
+            return False
+        finally:
+            cursor.close()
+            connection.close()
+
+    # Replays the bundles (in capture order) from start (file, position), up to stop_datetime (local time) when given
+    # source is the database the binary logs were captured from when replaying into another one (credentials name)
+    # Returns the size of the binary logs replayed
+    def replay(self, bundles: list, start: tuple, stop_datetime: str = None, source: str = None) -> int:
+        started_at = time.time()
+        folder = tempfile.mkdtemp(prefix='bqckup-replay-', dir=self.tmp_path)
+        try:
+            files = []
+            for index, bundle in enumerate(bundles):
+                target = os.path.join(folder, f"{index:05d}")
+                with tarfile.open(bundle) as archive:
+                    # Flat regular files only, the data filter (Python 3.12+, backported) refuses anything else
+                    if hasattr(tarfile, 'data_filter'):
+                        archive.extractall(target, filter='data')
+                    else:
+                        archive.extractall(target)
+                with open(os.path.join(target, MANIFEST_NAME)) as f:
+                    manifest = json.load(f)
+                codec = get_codec(manifest['codec'])
+                for segment in manifest['files']:
+                    raw = os.path.join(target, segment['file'])
+                    self._run(f"{codec.decompress_command()} < {shlex.quote(os.path.join(target, segment['member']))} > {shlex.quote(raw)}", f"decompress {segment['file']}")
+                    files.append(raw)
+
+            if not files:
+                return 0
+            size = sum(os.path.getsize(file) for file in files)
+            # --start-position only applies to the first file given
+            if os.path.basename(files[0]) != start[0]:
+                raise DatabaseException(f"Binary logs start at {os.path.basename(files[0])}, the dump was taken at {start[0]}")
+
+            # --rewrite-db is applied before --database, the filter then matches the target name
+            target = self.credentials.get('name')
+            options = [f"--database={shlex.quote(target)}", f"--start-position={start[1]}"]
+            if source and source != target:
+                options.append(f"--rewrite-db={shlex.quote(f'{source}->{target}')}")
+            if stop_datetime:
+                options.append(f"--stop-datetime={shlex.quote(stop_datetime)}")
+            # Transactions keep their GTID otherwise and the server skips them as already applied
+            if self._gtid_mode():
+                options.append("--skip-gtids")
+
+            self._run(
+                f"mysqlbinlog {' '.join(options)} {' '.join(shlex.quote(file) for file in files)} | "
+                f"mysql {self._client_options()} {shlex.quote(self.credentials.get('name'))}",
+                "replay the binary logs"
+            )
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+        print(f"Replayed {len(files)} binary log(s) in {time.time() - started_at:.2f}s" + (f", up to {stop_datetime}" if stop_datetime else ""))
+        return size
@@ -1,14 +1,34 @@
-import os, time, shutil
+import json, os, queue, tempfile, threading, time, shutil
 from classes.database import Database
+from classes.mysqldump import MysqlDump
+from classes.binlog import Binlog, BinlogException
+from classes.pgdump import PgDump
+from classes.sqlitedump import SqliteDump
+from classes.fingerprint import files_fingerprint, mysql_fingerprint, sqlite_fingerprint
 from classes.storage import Storage
-from classes.tar import Tar
+from classes.tar import Tar, DELETED_MEMBER
+from classes.archive_index import ArchiveIndex, INDEX_SUFFIX
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from classes.file import File
 from classes.config import Config
 from classes.yml_parser import Yml_Parser
+from classes.registry import SiteRegistry
+from classes.codec import Codec, decompress_block, get_codec, open_decompressor
+from classes.restore import RestoreStats, extract_stream
+from classes.replication import ReplicationException, open_tee, replicate
+from classes.lock import SiteLock
+from classes.retention import Retention, Policy, RetentionException
+from classes.manifest import Manifest
+from classes.repository import Repository, SNAPSHOT_MARKER
+from classes.runner import Runner, Unlimited
+from classes.scheduler import CronException, Schedule
 from models.log import Log
+from models.run import Run, Artifact
+from models.binlog import BinlogChain, BinlogSegment
+from peewee import fn
 from models.notification_log import NotificationLog
 from constant import BQ_PATH, STORAGE_CONFIG_PATH, SITE_CONFIG_PATH
-from classes.s3 import s3
 from helpers import difference_in_days, get_today, time_since, get_server_ip
 from datetime import datetime
 from helpers.file_management import remove_folder
@@ -20,6 +40,9 @@ from configparser import ConfigParser
 class ConfigExceptions(Exception):
     pass
 
+# Finished artifacts waiting for their upload, producers block past this
+PIPELINE_QUEUE_SIZE = 2
+
 class Bqckup:
     def __init__(self):
         self.last_backup_sizes = {} 
@@ -43,27 +66,87 @@ class Bqckup:
             if config.get('database').get('type') not in Database().SUPPORTED_DATABASE:
                 raise ConfigExceptions(f"Database type {config.get('database').get('type')} not supported")
             
-            Database(type=config.get('database').get('type')).test_connection({
-                "user": config.get('database').get('user'),
-                "password": config.get('database').get('password'),
-                "host": config.get('database').get('host'),
-                "name": config.get('database').get('name')
-            })
+            Database(type=config.get('database').get('type')).test_connection(config.get('database'))
+
+            threads = config.get('database').get('threads') or 1
+            if not str(threads).isdigit() or int(threads) < 1:
+                raise ConfigExceptions(f"Database threads should be a number greater than 0, got {threads}")
+
+            if config.get('database').get('binlog') and (config.get('database').get('type') or 'mysql') != 'mysql':
+                raise ConfigExceptions("Binary log backups are only available for mysql databases")
+
+            full_every = config.get('database').get('full_every') or 7
+            if config.get('database').get('binlog') and (not str(full_every).isdigit() or int(full_every) < 1):
+                raise ConfigExceptions(f"Database full_every should be a number of days greater than 0, got {full_every}")
             
+        if config.get('options').get('retention'):
+            try:
+                Policy(config.get('options').get('retention'))
+            except RetentionException as e:
+                raise ConfigExceptions(str(e))
+
         if config.get('options').get('provider') == 's3':
-            Storage().get_storage_detail(config.get('options').get('storage'))
+            storages = self.get_storages(config)
+            if not storages:
+                raise ConfigExceptions("No storage set, use options.storage or options.storages")
+            for storage in storages:
+                Storage().get_storage_detail(storage)
+            # Dedup chunks are tracked per storage by the repository, it writes to a single one
+            if len(storages) > 1 and config.get('options').get('format') == 'dedup':
+                raise ConfigExceptions("The dedup format uploads to a single storage, options.storages can't list several")
+
+        # validate compression
+        self.get_codec(config).check()
+
+        # validate schedule
+        try:
+            Schedule(config['name'], config.get('options'))
+        except CronException as e:
+            raise ConfigExceptions(str(e))
             
         print("All OK !")
             
     def detail(self, name: str):
-        backups = self.list()
-        
-        for i in backups:
-            if backups[i]['name'] == name:
-                return backups[i]
-            
-        return None
+        site = SiteRegistry.get(name)
+        if not site:
+            return None
+        return self._entry(site[0], site[1], self.get_last_log(name))
     
+    # S3 storages a site uploads to, options.storages (every artifact replicated to each one) or options.storage
+    @staticmethod
+    def get_storages(backup: dict) -> list:
+        options = backup.get('options') or {}
+        storages = options.get('storages') or [options.get('storage')]
+        if isinstance(storages, str):
+            storages = storages.split(',')
+        return list(dict.fromkeys(str(storage).strip() for storage in storages if storage and str(storage).strip()))
+
+    def get_codec(self, backup: dict) -> Codec:
+        options = backup.get('options') or {}
+        level = options.get('compression_level')
+        if not options.get('compression') and level is None:
+            level = Config().read_int('compression', 'level', None)
+        return get_codec(options.get('compression'), level)
+
+    # Incremental sites run a full backup every options.full_every runs
+    def get_backup_mode(self, backup: dict) -> str:
+        options = backup.get('options') or {}
+        # Dedup snapshots are always complete, unchanged chunks are simply not uploaded again
+        if options.get('format') == 'dedup':
+            return Log.__FULL__
+        if options.get('mode') != Log.__INCREMENTAL__ or not Manifest(backup['name']).exists():
+            return Log.__FULL__
+
+        full_every = int(options.get('full_every', 7))
+        incrementals = 0
+        logs = Log.select(Log.mode).where((Log.name == backup['name']) & (Log.status == Log.__SUCCESS__) & (Log.type == Log.__FILES__)).order_by(Log.id.desc()).limit(full_every)
+        for log in logs:
+            if log.mode != Log.__INCREMENTAL__:
+                return Log.__INCREMENTAL__ if incrementals + 1 < full_every else Log.__FULL__
+            incrementals += 1
+
+        return Log.__FULL__
+
     def _interval_in_number(self, interval: str) -> int:
         if interval == 'weekly':
             return 7
@@ -71,27 +154,28 @@ class Bqckup:
             return 30
         return 1
     
+    def _entry(self, file_name: str, bqckup: dict, log) -> dict:
+        bqckup['file_name'] = file_name
+        bqckup['last_backup'] = log.created_at if log else None
+
+        bqckup['next_backup'] = False
+        if bqckup['last_backup']:
+            next_backup_in_date = datetime.fromtimestamp(bqckup['last_backup'] + (self._interval_in_number(bqckup['options']['interval']) * 86400)).strftime('%d/%m/%Y 00:00:00')
+            bqckup['next_backup'] = time_since(datetime.strptime(next_backup_in_date, '%d/%m/%Y %H:%M:%S').timestamp(), time.time(), reverse=True)
+        return bqckup
+
     def list(self):
-        files = File().get_file_list(SITE_CONFIG_PATH)
-        files = [file for file in files if file.endswith('.yml')]
-        results = {}
-        
-        for index, file in enumerate(files):
-            file_name = os.path.basename(file)
-            parsed_content = Yml_Parser.parse(file)
-            bqckup = parsed_content['bqckup']
-            log = self.get_last_log(bqckup['name'])
-            results[index] = {}
-            results[index] = bqckup
-            results[index]['file_name'] = file_name
-            results[index]['last_backup'] = log.created_at if log else None
-            
-            results[index]['next_backup'] = False
-            if results[index]['last_backup']:
-                next_backup_in_date = datetime.fromtimestamp(results[index]['last_backup'] + (self._interval_in_number(bqckup['options']['interval']) * 86400)).strftime('%d/%m/%Y 00:00:00')
-                results[index]['next_backup'] = time_since(datetime.strptime(next_backup_in_date, '%d/%m/%Y %H:%M:%S').timestamp(), time.time(), reverse=True)
-                
-        return results
+        sites = SiteRegistry.sites()
+        last_logs = self.get_last_logs()
+        return {
+            index: self._entry(file_name, bqckup, last_logs.get(bqckup.get('name')))
+            for index, (file_name, bqckup) in enumerate(sites)
+        }
+
+    # Last files log (not failed) of every site in one query, name => Log
+    def get_last_logs(self) -> dict:
+        last_ids = Log.select(fn.MAX(Log.id)).where((Log.status != Log.__FAILED__) & (Log.type == Log.__FILES__)).group_by(Log.name)
+        return {log.name: log for log in Log.select().where(Log.id.in_(last_ids))}
             
     def get_last_log(self, name:str):
         return Log().select().where((Log.name == name) & (Log.status != Log.__FAILED__) & (Log.type == Log.__FILES__)).order_by(Log.id.desc()).first()
@@ -103,13 +187,14 @@ class Bqckup:
     def get_logs(self, name: str):
         return list(Log().select().where(Log.name == name))
     
-    def backup(self, force:bool = False):
+    def backup(self, force:bool = False, workers: int = None):
         backups = self.list()
         
         if not backups:
             print("No backups found")
             return
         
+        due = []
         for i in backups:
             backup = backups[i]
             # self.validate_config(backup['name'])
@@ -137,209 +222,793 @@ class Bqckup:
                 
 
                 
-            self.do_backup(backup['file_name'])
+            due.append(backup)
+
+        if due:
+            Runner(workers).run(self, due)
     
-    # Upload
-    def do_backup(self, backup_config):
+    def _clean_uploaded(self, options: dict, path: str) -> None:
+        if not os.path.exists(path):
+            return
+        if options.get('save_locally') and options.get('save_locally_path'):
+            shutil.move(path, os.path.join(options.get('save_locally_path'), os.path.basename(path)))
+        else:
+            os.unlink(path)
+
+    def recover_uploads(self, backup: dict, _s3) -> None:
+        for upload, uploaded in _s3.resume_uploads(backup['name']):
+            log = Log.get_or_none(Log.id == upload.log_id) if upload.log_id else None
+            if not log or log.status != Log.__ON_PROGRESS__:
+                continue
+
+            if uploaded:
+                self._clean_uploaded(backup.get('options'), upload.source)
+                Log().update_status(log.id, Log.__SUCCESS__, "File Backup Success" if log.type == Log.__FILES__ else "Database Backup Success")
+            else:
+                Log().update_status(log.id, Log.__FAILED__, "Upload interrupted and could not be resumed")
+
+        _s3.abort_orphaned_uploads(f"{backup['name']}/")
+
+    def _notify_failed(self, backup: dict, title: str, field: str, filename: str) -> None:
+        webhook_url = Config().read('notification', 'discord_webhook_url')
+        if not webhook_url:
+            return
+        send_notification({
+                    "embeds": [{
+                        "title": title,
+                        "description": "This is an automated notification to inform you that the bqckup has failed.",
+                        "color": 15548997,
+                        "fields": [
+                            {"name": "Date",  "value": get_today(format="%d-%B-%Y"), "inline":True},     
+                            {"name": "Name", "value": backup.get('name'), "inline": True},
+                            {"name": "Server IP", "value": get_server_ip(), "inline": True},
+                            {"name": field, "value": filename, "inline": True}, 
+                            {"name": "Details", "value": f"Please make sure, your set the right {'file' if field == 'File Backup' else 'database'} for this backup", "inline": False}
+                        ],
+                        "footer": {"text": "If this was a mistake, please create issue here: https://github.com/bqckup/bqckup"}
+                    }]
+                })
+
+    # Local provider, move the artifact to its destination and keep a copy if asked
+    def _save_local(self, backup: dict, backup_folder: str, log, path: str) -> None:
+        options = backup.get('options')
+        backup_path = os.path.join(options.get('destination'), backup_folder)
+        os.makedirs(backup_path, exist_ok=True)
+
+        destination = os.path.join(backup_path, os.path.basename(path))
+        shutil.move(path, destination)
+        Log().update(file_size=os.stat(destination).st_size).where(Log.id == log.id).execute()
+        print(f"\nBackup for {backup['name']} completed: {os.path.basename(path)}")
+
+        if not options.get('save_locally'):
+            os.unlink(destination)
+        elif options.get('save_locally_path'):
+            print("\nSaving locally ...")
+            if not os.path.isdir(options.get('save_locally_path')):
+                raise Exception(f"Save locally path {options.get('save_locally_path')} is not a directory")
+            shutil.copy(destination, options.get('save_locally_path'))
+            print(f"\nSuccessfully saved {os.path.basename(path)} to {options.get('save_locally_path')}")
+
+    # Fingerprint of the last backup of log_type that went through or was skipped as unchanged
+    def get_last_fingerprint(self, name: str, log_type: str):
+        log = Log.select(Log.fingerprint).where((Log.name == name) & (Log.type == log_type) & (Log.status.in_([Log.__SUCCESS__, Log.__SKIPPED__]))).order_by(Log.id.desc()).first()
+        return log.fingerprint if log else None
+
+    # None when the engine has none (postgresql) or binary logs already tell what changed
+    def _database_fingerprint(self, database: dict):
+        engine = (database.get('type') or 'mysql').lower()
+        try:
+            if engine == 'mysql' and not database.get('binlog'):
+                return mysql_fingerprint(database)
+            if engine == 'sqlite':
+                return sqlite_fingerprint(database)
+        except Exception as e:
+            print(f"Unable to fingerprint the database, backing it up anyway ({e})")
+        return None
+
+    def _write_skipped(self, backup: dict, log_type: str, fingerprint: str, mode: str, run_id: int, started_at: int):
+        label = "Files" if log_type == Log.__FILES__ else "Database"
+        print(f"{label} of {backup['name']} unchanged since the last backup, skipped")
+        log = Log().write({
+            "name": backup['name'],
+            "file_path": "",
+            "description": f"{label} unchanged since the last backup, skipped",
+            "type": log_type,
+            "storage": backup['options']['storage'],
+            "mode": mode,
+            "started_at": started_at,
+            "run_id": run_id,
+            "fingerprint": fingerprint,
+        })
+        Log().update_status(log.id, Log.__SKIPPED__)
+        log.status = Log.__SKIPPED__
+        return log
+
+    # Open binlog chain of a site, None when its next database backup is a full dump (every database.full_every days)
+    def get_binlog_chain(self, backup: dict):
+        chain = BinlogChain.select().where((BinlogChain.name == backup['name']) & (BinlogChain.status == BinlogChain.__OPEN__)).order_by(BinlogChain.id.desc()).first()
+        full_every = int(backup.get('database').get('full_every') or 7)
+        if chain and abs(difference_in_days(chain.created_at, time.time())) < full_every:
+            return chain
+        return None
+
+    # (file name, export, log mode, called once delivered) for the database stage, None when there is nothing new
+    def _database_export(self, backup: dict, codec: Codec, tmp_path: str):
+        database = backup.get('database')
+        threads = int(database.get('threads') or 1)
+        now = int(time.time())
+        engine = (database.get('type') or 'mysql').lower()
+
+        if engine == 'postgresql':
+            return f"{now}.pgdump.tar", PgDump(database, threads, codec, tmp_path).export, None, None
+        if engine == 'sqlite':
+            return f"{now}.sqlite.{codec.extension}", SqliteDump(database, codec, tmp_path).export, None, None
+
+        if not database.get('binlog'):
+            # database.threads > 1 dumps tables in parallel into a tar of compressed tables
+            if threads > 1:
+                return f"{now}.sql.tar", MysqlDump(database, threads, codec, tmp_path).export, None, None
+            return f"{now}.sql.{codec.extension}", lambda output: Database().export(
+                output,
+                db_user=database.get('user'),
+                db_password=database.get('password'),
+                db_name=database.get('name'),
+                codec=codec,
+            ), None, None
+
+        chain = self.get_binlog_chain(backup)
+        if chain:
+            binlog = Binlog(database, codec, tmp_path)
+            try:
+                changed = binlog.changed(chain.next_file, chain.next_position)
+            except BinlogException as e:
+                print(f"{e}, taking a full dump of {backup['name']}")
+                BinlogChain.update(status=BinlogChain.__BROKEN__, updated_at=now).where(BinlogChain.id == chain.id).execute()
+                chain = None
+            else:
+                if not changed:
+                    return None
+
+                # Compare and set, a capture that lost the race to another one records nothing so its bundle is never replayed
+                def captured(log) -> None:
+                    with BinlogChain._meta.database.atomic():
+                        moved = BinlogChain.update(
+                            next_file=binlog.result['next']['file'], next_position=binlog.result['next']['position'], updated_at=int(time.time())
+                        ).where(
+                            (BinlogChain.id == chain.id) & (BinlogChain.next_file == chain.next_file) & (BinlogChain.next_position == chain.next_position)
+                        ).execute()
+                        if not moved:
+                            raise BinlogException(f"Binary logs of {backup['name']} from {chain.next_file}:{chain.next_position} were captured by another run, bundle dropped")
+                        BinlogSegment.insert_many([{
+                            "chain": chain.id,
+                            "log_id": log.id,
+                            "file": segment['file'],
+                            "start_position": segment['start_position'],
+                            "end_position": segment['end_position'],
+                            "captured_at": binlog.result['captured_at'],
+                        } for segment in binlog.result['files']]).execute()
+
+                return f"{now}.binlog.tar", lambda output: binlog.capture((chain.next_file, chain.next_position), output), Log.__INCREMENTAL__, captured
+
+        dump = MysqlDump(database, threads, codec, tmp_path, binlog=True)
+
+        def dumped(log) -> None:
+            BinlogChain.update(status=BinlogChain.__CLOSED__, updated_at=int(time.time())).where((BinlogChain.name == backup['name']) & (BinlogChain.status == BinlogChain.__OPEN__)).execute()
+            BinlogChain.create(
+                name=backup['name'], log_id=log.id, start_file=dump.position[0], start_position=dump.position[1],
+                next_file=dump.position[0], next_position=dump.position[1], status=BinlogChain.__OPEN__, created_at=now, updated_at=now
+            )
+
+        return f"{now}.sql.tar", dump.export, Log.__FULL__, dumped
+
+    # Local copy of what a log delivered, downloaded to folder from its storage
+    def _fetch_artifact(self, log_id: int, folder: str, artifact_type: str = None) -> str:
+        type_filter = (Artifact.type == artifact_type) if artifact_type else (Artifact.type != Artifact.__INDEX__)
+        artifact = Artifact.select().where((Artifact.log_id == log_id) & type_filter & (Artifact.status == Log.__SUCCESS__)).first()
+        if not artifact:
+            raise Exception(f"No delivered backup for log {log_id}")
+        if artifact.storage.startswith('local:'):
+            path = os.path.join(artifact.storage[len('local:'):], artifact.key)
+            if not os.path.exists(path):
+                raise Exception(f"{path} not found, enable save_locally to keep local backups")
+            return path
+
+        from classes.s3 import s3
+        path = os.path.join(folder, os.path.basename(artifact.key))
+        print(f"Downloading {artifact.key}")
+        s3(artifact.storage).download(artifact.key, path)
+        return path
+
+    # Bytes start to end (inclusive) of a delivered artifact, a ranged GET on S3
+    def _read_range(self, artifact, start: int, end: int) -> bytes:
+        if artifact.storage.startswith('local:'):
+            with open(os.path.join(artifact.storage[len('local:'):], artifact.key), 'rb') as f:
+                f.seek(start)
+                return f.read(end - start + 1)
+        from classes.s3 import s3
+        return s3(artifact.storage).get_range(artifact.key, start, end)
+
+    # Restores path (a file or a folder, absolute or as named in the archive) from the last files backups
+    # of a site into output, only the compressed blocks holding it are read, thanks to the archive index.
+    # Incremental archives are looked up newest first, down to the last full one.
+    def restore_file(self, name: str, path: str, output: str = None) -> int:
+        site = SiteRegistry.get(name)
+        if not site:
+            raise ConfigExceptions(f"Site {name} not found")
+        backup = site[1]
+        arcname = Tar.arcname(backup.get('path'), path.rstrip(os.sep)) if os.path.isabs(path) else path.strip('/')
+        output = output or os.getcwd()
+        started_at = time.time()
+
+        tmp_path = os.path.join(BQ_PATH, 'tmp', name)
+        os.makedirs(tmp_path, exist_ok=True)
+        folder = tempfile.mkdtemp(prefix='bqckup-restore-', dir=tmp_path)
+        # Archive member => (index, archive artifact), the newest version of each
+        found = {}
+        removed = set()
+        try:
+            logs = Log.select().where((Log.name == name) & (Log.type == Log.__FILES__) & (Log.status == Log.__SUCCESS__)).order_by(Log.id.desc())
+            for log in logs:
+                archive = Artifact.select().where((Artifact.log_id == log.id) & (Artifact.type == Log.__FILES__) & (Artifact.status == Log.__SUCCESS__)).first()
+                if not archive:
+                    continue
+                try:
+                    index = ArchiveIndex.load(self._fetch_artifact(log.id, folder, Artifact.__INDEX__))
+                except Exception:
+                    raise Exception(f"Backup {os.path.basename(log.file_path)} has no archive index, restore it in full instead")
+
+                for member in index.find(arcname):
+                    if member not in found and member not in removed:
+                        found[member] = (index, archive)
+                if DELETED_MEMBER in index.members:
+                    deleted = b"".join(index.read(DELETED_MEMBER, self._fetch_blocks(index, archive, [DELETED_MEMBER]))).decode()
+                    removed.update(member for member in deleted.split("\n") if member == arcname or member.startswith(arcname + '/'))
+                if log.mode != Log.__INCREMENTAL__:
+                    break
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+        if not found:
+            raise Exception(f"{path} not found in the backups of {name}" + (", it was deleted" if arcname in removed else ""))
+
+        restored = fetched = 0
+        for index, archive in dict.fromkeys(found.values()):
+            names = [member for member, source in found.items() if source[0] is index]
+            blocks = self._fetch_blocks(index, archive, names)
+            fetched += sum(index.blocks[block][2] for block in blocks)
+            restored += index.extract(names, blocks, output)
+
+        elapsed = max(time.time() - started_at, 0.001)
+        print(f"Restored {restored} file(s) of {path} to {output}, {fetched / (1024 * 1024):.2f} MB read in {elapsed:.2f}s")
+        return restored
+
+    # Decompressed blocks (block number => bytes) holding names, the ranges are read concurrently
+    def _fetch_blocks(self, index: ArchiveIndex, archive, names: list) -> dict:
+        def fetch(span: tuple) -> dict:
+            start, end, first, last = span
+            data = self._read_range(archive, start, end)
+            blocks = {}
+            for block in range(first, last + 1):
+                offset = index.blocks[block][1] - start
+                blocks[block] = decompress_block(index.codec, data[offset:offset + index.blocks[block][2]])
+            return blocks
+
+        blocks = {}
+        workers = Config().read_int('restore', 'concurrency', 8)
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            for result in pool.map(fetch, index.ranges(names)):
+                blocks.update(result)
+        return blocks
+
+    # Applies options.retention to a site (every site when None), what would be done when dry_run
+    def prune(self, name: str = None, dry_run: bool = False) -> dict:
+        results = {}
+        for _, backup in SiteRegistry.sites():
+            if name and backup.get('name') != name:
+                continue
+            retention = (backup.get('options') or {}).get('retention') or 0
+            results[backup['name']] = Retention(backup['name'], retention).apply(dry_run)
+        if name and name not in results:
+            raise ConfigExceptions(f"Site {name} not found")
+        return results
+
+    # Readable stream of a delivered artifact, concurrent ranged GETs on S3
+    def _open_artifact(self, artifact):
+        if artifact.storage.startswith('local:'):
+            path = os.path.join(artifact.storage[len('local:'):], artifact.key)
+            if not os.path.exists(path):
+                raise Exception(f"{path} not found, enable save_locally to keep local backups")
+            return open(path, 'rb')
+        from classes.s3 import s3
+        return s3(artifact.storage).open_stream(artifact.key)
+
+    # Files logs to extract, in order, to get the files as they were at log_id: the last full archive then its incrementals
+    def _files_chain(self, name: str, log_id: int) -> list:
+        chain = []
+        logs = Log.select().where((Log.name == name) & (Log.type == Log.__FILES__) & (Log.status == Log.__SUCCESS__) & (Log.id <= log_id)).order_by(Log.id.desc())
+        for log in logs:
+            chain.append(log)
+            if log.mode != Log.__INCREMENTAL__:
+                break
+        return list(reversed(chain))
+
+    def _restore_files(self, backup: dict, logs: list, output: str, stats: RestoreStats) -> None:
+        restored = 0
+        for log in logs:
+            artifact = Artifact.select().where((Artifact.log_id == log.id) & (Artifact.type == Log.__FILES__) & (Artifact.status == Log.__SUCCESS__)).first()
+            if not artifact:
+                raise Exception(f"No delivered archive for {os.path.basename(log.file_path)}")
+            print(f"Restoring {os.path.basename(log.file_path)}")
+            source = self._open_artifact(artifact)
+            if SNAPSHOT_MARKER in artifact.key:
+                with source, open_decompressor(log.compression, source) as reader:
+                    snapshot = json.loads(reader.read())
+                if artifact.storage.startswith('local:'):
+                    repository = Repository(backup['name'], destination=artifact.storage[len('local:'):], codec=get_codec(log.compression))
+                else:
+                    from classes.s3 import s3
+                    repository = Repository(backup['name'], s3(artifact.storage), codec=get_codec(log.compression))
+                restored += repository.restore(snapshot, output, stats)
+            else:
+                restored += extract_stream(source, log.compression, output, stats)
+        print(f"Restored {restored} file(s) of {backup['name']} to {output}")
+
+    def _restore_database(self, backup: dict, log, credentials: dict, tmp_path: str, stats: RestoreStats) -> None:
+        engine = (credentials.get('type') or 'mysql').lower()
+        threads = int(credentials.get('threads') or 1)
+        artifact = Artifact.select().where((Artifact.log_id == log.id) & (Artifact.type == Log.__DATABASE__) & (Artifact.status == Log.__SUCCESS__)).first()
+        if not artifact:
+            raise Exception(f"No delivered dump for {os.path.basename(log.file_path)}")
+        print(f"Restoring {os.path.basename(log.file_path)} into {credentials.get('path') or credentials.get('name')}")
+
+        # A single compressed dump is streamed into mysql, nothing is written to disk
+        if engine == 'mysql' and not artifact.key.endswith('.tar'):
+            started_at = time.time()
+            source = self._open_artifact(artifact)
+            with source:
+                size = Database().restore(source, credentials.get('user'), credentials.get('password'), credentials.get('name'), get_codec(log.compression))
+            stats.add('db load', size, time.time() - started_at)
+            return
+
+        folder = tempfile.mkdtemp(prefix='bqckup-restore-', dir=tmp_path)
+        try:
+            started_at = time.time()
+            path = self._fetch_artifact(log.id, folder)
+            downloaded_at = time.time()
+            stats.add('db download', os.stat(path).st_size, downloaded_at - started_at)
+            # Tables (or pg_restore jobs) are loaded database.threads at a time
+            if engine == 'postgresql':
+                PgDump(credentials, threads, tmp_path=tmp_path).restore(path)
+            elif engine == 'sqlite':
+                SqliteDump(credentials, tmp_path=tmp_path).restore(path)
+            else:
+                MysqlDump(credentials, threads, tmp_path=tmp_path).restore(path)
+            stats.add('db load', os.stat(path).st_size, time.time() - downloaded_at)
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    # Restores the files and the database of a site as they were at a run (the last successful one when None).
+    # Archives are streamed from the storage through decompression into output, the database is loaded
+    # at the same time, into database instead of the configured one when given. Returns the stage stats.
+    def restore(self, name: str, run_id: int = None, output: str = None, files: bool = True, database: bool = True, database_name: str = None) -> dict:
+        site = SiteRegistry.get(name)
+        if not site:
+            raise ConfigExceptions(f"Site {name} not found")
+        backup = site[1]
+
+        runs = Run.select().where(Run.name == name)
+        runs = runs.where(Run.id == run_id) if run_id else runs.where(Run.status == Run.__SUCCESS__)
+        run = runs.order_by(Run.id.desc()).first()
+        if not run:
+            raise ConfigExceptions(f"No backup run {run_id} for {name}" if run_id else f"No successful backup of {name}")
+        last_log_id = Log.select(fn.MAX(Log.id)).where(Log.run_id == run.id).scalar() or 0
+
+        files_logs = self._files_chain(name, last_log_id) if files else []
+        database_log = None
+        if database and backup.get('database'):
+            database_log = Log.select().where((Log.name == name) & (Log.type == Log.__DATABASE__) & (Log.status == Log.__SUCCESS__) & (Log.id <= last_log_id)).order_by(Log.id.desc()).first()
+        if not files_logs and not database_log:
+            raise ConfigExceptions(f"Nothing to restore for run {run.id} of {name}")
+
+        output = output or os.path.join(os.getcwd(), f"{name}-{run.id}")
+        tmp_path = os.path.join(BQ_PATH, 'tmp', name)
+        os.makedirs(tmp_path, exist_ok=True)
+        os.makedirs(output, exist_ok=True)
+        print(f"Restoring run {run.id} of {name} ({datetime.fromtimestamp(run.started_at).strftime('%Y-%m-%d %H:%M:%S')})")
+
+        stats = RestoreStats()
+        errors = []
+
+        def restore_database() -> None:
+            try:
+                credentials = {**backup.get('database'), **({'name': database_name} if database_name else {})}
+                if backup.get('database').get('binlog'):
+                    # Full dump and binary logs replayed up to the end of the run
+                    self.restore_database(name, datetime.fromtimestamp(run.finished_at or run.started_at).strftime('%Y-%m-%d %H:%M:%S'), database_name, stats)
+                else:
+                    self._restore_database(backup, database_log, credentials, tmp_path, stats)
+            except Exception as e:
+                errors.append(f"Database restore failed, {e}")
+
+        loader = None
+        if database_log:
+            loader = threading.Thread(target=restore_database, name=f"{name}-restore-database")
+            loader.start()
+        try:
+            if files_logs:
+                self._restore_files(backup, files_logs, output, stats)
+        except Exception as e:
+            errors.append(f"Files restore failed, {e}")
+        if loader:
+            loader.join()
+
+        print(f"\nRestore of {name} {'failed' if errors else 'finished'}:")
+        stats.report()
+        if errors:
+            raise Exception(", ".join(errors))
+        return stats.as_dict()
+
+    # Point in time recovery of a binlog site: the full dump taken before to (local time, YYYY-MM-DD HH:MM:SS,
+    # latest when None), then its binary logs replayed up to that moment
+    # database restores into another database of the same server, stats gets the dump load and the replay
+    def restore_database(self, name: str, to: str = None, database: str = None, stats: RestoreStats = None) -> None:
+        site = SiteRegistry.get(name)
+        if not site:
+            raise ConfigExceptions(f"Site {name} not found")
+        backup = site[1]
+        credentials = {**backup.get('database'), **({'name': database} if database else {})}
+        target = datetime.strptime(to, '%Y-%m-%d %H:%M:%S').timestamp() if to else time.time()
+
+        chain = BinlogChain.select().where((BinlogChain.name == name) & (BinlogChain.created_at <= target)).order_by(BinlogChain.id.desc()).first()
+        if not chain:
+            raise ConfigExceptions(f"No binary log backup of {name} before {to or 'now'}")
+
+        # Segments up to the first one captured after the target, replay stops at the target inside it
+        segments = []
+        for segment in chain.segments.order_by(BinlogSegment.id):
+            segments.append(segment)
+            if segment.captured_at >= target:
+                break
+        if to and (not segments or segments[-1].captured_at < target):
+            last = segments[-1].captured_at if segments else chain.created_at
+            print(f"Warning, the last capture is from {datetime.fromtimestamp(last).strftime('%Y-%m-%d %H:%M:%S')}, restoring up to there")
+
+        tmp_path = os.path.join(BQ_PATH, 'tmp', name)
+        os.makedirs(tmp_path, exist_ok=True)
+        folder = tempfile.mkdtemp(prefix='bqckup-restore-', dir=tmp_path)
+        try:
+            print(f"Restoring the full dump of {datetime.fromtimestamp(chain.created_at).strftime('%Y-%m-%d %H:%M:%S')}")
+            dump = self._fetch_artifact(chain.log_id, folder)
+            started_at = time.time()
+            MysqlDump(credentials, int(credentials.get('threads') or 1), tmp_path=tmp_path).restore(dump)
+            if stats:
+                stats.add('db load', os.path.getsize(dump), time.time() - started_at)
+
+            bundles = [self._fetch_artifact(log_id, folder) for log_id in dict.fromkeys(segment.log_id for segment in segments)]
+            started_at = time.time()
+            replayed = Binlog(credentials, tmp_path=tmp_path).replay(bundles, (chain.start_file, chain.start_position), to, backup.get('database').get('name'))
+            if stats:
+                stats.add('db replay', replayed, time.time() - started_at)
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+        print(f"Database of {name} restored" + (f" to {to}" if to else ""))
+
+    # limits is shared by the backups running at the same time, see classes/runner.py
+    # The files archive and the database dump are made at the same time, each one
+    # is handed to the delivery stage (upload or local move) as soon as it's ready
+    # database_only skips the files archive (binary log captures between two regular runs)
+    def do_backup(self, backup_config, limits=None, database_only: bool = False):
+        # Two backups of a site would read the same binlog position and capture overlapping ranges
+        lock = SiteLock(os.path.join(BQ_PATH, 'tmp'), os.path.splitext(os.path.basename(backup_config))[0])
+        if not lock.acquire():
+            print(f"Backup for {os.path.splitext(backup_config)[0]} is already running...")
+            return False
+        try:
+            return self._do_backup(backup_config, limits, database_only)
+        finally:
+            lock.release()
+
+    def _do_backup(self, backup_config, limits=None, database_only: bool = False):
+        # boto3 is only loaded by the commands that upload
+        from classes.s3 import s3
+        limits = limits or Unlimited()
+        started_at = int(time.time())
         try:
             bqckup_config_location = os.path.join(SITE_CONFIG_PATH, backup_config)
             backup = Yml_Parser.parse(bqckup_config_location)['bqckup']
             backup_folder = f"{backup.get('name')}/{get_today()}"
             tmp_path = os.path.join(BQ_PATH, 'tmp', f"{backup.get('name')}")
+            options = backup.get('options')
+            storages = self.get_storages(backup) if options.get('provider') == 's3' else []
+            # The first storage is the one logs, listings and dedup snapshots refer to
+            if storages:
+                options['storage'] = storages[0]
+            # Storage name => s3, every artifact is uploaded to each one
+            targets = {storage: s3(storage_name=storage) for storage in storages}
+            _s3 = targets[storages[0]] if storages else None
+            # Several storages are fed from a single read of the artifact, see classes/replication.py
+            replicated = len(targets) > 1
+            # Stream straight into a multipart upload instead of writing to tmp_path first
+            stream = bool(_s3 and options.get('stream'))
+
+            # Uploads interrupted by a dead worker are finished before the running check
+            for target in targets.values():
+                self.recover_uploads(backup, target)
 
-            if Log().select().where((Log.name == backup.get('name')) & (Log.status == Log.__ON_PROGRESS__)).exists():
-                print(f"Backup for {backup.get('name')} is already running...")
-                return False
+            # The site lock is held, a log still in progress was left by a process that died
+            # (a single part upload or a local move, nothing recover_uploads could finish)
+            Log.update(status=Log.__FAILED__, description="Interrupted", finished_at=started_at).where((Log.name == backup.get('name')) & (Log.status == Log.__ON_PROGRESS__)).execute()
 
             if not File().is_exists(tmp_path):
                 os.makedirs(tmp_path)
 
-            # File Backup        
-            print(f"Compressing {backup['path'][0]} for {backup['name']}")
-            compressed_file = os.path.join(tmp_path, f"{int(time.time())}.tar.gz")
-            Tar().compress(backup.get('path'), compressed_file)
+            codec = self.get_codec(backup)
+            mode = self.get_backup_mode(backup)
+            only = deleted = None
+
+            # Keep the manifest up to date for incremental sites, even on full runs
+            manifest = None
+            dedup = options.get('format') == 'dedup'
+            if options.get('mode') == Log.__INCREMENTAL__ and not dedup and not database_only:
+                manifest = Manifest(backup['name'], hash=bool(options.get('manifest_hash')))
+                current_manifest = manifest.scan(backup.get('path'))
+                if mode == Log.__INCREMENTAL__:
+                    only, deleted = manifest.diff(current_manifest)
+                    print(f"Incremental backup, {len(only)} changed and {len(deleted)} deleted path(s)")
+
+            # The site lock is held, a run still in progress was left by a process that died
+            Run.update(status=Run.__FAILED__, finished_at=started_at).where((Run.name == backup['name']) & (Run.status == Run.__ON_PROGRESS__)).execute()
+            run = Run.create(name=backup['name'], mode=mode, status=Run.__ON_PROGRESS__, started_at=started_at)
+        except Exception as e:
+            print(e)
+            return False
+
+        # (log, path, stage timings, called once delivered, storage => error of a streamed upload) ready to be delivered,
+        # None stops the delivery stage
+        artifacts = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        # Log type => log once delivered (or skipped as unchanged), False when the stage failed
+        results = {}
+        # Unchanged content is not compressed again, options.skip_unchanged: no backs up every run
+        skip_unchanged = options.get('skip_unchanged', True) is not False
+
+        # One artifact per storage, errors (storage => error) fails the storages an upload didn't reach
+        def record_artifact(log, status: int, errors: dict = None) -> None:
+            key = log.object_name or f"{backup_folder}/{os.path.basename(log.file_path)}"
+            for storage in storages or [f"local:{options.get('destination')}"]:
+                Artifact.create(
+                    run=run, log_id=log.id, type=log.type, storage=storage, key=key, size=log.file_size or 0, compression=log.compression,
+                    status=Log.__FAILED__ if (errors or {}).get(storage) else status, created_at=int(time.time())
+                )
+
+        # A replicated upload is only done once every storage has it
+        def replication_errors(errors: dict) -> None:
+            failed_on = [storage for storage, error in errors.items() if error]
+            if failed_on:
+                raise ReplicationException("Replication failed on " + ", ".join(f"{storage} ({errors[storage]})" for storage in failed_on))
+
+        # Opens the uploads of key, a tee of one upload per storage when replicated
+        def upload_stream(key: str):
+            return open_tee(targets, key) if replicated else _s3.upload_stream(key)
+
+        # Upload slot on every storage, taken in the same order by every site
+        def uploading() -> ExitStack:
+            stack = ExitStack()
+            for storage in sorted(storages):
+                stack.enter_context(limits.uploading(storage))
+            return stack
+
+        def failed(log_type: str, log, e: Exception, errors: dict = None) -> None:
+            label = "File Backup" if log_type == Log.__FILES__ else "Database Backup"
+            if log:
+                Log().update_status(log.id, Log.__FAILED__, f"{label} Failed: {str(e)}")
+                # The storages a partial replication reached keep their copy, the retention deletes it with the run
+                partial = errors and any(errors.values()) and not all(errors.values())
+                record_artifact(log, Log.__SUCCESS__ if partial else Log.__FAILED__, errors if partial else None)
+            print(f"{label} for {backup['name']} failed, {e}")
+            self._notify_failed(backup, f"Bqckup {'File' if log_type == Log.__FILES__ else 'Database'} Failed", label, os.path.basename(log.file_path) if log else backup['name'])
+            results[log_type] = False
+
+        # Stage 1, files archive
+        def files_stage() -> None:
+            log = None
+            try:
+                fingerprint = files_fingerprint(backup.get('path'), current_manifest if manifest else None)
+                if skip_unchanged and fingerprint == self.get_last_fingerprint(backup['name'], Log.__FILES__):
+                    results[Log.__FILES__] = self._write_skipped(backup, Log.__FILES__, fingerprint, mode, run.id, started_at)
+                    return
+
+                print(f"Compressing {backup['path'][0]} for {backup['name']}")
+                if dedup:
+                    archiver = Repository(backup['name'], _s3, options.get('destination'), codec)
+                    compressed_file = os.path.join(tmp_path, f"{int(time.time())}.snapshot.json.{codec.extension}")
+                else:
+                    # options.index: no skips the member index (restore-file)
+                    archiver = Tar(codec=codec, index=options.get('index', True) is not False)
+                    compressed_file = os.path.join(tmp_path, f"{int(time.time())}{'.inc' if mode == Log.__INCREMENTAL__ else ''}.tar.{codec.extension}")
+
+                stage_started_at = time.time()
+                errors = None
+                if stream:
+                    with limits.compressing(), uploading(), upload_stream(f"{backup_folder}/{os.path.basename(compressed_file)}") as writer:
+                        archiver.compress(backup.get('path'), writer, only, deleted)
+                    current_file_size = archiver.stats['compressed_size']
+                    errors = getattr(writer, 'errors', None)
+                else:
+                    with limits.compressing():
+                        archiver.compress(backup.get('path'), compressed_file, only, deleted)
+                    current_file_size = os.stat(compressed_file).st_size
+                timings = {"compress": time.time() - stage_started_at}
+
+                on_delivered = None
+                if not dedup and archiver.index:
+                    index_path = compressed_file + INDEX_SUFFIX
+                    archiver.index.archive = os.path.basename(compressed_file)
+                    archiver.index.save(index_path)
+                    index_size = os.stat(index_path).st_size
+
+                    # The index goes next to its archive (on every storage), a backup without it is still a good backup
+                    def on_delivered(log) -> None:
+                        delivered = []
+                        try:
+                            if _s3:
+                                key = log.object_name + INDEX_SUFFIX
+                                for storage, target in targets.items():
+                                    try:
+                                        target.upload(index_path, key, showProgress=False)
+                                        delivered.append(storage)
+                                    except Exception as e:
+                                        print(f"Failed to upload the archive index of {backup['name']} to {storage}, {e}")
+                                os.unlink(index_path)
+                            elif options.get('save_locally'):
+                                key = f"{backup_folder}/{os.path.basename(index_path)}"
+                                shutil.move(index_path, os.path.join(options.get('destination'), key))
+                                delivered.append(f"local:{options.get('destination')}")
+                            else:
+                                os.unlink(index_path)
+                        except Exception as e:
+                            print(f"Failed to deliver the archive index of {backup['name']}, {e}")
+                        for storage in delivered:
+                            Artifact.create(
+                                run=run, log_id=log.id, type=Artifact.__INDEX__, storage=storage,
+                                key=key, size=index_size, status=Log.__SUCCESS__, created_at=int(time.time())
+                            )
 
-            current_file_size = os.stat(compressed_file).st_size
-            last_log = self.get_last_log(backup['name'])
-            
-            log_compressed_files = None  # Initialize the variable
-
-            if last_log and last_log.file_size is not None and current_file_size == last_log.file_size:
-                print(f"Backup file name: {os.path.basename(compressed_file)}")
-                print(f"\nCurrent file size: {current_file_size}")
-                print(f"Last backup size: {last_log.file_size}")
-                print(f"\nSorry, unable to do backup file for {backup['name']}, current file size is exactly same as before.")
-                print("Please make sure, your set the right file for this backup")
-                webhook_url = Config().read('notification', 'discord_webhook_url')
-                compressed_filename = os.path.basename(compressed_file)
-                if webhook_url:
-                    send_notification({
-                                "embeds": [{
-                                    "title": "Bqckup File Failed",
-                                    "description": "This is an automated notification to inform you that the bqckup has failed.",
-                                    "color": 15548997,
-                                    "fields": [
-                                        {"name": "Date",  "value": get_today(format="%d-%B-%Y"), "inline":True},     
-                                        {"name": "Name", "value": backup.get('name'), "inline": True},
-                                        {"name": "Server IP", "value": get_server_ip(), "inline": True},
-                                        {"name": "File Backup", "value": compressed_filename, "inline": True}, 
-                                        {"name": "Details", "value": "Please make sure, your set the right file for this backup", "inline": False}
-                                    ],
-                                    "footer": {"text": "If this was a mistake, please create issue here: https://github.com/bqckup/bqckup"}
-                                }]
-                            })
-                    return False
-            
-            else:
                 print("Writing log for file backup in progress...")
-                log_compressed_files = Log().write({
+                log = Log().write({
                     "name": backup['name'],
                     "file_path": compressed_file,
                     "description": "File backup is in progress...",
                     "type": Log.__FILES__,
                     "file_size": current_file_size,
-                    "storage": backup['options']['storage']
+                    "storage": backup['options']['storage'],
+                    "compression": codec.name,
+                    "mode": mode,
+                    "started_at": started_at,
+                    "run_id": run.id,
+                    "fingerprint": fingerprint,
+                    "object_name": f"{backup_folder}/{os.path.basename(compressed_file)}" if _s3 else None
                 })
+                artifacts.put((log, compressed_file, timings, on_delivered, errors))
+            except Exception as e:
+                failed(Log.__FILES__, log, e)
 
-            # Database Backup
-            if backup.get('database'):
-                print(f"\nExporting Database for {backup['name']}")
-                sql_path = os.path.join(tmp_path, f"{int(time.time())}.sql.gz")
+        # Stage 1 bis, database dump, runs next to the files archive
+        def database_stage() -> None:
+            log = None
+            try:
+                fingerprint = self._database_fingerprint(backup.get('database')) if skip_unchanged else None
+                if fingerprint and fingerprint == self.get_last_fingerprint(backup['name'], Log.__DATABASE__):
+                    results[Log.__DATABASE__] = self._write_skipped(backup, Log.__DATABASE__, fingerprint, None, run.id, started_at)
+                    return
 
-                Database().export(
-                    sql_path,
-                    db_user=backup.get('database').get('user'),
-                    db_password=backup.get('database').get('password'),
-                    db_name=backup.get('database').get('name'),
-                )
-                
+                print(f"\nExporting Database for {backup['name']}")
+                database_export = self._database_export(backup, codec, tmp_path)
+                if not database_export:
+                    print(f"No database changes for {backup['name']} since the last binary log capture")
+                    return
+                file_name, export, database_mode, on_delivered = database_export
+                sql_path = os.path.join(tmp_path, file_name)
 
-                current_file_size_db = os.stat(sql_path).st_size
-                last_log_db = self.get_last_db(backup['name'])
-                
-                log_database = None  # Initialize the variable
-
-                if last_log_db and last_log_db.file_size is not None and current_file_size_db == last_log_db.file_size:
-                    print(f"Database file name: {os.path.basename(sql_path)}")
-                    print(f"\nLast database backup size: {last_log_db.file_size}")
-                    print(f"Current database backup size: {current_file_size_db}")
-                    print(f"\nSorry, unable to do backup database for {backup['name']}, current database size is exactly same as before.")
-                    print("Please make sure, your set the right database for this backup")
-                    database_filename = os.path.basename(sql_path)
-                    webhook_url = Config().read('notification', 'discord_webhook_url')
-                    if webhook_url:
-                        send_notification({
-                                        "embeds": [{
-                                            "title": "Bqckup Database Failed",
-                                            "description": "This is an automated notification to inform you that the bqckup has failed.",
-                                            "color": 15548997,
-                                            "fields": [
-                                            {"name": "Date",  "value": get_today(format="%d-%B-%Y"), "inline":True},     
-                                            {"name": "Name", "value": backup.get('name'), "inline": True},
-                                            {"name": "Server IP", "value": get_server_ip(), "inline": True},
-                                            {"name": "Database File", "value": database_filename, "inline": True}, 
-                                            {"name": "Details", "value": "Please make sure, your set the right database for this backup", "inline": False}
-                                            ],
-                                            "footer": {"text": "If this was a mistake, please create issue here: https://github.com/bqckup/bqckup"}
-                                                        }]
-                                    })
-                    return False
+                stage_started_at = time.time()
+                database = backup.get('database')
+                if (database.get('type') or 'mysql') == 'sqlite':
+                    database_host = f"sqlite:{database.get('path') or database.get('name')}"
                 else:
-                    print("Writing log for database backup in progress...")
-                    log_database = Log().write({
+                    database_host = f"{database.get('host') or 'localhost'}:{database.get('port') or (5432 if database.get('type') == 'postgresql' else 3306)}"
+                errors = None
+                if stream:
+                    with limits.dumping(database_host), uploading(), upload_stream(f"{backup_folder}/{os.path.basename(sql_path)}") as writer:
+                        current_file_size_db = export(writer)
+                    errors = getattr(writer, 'errors', None)
+                else:
+                    with limits.dumping(database_host):
+                        current_file_size_db = export(sql_path)
+                timings = {"dump": time.time() - stage_started_at}
+
+                print("Writing log for database backup in progress...")
+                log = Log().write({
                     "name": backup['name'],
                     "file_path": sql_path,
                     "description": "Database Backup is in Progress",
                     "type": Log.__DATABASE__,
                     "file_size": current_file_size_db,
-                    "storage": backup['options']['storage']
+                    "storage": backup['options']['storage'],
+                    "compression": codec.name,
+                    "mode": database_mode,
+                    "started_at": started_at,
+                    "run_id": run.id,
+                    "fingerprint": fingerprint,
+                    "object_name": f"{backup_folder}/{os.path.basename(sql_path)}" if _s3 else None
                 })
-                    
-            # Local Save
-            if backup.get('options').get('provider') == 'local':
-                destination = backup.get('options').get('destination')
-                backup_path = os.path.join(destination, backup_folder)
-
-                if not os.path.exists(backup_path):
-                    os.makedirs(backup_path, exist_ok=True)
-
-                file_backup_complete = False
-                database_backup_complete = False
+                artifacts.put((log, sql_path, timings, on_delivered, errors))
+            except Exception as e:
+                failed(Log.__DATABASE__, log, e)
 
+        # Stage 2, delivery of every artifact as soon as one is ready
+        def delivery_stage() -> None:
+            while True:
+                artifact = artifacts.get()
+                if artifact is None:
+                    return
+                log, path, timings, on_delivered, errors = artifact
                 try:
-                    if os.path.exists(compressed_file):
-                        shutil.move(compressed_file, os.path.join(backup_path, os.path.basename(compressed_file)))
-                        current_file_size = os.stat(os.path.join(backup_path, os.path.basename(compressed_file))).st_size
-                        if 'log_compressed_files' in locals() and log_compressed_files is not None:  # Check if the log was created and is not None
-                            Log().update(file_size=current_file_size).where((Log.id == log_compressed_files.id) & (Log.type == Log.__FILES__)).execute()
-                            Log().update(status=Log.__SUCCESS__, description="File Backup Success").where((Log.id == log_compressed_files.id) & (Log.type == Log.__FILES__)).execute()
-                            file_backup_complete = True
-                    else:
-                        if 'log_compressed_files' in locals() and log_compressed_files is not None:  # Check if the log was created and is not None
-                            Log().update(status=Log.__FAILED__, description="File Backup Failed: Compressed file does not exist or could not be moved.").where((Log.id == log_compressed_files.id) & (Log.type == Log.__FILES__)).execute()
-                        print(f"Compressed file {compressed_file} does not exist or could not be moved.")
-
-                    if backup.get('database'):
-                        if os.path.exists(sql_path):
-                            shutil.move(sql_path, os.path.join(backup_path, os.path.basename(sql_path)))
-                            current_file_size_db = os.stat(os.path.join(backup_path, os.path.basename(sql_path))).st_size
-                            if 'log_database' in locals() and log_database is not None:  # Check if the log was created and is not None
-                                Log().update(file_size=current_file_size_db).where((Log.id == log_database.id) & (Log.type == Log.__DATABASE__)).execute()
-                                Log().update(status=Log.__SUCCESS__, description="Database Backup Success").where((Log.id == log_database.id) & (Log.type == Log.__DATABASE__)).execute()
-                                database_backup_complete = True
-                        else:
-                            if 'log_database' in locals() and log_database is not None:  # Check if the log was created and is not None
-                                Log().update(status=Log.__FAILED__, description="Database Backup Failed: SQL file does not exist or could not be moved.").where((Log.id == log_database.id) & (Log.type == Log.__DATABASE__)).execute()
-                            print(f"SQL file {sql_path} does not exist or could not be moved.")
+                    delivery_started_at = time.time()
+                    if _s3:
+                        if not stream and replicated:
+                            print(f"\nUploading {path} to {', '.join(storages)}\n")
+                            with uploading():
+                                errors, elapsed = replicate(path, targets, log.object_name)
+                            timings.update({f"upload:{storage}": seconds for storage, seconds in elapsed.items()})
+                            self._clean_uploaded(options, path)
+                        elif not stream:
+                            print(f"\nUploading {path}\n")
+                            with uploading():
+                                _s3.upload(path, log.object_name, name=backup['name'], log_id=log.id)
+                            self._clean_uploaded(options, path)
+                        if errors:
+                            replication_errors(errors)
+                        print(f"\nBackup for {backup['name']} uploaded: {log.object_name}" + (f" to {', '.join(storages)}" if replicated else ""))
+                    elif options.get('provider') == 'local':
+                        self._save_local(backup, backup_folder, log, path)
+                    timings["upload"] = time.time() - delivery_started_at
+
+                    Log().update(stages=json.dumps({stage: round(elapsed, 3) for stage, elapsed in timings.items()})).where(Log.id == log.id).execute()
+                    if on_delivered:
+                        on_delivered(log)
+                    Log().update_status(log.id, Log.__SUCCESS__, "File Backup Success" if log.type == Log.__FILES__ else "Database Backup Success")
+                    record_artifact(Log.get_by_id(log.id), Log.__SUCCESS__)
+                    results[log.type] = log
                 except Exception as e:
-                    print(f"An error occurred while moving files: {e}")
-
-                if file_backup_complete:
-                    print(f"\nBackup for {backup['name']} completed: {os.path.basename(compressed_file)}")
-                if database_backup_complete:
-                    print(f"Database backup for {backup['name']} completed: {os.path.basename(sql_path)}")
-
-                should_save_locally = backup.get('options').get('save_locally')
-                save_locally_path = backup.get('options').get('save_locally_path')
-
-                if not should_save_locally:
-                    if os.path.exists(os.path.join(backup_path, os.path.basename(compressed_file))):
-                        os.unlink(os.path.join(backup_path, os.path.basename(compressed_file)))
-                    if os.path.exists(os.path.join(backup_path, os.path.basename(sql_path))):
-                        os.unlink(os.path.join(backup_path, os.path.basename(sql_path)))
-                elif should_save_locally and save_locally_path:
-                    print("\nSaving locally ...")
-                    if not os.path.isdir(save_locally_path):
-                        raise Exception(f"Save locally path {save_locally_path} is not a directory")
-                    else:
-                        try:
-                            file_saved = False
-                            db_saved = False
-                            
-                            if os.path.exists(os.path.join(backup_path, os.path.basename(compressed_file))):
-                                if 'log_compressed_files' in locals() and log_compressed_files is not None:
-                                    shutil.copy(os.path.join(backup_path, os.path.basename(compressed_file)), save_locally_path)
-                                    file_saved = True
-                            if os.path.exists(os.path.join(backup_path, os.path.basename(sql_path))):
-                                if 'log_database' in locals() and log_database is not None:
-                                    shutil.copy(os.path.join(backup_path, os.path.basename(sql_path)), save_locally_path)
-                                    db_saved = True
-                            
-                            if file_saved:
-                                print(f"\nSuccessfully saved {os.path.basename(compressed_file)} to {save_locally_path}")
-                            if db_saved:
-                                print(f"\nSuccessfully saved {os.path.basename(sql_path)} to {save_locally_path}")
-                                
-                        except Exception as e:
-                            print(f"Failed to save locally: {e}")
-                            
-        except Exception as e:
-            if log_compressed_files:
-                Log().update(status=Log.__FAILED__, description=f"File Backup Failed: {str(e)}").where((Log.id == log_compressed_files.id) & (Log.type == Log.__FILES__)).execute()
-            if log_database:
-                Log().update(status=Log.__FAILED__, description=f"Database Backup Failed: {str(e)}").where((Log.id == log_database.id) & (Log.type == Log.__DATABASE__)).execute()
-            print(e)
-            return False
+                    failed(log.type, log, e, errors)
+
+        delivery = threading.Thread(target=delivery_stage, name=f"{backup['name']}-delivery")
+        delivery.start()
+        dump = None
+        if backup.get('database'):
+            dump = threading.Thread(target=database_stage, name=f"{backup['name']}-dump")
+            dump.start()
+        if not database_only:
+            files_stage()
+        if dump:
+            dump.join()
+        artifacts.put(None)
+        delivery.join()
+
+        # Next incremental run compares against what was just backed up (a skipped run changed nothing)
+        if manifest and results.get(Log.__FILES__) and results[Log.__FILES__].status != Log.__SKIPPED__:
+            manifest.save(current_manifest)
+
+        success = all(results.values())
+        Run.update(status=Run.__SUCCESS__ if success else Run.__FAILED__, finished_at=int(time.time())).where(Run.id == run.id).execute()
+
+        # Runs the retention policy doesn't keep go once this one went through
+        if success and options.get('retention'):
+            try:
+                Retention(backup['name'], options.get('retention')).apply()
+            except Exception as e:
+                print(f"Retention of {backup['name']} failed, {e}")
+        print(f"\nBackup for {backup['name']} finished in {time.time() - started_at:.2f}s")
+        return success
     
     def remove(self):
         pass
@@ -0,0 +1,93 @@
+import time
+from peewee import chunked, fn
+from classes.config import Config
+from models import database
+from models.s3_object import S3Object, S3Prefix
+
+"""
+    Local catalog of the objects of a storage (key, size, last modified, etag).
+    A prefix is listed from S3 once, after that uploads and deletes keep it
+    up to date so listings and usage are answered without scanning the bucket.
+    Prefixes are listed again after [catalog] max_age_hours to catch changes
+    made outside bqckup (lifecycle rules, another host, the console...).
+"""
+class Catalog:
+    def __init__(self, storage_name: str):
+        self.storage_name = storage_name
+        self.max_age = Config().read_int('catalog', 'max_age_hours', 24) * 3600
+
+    # Keys starting with prefix, as a range so the (storage, key) index is used and the match is case sensitive
+    def _under(self, prefix: str):
+        condition = S3Object.storage == self.storage_name
+        if prefix:
+            condition &= (S3Object.key >= prefix) & (S3Object.key < prefix + chr(0x10FFFF))
+        return condition
+
+    def synced(self, prefix: str = "") -> bool:
+        oldest = int(time.time()) - self.max_age
+        for row in S3Prefix.select().where((S3Prefix.storage == self.storage_name) & (S3Prefix.synced_at >= oldest)):
+            # A listing of a parent prefix covers this one too
+            if prefix.startswith(row.prefix):
+                return True
+        return False
+
+    # objects is an iterable of list_objects_v2 entries, consumed page by page
+    def sync(self, objects, prefix: str = "") -> int:
+        started_at = int(time.time() * 1000)
+        count = 0
+        for batch in chunked(objects, 500):
+            rows = [
+                {
+                    "storage": self.storage_name,
+                    "key": obj['Key'],
+                    "size": int(obj['Size']),
+                    "last_modified": int(obj['LastModified'].timestamp()),
+                    "etag": obj.get('ETag', '').strip('"') or None,
+                    "synced_at": started_at,
+                }
+                for obj in batch
+            ]
+            with database.atomic():
+                S3Object.insert_many(rows).on_conflict_replace().execute()
+            count += len(rows)
+
+        with database.atomic():
+            # Whatever the listing didn't see is gone, uploads recorded meanwhile are newer than the listing
+            S3Object.delete().where(self._under(prefix) & (S3Object.synced_at < started_at)).execute()
+            S3Prefix.insert(storage=self.storage_name, prefix=prefix, synced_at=started_at // 1000).on_conflict_replace().execute()
+        return count
+
+    def record(self, key: str, size: int, etag: str = None, last_modified: int = None) -> None:
+        now = time.time()
+        try:
+            S3Object.insert(
+                storage=self.storage_name,
+                key=key,
+                size=size,
+                last_modified=last_modified or int(now),
+                etag=etag.strip('"') if etag else None,
+                synced_at=int(now * 1000),
+            ).on_conflict_replace().execute()
+        except Exception as e:
+            print(f"Failed to update the object catalog, {e}")
+
+    def forget(self, key: str) -> None:
+        try:
+            S3Object.delete().where((S3Object.storage == self.storage_name) & (S3Object.key == key)).execute()
+        except Exception as e:
+            print(f"Failed to update the object catalog, {e}")
+
+    def forget_many(self, keys: list) -> None:
+        try:
+            with database.atomic():
+                for batch in chunked(keys, 500):
+                    S3Object.delete().where((S3Object.storage == self.storage_name) & S3Object.key.in_(batch)).execute()
+        except Exception as e:
+            print(f"Failed to update the object catalog, {e}")
+
+    def objects(self, prefix: str = ""):
+        return S3Object.select().where(self._under(prefix)).order_by(S3Object.key)
+
+    def total_size(self, prefix: str = "") -> int:
+        total = S3Object.select(fn.SUM(S3Object.size)).where(self._under(prefix)).scalar()
+        return int(total or 0)
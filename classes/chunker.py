@@ -0,0 +1,70 @@
+import mmap, os, random
+from hashlib import sha256
+
+MIN_CHUNK_SIZE = 1024 * 256
+AVG_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024 * 4
+
+_MASK_64 = (1 << 64) - 1
+# Fixed seed, the table must never change or previously stored chunks stop matching
+GEAR = tuple(random.Random(0x6271636b + i).getrandbits(64) for i in range(256))
+
+def _mask(bits: int) -> int:
+    # Gear hash mixes older bytes into the high bits, so the boundary test uses those
+    return ((1 << bits) - 1) << (64 - bits)
+
+"""
+    Content-defined chunking with a gear rolling hash (FastCDC style).
+    Boundaries depend on the content only, so an insertion in a file
+    shifts at most the chunks around it and identical files give identical chunks.
+"""
+class Chunker:
+    def __init__(self, min_size: int = MIN_CHUNK_SIZE, avg_size: int = AVG_CHUNK_SIZE, max_size: int = MAX_CHUNK_SIZE):
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        bits = max(avg_size.bit_length() - 1, 1)
+        # Normalized chunking, harder to cut before avg_size and easier after it
+        self._mask_small = _mask(bits + 2)
+        self._mask_large = _mask(max(bits - 2, 1))
+
+    def _cut(self, data, start: int, end: int) -> int:
+        remaining = end - start
+        if remaining <= self.min_size:
+            return end
+
+        stop = start + min(remaining, self.max_size)
+        normal = start + min(remaining, self.avg_size)
+        gear, mask, h = GEAR, self._mask_small, 0
+        i = start + self.min_size
+        while i < normal:
+            h = ((h << 1) + gear[data[i]]) & _MASK_64
+            if not h & mask:
+                return i + 1
+            i += 1
+
+        mask = self._mask_large
+        while i < stop:
+            h = ((h << 1) + gear[data[i]]) & _MASK_64
+            if not h & mask:
+                return i + 1
+            i += 1
+        return stop
+
+    # Returns [(offset, length, sha256 hex)]
+    def chunk_file(self, path: str) -> list:
+        size = os.path.getsize(path)
+        if not size:
+            return []
+
+        chunks = []
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offset = 0
+            while offset < size:
+                cut = self._cut(data, offset, size)
+                chunks.append((offset, cut - offset, sha256(data[offset:cut]).hexdigest()))
+                offset = cut
+        return chunks
+
+def chunk_file(path: str) -> list:
+    return Chunker().chunk_file(path)
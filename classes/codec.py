@@ -0,0 +1,120 @@
+import gzip, shutil
+
+class CodecException(Exception): pass
+
+"""
+    Compression codecs used for archives and database dumps.
+    Every block is compressed as an independent frame (gzip member, zstd frame, lz4 frame)
+    so the concatenated output can be read by the standard gzip / zstd / lz4 tools.
+"""
+class Codec:
+    name = None
+    extension = None
+    min_level = 1
+    max_level = 9
+    default_level = 6
+
+    def __init__(self, level: int = None):
+        self.level = self.default_level if level is None else int(level)
+        if not self.min_level <= self.level <= self.max_level:
+            raise CodecException(f"{self.name} level should be between {self.min_level} and {self.max_level}")
+
+    def check(self) -> None:
+        pass
+
+    # Shell command used to compress a pipe, e.g. mysqldump ... | <command>
+    def command(self) -> str:
+        raise NotImplementedError
+
+    def decompress_command(self) -> str:
+        raise NotImplementedError
+
+class Gzip(Codec):
+    name = 'gzip'
+    extension = 'gz'
+
+    def command(self) -> str:
+        return f"gzip -{self.level}"
+
+    def decompress_command(self) -> str:
+        return "gzip -dc"
+
+class Zstd(Codec):
+    name = 'zstd'
+    extension = 'zst'
+    max_level = 19
+    default_level = 3
+
+    def check(self) -> None:
+        try:
+            import zstandard
+        except ImportError:
+            raise CodecException("zstd compression requires the zstandard package")
+        # Database dumps and every restore pipe through the command line tool
+        if not shutil.which('zstd'):
+            raise CodecException("zstd compression requires the zstd command (apt install zstd)")
+
+    def command(self) -> str:
+        # -T0 compress with as many threads as cores
+        return f"zstd -q -T0 -{self.level}"
+
+    def decompress_command(self) -> str:
+        return "zstd -q -dc"
+
+class Lz4(Codec):
+    name = 'lz4'
+    extension = 'lz4'
+    max_level = 12
+    default_level = 1
+
+    def check(self) -> None:
+        try:
+            import lz4.frame
+        except ImportError:
+            raise CodecException("lz4 compression requires the lz4 package")
+        if not shutil.which('lz4'):
+            raise CodecException("lz4 compression requires the lz4 command (apt install lz4)")
+
+    def command(self) -> str:
+        return f"lz4 -q -{self.level}"
+
+    def decompress_command(self) -> str:
+        return "lz4 -q -dc"
+
+CODECS = {codec.name: codec for codec in (Gzip, Zstd, Lz4)}
+
+def get_codec(name: str = None, level: int = None) -> Codec:
+    name = (name or Gzip.name).lower()
+    if name not in CODECS:
+        raise CodecException(f"Compression {name} not supported, use one of {', '.join(CODECS)}")
+    return CODECS[name](level)
+
+def compress_block(name: str, data: bytes, level: int) -> bytes:
+    if name == Zstd.name:
+        import zstandard
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    if name == Lz4.name:
+        import lz4.frame
+        return lz4.frame.compress(data, compression_level=level)
+    # mtime=0 so identical blocks produce identical members
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+# Reverse of compress_block, a block decompresses on its own
+def decompress_block(name: str, data: bytes) -> bytes:
+    if name == Zstd.name:
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    if name == Lz4.name:
+        import lz4.frame
+        return lz4.frame.decompress(data)
+    return gzip.decompress(data)
+
+# Readable stream of the decompressed content of fileobj (blocks written by compress_block, one after the other)
+def open_decompressor(name: str, fileobj):
+    if name == Zstd.name:
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True)
+    if name == Lz4.name:
+        import lz4.frame
+        return lz4.frame.open(fileobj, 'rb')
+    return gzip.GzipFile(fileobj=fileobj, mode='rb')
@@ -0,0 +1,98 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from classes.codec import Codec, Gzip, compress_block
+
+# 8 MB blocks keep every worker busy without holding too much in memory
+DEFAULT_BLOCK_SIZE = 1024 * 1024 * 8
+
+class CompressorException(Exception): pass
+
+"""
+    File-like writer that splits the incoming stream into fixed size blocks,
+    compresses them on a process pool and writes the frames back in order.
+    Usage:
+        with open(output, 'wb') as f, ParallelCompressor(f, workers=8) as writer:
+            writer.write(data)
+"""
+class ParallelCompressor:
+    def __init__(self, fileobj, workers: int, block_size: int = DEFAULT_BLOCK_SIZE, codec: Codec = None):
+        if workers < 1:
+            raise CompressorException("Compression workers should be at least 1")
+
+        self._fileobj = fileobj
+        self._block_size = block_size
+        self._codec = codec or Gzip()
+        self._codec.check()
+        self._buffer = bytearray()
+        self._pending = deque()
+        # Bound the in-flight blocks so memory stays around workers * 2 * block_size
+        self._max_pending = workers * 2
+        # A single worker compresses inline, no need to pay for a process pool
+        self._pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        self._closed = False
+        self._raw_written = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # (raw offset, compressed offset, compressed size) of every block, each one decompresses on its own
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+    def write(self, data) -> int:
+        if self._closed:
+            raise CompressorException("Write on closed compressor")
+
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            self._submit(bytes(self._buffer[:self._block_size]))
+            del self._buffer[:self._block_size]
+        return len(data)
+
+    def _submit(self, block: bytes):
+        self.bytes_in += len(block)
+        if not self._pool:
+            self._write(compress_block(self._codec.name, block, self._codec.level), len(block))
+            return
+
+        self._pending.append((len(block), self._pool.submit(compress_block, self._codec.name, block, self._codec.level)))
+        while len(self._pending) > self._max_pending:
+            self._drain_one()
+
+    def _drain_one(self):
+        raw_size, future = self._pending.popleft()
+        self._write(future.result(), raw_size)
+
+    def _write(self, compressed: bytes, raw_size: int):
+        self._fileobj.write(compressed)
+        self.blocks.append((self._raw_written, self.bytes_out, len(compressed)))
+        self._raw_written += raw_size
+        self.bytes_out += len(compressed)
+
+    def close(self):
+        if self._closed:
+            return
+        try:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._pending:
+                self._drain_one()
+        finally:
+            self._closed = True
+            if self._pool:
+                self._pool.shutdown()
+
+    def abort(self):
+        self._closed = True
+        for _, future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        if self._pool:
+            self._pool.shutdown()
@@ -1,10 +1,32 @@
-import configparser
+import configparser, os, threading
 from constant import CONFIG_PATH
 
+"""
+    bqckup.cnf is parsed once per process, every Config() only checks the
+    file (mtime and size) and parses it again when it changed.
+"""
 class Config:
+    _parser = None
+    _version = None
+    _lock = threading.Lock()
+
     def __init__(self):
-        self.config_parser = configparser.ConfigParser()
-        self.config_parser.read(CONFIG_PATH)
+        self.config_parser = Config._load()
+
+    @classmethod
+    def _load(cls) -> configparser.ConfigParser:
+        try:
+            st = os.stat(CONFIG_PATH)
+            version = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            version = None
+
+        with cls._lock:
+            if cls._parser is None or version != cls._version:
+                parser = configparser.ConfigParser()
+                parser.read(CONFIG_PATH)
+                cls._parser, cls._version = parser, version
+            return cls._parser
     
     def read(self, section, key, default=None):
         try:
@@ -13,5 +35,29 @@ class Config:
             print(f"Failed to read config, {str(e)}")
             print(f"Check if {CONFIG_PATH} exists and has the correct format")
             return default
+
+    # Typed accessors, a missing key quietly returns the default (options added after the install)
+    def _typed(self, section, key, default, cast):
+        value = self.config_parser.get(section, key, fallback=None)
+        if value is None or value == '':
+            return default
+        try:
+            return cast(value)
+        except ValueError:
+            print(f"Invalid value for {key} in [{section}] of {CONFIG_PATH}: {value}")
+            return default
+
+    def read_int(self, section, key, default=None) -> int:
+        return self._typed(section, key, default, int)
+
+    def read_float(self, section, key, default=None) -> float:
+        return self._typed(section, key, default, float)
+
+    def read_bool(self, section, key, default=None) -> bool:
+        def cast(value):
+            if value.lower() not in configparser.ConfigParser.BOOLEAN_STATES:
+                raise ValueError(value)
+            return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+        return self._typed(section, key, default, cast)
+        
         
-        
\ No newline at end of file
@@ -1,4 +1,5 @@
-import logging, os
+import logging, os, subprocess
+from classes.codec import Codec, Gzip
 
 # Database Exceptions
 class DatabaseException(Exception):
@@ -15,10 +16,62 @@ class Database:
     def __init__(self, type = "mysql"):
         self.type = type.lower()
         
-    def export(self, output: str, db_user: str, db_password: str, db_name: str) -> None:
-        os.system(f"mysqldump -u {db_user} -p'{db_password}' {db_name} --no-tablespaces | gzip > {output}")
+    # output is either a path or a writable file-like object (e.g. an upload stream)
+    def export(self, output, db_user: str, db_password: str, db_name: str, codec: Codec = None) -> int:
+        codec = codec or Gzip()
+        command = f"mysqldump -u {db_user} -p'{db_password}' {db_name} --no-tablespaces | {codec.command()}"
+
+        if isinstance(output, str):
+            os.system(f"{command} > {output}")
+            return os.stat(output).st_size
+
+        # pipefail so a failing mysqldump is not hidden behind the compressor exit code
+        process = subprocess.Popen(f"set -o pipefail; {command}", shell=True, executable='/bin/bash', stdout=subprocess.PIPE)
+        written = 0
+        while True:
+            chunk = process.stdout.read(1024 * 1024)
+            if not chunk:
+                break
+            output.write(chunk)
+            written += len(chunk)
+        if process.wait() != 0:
+            raise DatabaseException(f"Failed to export database {db_name}")
+        return written
     
+    # Loads a dump made by export, source is a path or a readable file-like object (e.g. a download stream)
+    def restore(self, source, db_user: str, db_password: str, db_name: str, codec: Codec = None) -> int:
+        codec = codec or Gzip()
+        command = f"{codec.decompress_command()} | mysql -u {db_user} -p'{db_password}' {db_name}"
+        process = subprocess.Popen(f"set -o pipefail; {command}", shell=True, executable='/bin/bash', stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        fileobj = open(source, 'rb') if isinstance(source, str) else source
+        read = 0
+        try:
+            while True:
+                chunk = fileobj.read(1024 * 1024)
+                if not chunk:
+                    break
+                process.stdin.write(chunk)
+                read += len(chunk)
+        except BrokenPipeError:
+            pass
+        finally:
+            if isinstance(source, str):
+                fileobj.close()
+            process.stdin.close()
+        if process.wait() != 0:
+            raise DatabaseException(f"Failed to import database {db_name}, {process.stderr.read().decode(errors='replace').strip()}")
+        return read
+
     def test_connection(self, credentials: dict) -> bool:
+        if self.type == 'postgresql':
+            from classes.pgdump import PgDump
+            PgDump(credentials).test_connection()
+            return True
+        if self.type == 'sqlite':
+            from classes.sqlitedump import SqliteDump
+            SqliteDump(credentials).test_connection()
+            return True
+
         import mysql.connector
         try:
             c = mysql.connector.connect(
@@ -0,0 +1,84 @@
+import os, time
+from hashlib import blake2b
+from classes.manifest import walk
+
+# Entry digests are added up, so the fingerprint doesn't depend on the walk order
+MODULO = 1 << 128
+# UPDATE_TIME has a one second resolution, a table written this recently may change again unnoticed
+RECENT = 2
+
+def _combine(kind: str, entries) -> str:
+    total = count = 0
+    for entry in entries:
+        total = (total + int.from_bytes(blake2b(entry, digest_size=16).digest(), 'big')) % MODULO
+        count += 1
+    return f"{kind}:{count}:{total:032x}"
+
+# (path, size, mtime) of everything under paths, taken from a manifest scan (path => (size, mtime, ...)) when there is one
+def files_fingerprint(paths: list, scanned: dict = None) -> str:
+    if scanned is not None:
+        entries = ((path, values[0], values[1]) for path, values in scanned.items())
+    else:
+        entries = ((path, st.st_size, st.st_mtime_ns) for root in paths if os.path.exists(root) for path, st in walk(root))
+    return _combine('files', (os.fsencode(path) + f"\0{size}\0{mtime}".encode() for path, size, mtime in entries))
+
+"""
+    MySQL fingerprint from information_schema: creation and update time of
+    every table, the view and trigger definitions. InnoDB doesn't keep
+    UPDATE_TIME across restarts (NULL), those tables are checksummed
+    (CHECKSUM TABLE reads the table, still far cheaper than a dump).
+    None when it can't be trusted, a table was written in the last seconds.
+"""
+def mysql_fingerprint(credentials: dict):
+    from classes.mysqldump import connect
+    import mysql.connector
+    name = credentials.get('name')
+    connection = connect(credentials)
+    cursor = connection.cursor()
+    try:
+        # MySQL 8 caches these statistics for a day by default
+        try:
+            cursor.execute("SET SESSION information_schema_stats_expiry = 0")
+        except mysql.connector.Error:
+            pass
+
+        cursor.execute(
+            "SELECT TABLE_NAME, TABLE_TYPE, ENGINE, CREATE_TIME, UPDATE_TIME, CHECKSUM, UNIX_TIMESTAMP(UPDATE_TIME), UNIX_TIMESTAMP() FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s",
+            (name,)
+        )
+        tables = cursor.fetchall()
+        entries = []
+        unknown = []
+        for table, kind, engine, created, updated, checksum, updated_unix, now in tables:
+            if updated_unix is not None and now - updated_unix < RECENT:
+                return None
+            if kind == 'BASE TABLE' and updated is None and checksum is None:
+                unknown.append(table)
+            entries.append(f"table\0{table}\0{kind}\0{engine}\0{created}\0{updated}\0{checksum}")
+
+        if unknown:
+            cursor.execute("CHECKSUM TABLE " + ", ".join("`" + name.replace("`", "``") + "`.`" + table.replace("`", "``") + "`" for table in unknown))
+            entries.extend(f"checksum\0{table}\0{checksum}" for table, checksum in cursor.fetchall())
+
+        cursor.execute("SELECT TABLE_NAME, VIEW_DEFINITION FROM information_schema.VIEWS WHERE TABLE_SCHEMA = %s", (name,))
+        entries.extend(f"view\0{view}\0{definition}" for view, definition in cursor.fetchall())
+        cursor.execute("SELECT TRIGGER_NAME, ACTION_TIMING, EVENT_MANIPULATION, EVENT_OBJECT_TABLE, ACTION_STATEMENT FROM information_schema.TRIGGERS WHERE TRIGGER_SCHEMA = %s", (name,))
+        entries.extend("trigger\0" + "\0".join(str(value) for value in row) for row in cursor.fetchall())
+    finally:
+        cursor.close()
+        connection.close()
+    return _combine('mysql', (entry.encode() for entry in entries))
+
+# Size and mtime of the database and its WAL
+def sqlite_fingerprint(credentials: dict):
+    path = credentials.get('path') or credentials.get('name')
+    entries = []
+    for file in (path, f"{path}-wal"):
+        try:
+            st = os.stat(file)
+        except FileNotFoundError:
+            continue
+        if time.time() - st.st_mtime < RECENT:
+            return None
+        entries.append(os.fsencode(file) + f"\0{st.st_size}\0{st.st_mtime_ns}".encode())
+    return _combine('sqlite', entries)
@@ -0,0 +1,31 @@
+import fcntl, os
+
+"""
+    Per-site lock held for a whole backup, across processes: the daemon, a cron
+    `bqckup run` and `bqckup capture-binlog` of the same site never overlap.
+    An flock, released by the kernel when its process dies, so a crash leaves no stale lock.
+    Shared holders don't exclude each other, only an exclusive one (see Repository.collect).
+"""
+class SiteLock:
+    def __init__(self, folder: str, name: str):
+        os.makedirs(folder, exist_ok=True)
+        self.path = os.path.join(folder, f"{name}.lock")
+        self._fd = None
+
+    # False when another backup of the site holds it, wait blocks until it is released instead
+    def acquire(self, shared: bool = False, wait: bool = False) -> bool:
+        fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if wait else fcntl.LOCK_NB))
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self) -> None:
+        if self._fd is None:
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
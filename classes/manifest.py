@@ -0,0 +1,104 @@
+import os, stat
+from hashlib import sha256
+from typing import Union
+from peewee import chunked
+from models import database
+from models.manifest import ManifestEntry
+
+# Yields (path, lstat) for the path itself and everything below it
+def walk(path: str):
+    yield path, os.lstat(path)
+    if not os.path.isdir(path) or os.path.islink(path):
+        return
+
+    stack = [path]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError as e:
+            print(f"Skipped, {e}")
+            continue
+        for entry in entries:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            yield entry.path, st
+            if stat.S_ISDIR(st.st_mode):
+                stack.append(entry.path)
+
+"""
+    Per site file manifest (path, size, mtime, inode and optional hash)
+    used to find what changed since the last successful backup.
+"""
+class Manifest:
+    def __init__(self, name: str, hash: bool = False):
+        self.name = name
+        self.hash = hash
+        self._previous = None
+
+    def previous(self) -> dict:
+        if self._previous is None:
+            self._previous = {
+                entry.path: (entry.size, entry.mtime, entry.inode, entry.hash)
+                for entry in ManifestEntry.select().where(ManifestEntry.name == self.name)
+            }
+        return self._previous
+
+    def exists(self) -> bool:
+        return ManifestEntry.select().where(ManifestEntry.name == self.name).exists()
+
+    def _hash_file(self, path: str) -> str:
+        digest = sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def scan(self, source: Union[str, list]) -> dict:
+        if type(source) == str:
+            source = [source]
+
+        previous = self.previous()
+        results = {}
+        for root in source:
+            if not os.path.exists(root):
+                continue
+            for path, st in walk(root):
+                file_hash = None
+                if self.hash and stat.S_ISREG(st.st_mode):
+                    old = previous.get(path)
+                    # Only hash what looks modified, unchanged files keep their previous hash
+                    if old and old[:3] == (st.st_size, st.st_mtime_ns, st.st_ino) and old[3]:
+                        file_hash = old[3]
+                    else:
+                        file_hash = self._hash_file(path)
+                results[path] = (st.st_size, st.st_mtime_ns, st.st_ino, file_hash)
+        return results
+
+    # Returns (new or changed paths, deleted paths)
+    def diff(self, current: dict) -> tuple:
+        previous = self.previous()
+        changed = set()
+        for path, entry in current.items():
+            old = previous.get(path)
+            if not old:
+                changed.add(path)
+            elif self.hash and entry[3] and old[3]:
+                if entry[3] != old[3] or entry[0] != old[0]:
+                    changed.add(path)
+            elif entry[:3] != old[:3]:
+                changed.add(path)
+        deleted = set(previous) - set(current)
+        return changed, deleted
+
+    def save(self, current: dict) -> None:
+        with database.atomic():
+            ManifestEntry.delete().where(ManifestEntry.name == self.name).execute()
+            rows = [
+                {"name": self.name, "path": path, "size": entry[0], "mtime": entry[1], "inode": entry[2], "hash": entry[3]}
+                for path, entry in current.items()
+            ]
+            for batch in chunked(rows, 100):
+                ManifestEntry.insert_many(batch).execute()
+        self._previous = current
@@ -0,0 +1,346 @@
+import os, queue, socket, threading, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from models.upload import Upload, UploadPart
+
+# S3 refuses parts smaller than 5 MB (except the last one) and more than 10,000 parts
+MIN_PART_SIZE = 1024 * 1024 * 5
+MAX_PARTS = 10000
+
+class MultipartException(Exception): pass
+
+"""
+    File-like writer that uploads everything written to it as an S3 multipart upload.
+    Parts are handed to uploader threads through a bounded queue, so at most
+    (buffers + concurrency + 1) parts are held in memory whatever the total size.
+    The part size grows by part_size every 1000 parts to stay under the 10,000 parts limit
+    for archives bigger than part_size * 10,000.
+"""
+class MultipartStream:
+    def __init__(self, client, bucket: str, key: str, part_size: int = MIN_PART_SIZE * 3, concurrency: int = 4, buffers: int = 4, on_complete=None):
+        self._client = client
+        self._bucket = bucket
+        self._key = key
+        self._part_size = max(part_size, MIN_PART_SIZE)
+        self._buffer = bytearray()
+        self._queue = queue.Queue(maxsize=buffers)
+        self._parts = {}
+        self._error = None
+        self._lock = threading.Lock()
+        self._closed = False
+        self._stopped = False
+        # Called with (size, elapsed, concurrency, part size) once the upload is completed
+        self._on_complete = on_complete
+        self._concurrency = max(concurrency, 1)
+        self._started_at = time.time()
+        self.part_number = 0
+        self.bytes_written = 0
+        self.etag = None
+
+        self.upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+        self._threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(self._concurrency)]
+        for thread in self._threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+    def _current_part_size(self) -> int:
+        return self._part_size * (1 + self.part_number // 1000)
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            part_number, data = item
+            try:
+                if not self._error:
+                    response = self._client.upload_part(
+                        Bucket=self._bucket, Key=self._key, UploadId=self.upload_id,
+                        PartNumber=part_number, Body=data
+                    )
+                    with self._lock:
+                        self._parts[part_number] = response['ETag']
+            except Exception as e:
+                self._error = e
+
+    def _put(self, data: bytes):
+        if self._error:
+            raise MultipartException(f"Failed to upload part: {self._error}")
+        self.part_number += 1
+        if self.part_number > MAX_PARTS:
+            raise MultipartException(f"Upload of {self._key} exceeds {MAX_PARTS} parts")
+        # Blocks while every buffer is in flight, this is what caps the memory usage
+        self._queue.put((self.part_number, data))
+
+    def write(self, data) -> int:
+        if self._closed:
+            raise MultipartException("Write on closed upload stream")
+
+        self._buffer += data
+        self.bytes_written += len(data)
+        part_size = self._current_part_size()
+        while len(self._buffer) >= part_size:
+            self._put(bytes(self._buffer[:part_size]))
+            del self._buffer[:part_size]
+            part_size = self._current_part_size()
+        return len(data)
+
+    def _stop_workers(self):
+        if self._stopped:
+            return
+        self._stopped = True
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def close(self):
+        if self._closed:
+            return
+        try:
+            # An empty stream still needs one (empty) part to complete the upload
+            if self._buffer or not self.part_number:
+                self._put(bytes(self._buffer))
+                self._buffer = bytearray()
+            self._stop_workers()
+            if self._error:
+                raise MultipartException(f"Failed to upload part: {self._error}")
+            response = self._client.complete_multipart_upload(
+                Bucket=self._bucket, Key=self._key, UploadId=self.upload_id,
+                MultipartUpload={"Parts": [{"PartNumber": number, "ETag": self._parts[number]} for number in sorted(self._parts)]}
+            )
+            self.etag = response.get('ETag')
+            if self._on_complete:
+                self._on_complete(self.bytes_written, time.time() - self._started_at, self._concurrency, self._part_size)
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._closed = True
+
+    def abort(self):
+        if not self._error:
+            self._error = MultipartException("Upload aborted")
+        self._closed = True
+        self._stop_workers()
+        try:
+            self._client.abort_multipart_upload(Bucket=self._bucket, Key=self._key, UploadId=self.upload_id)
+        except Exception as e:
+            print(f"Failed to abort multipart upload {self._key}, {e}")
+
+# Owners on another host are considered dead once they stop updating the upload for this long
+STALE_AFTER = 60 * 60 * 6
+
+"""
+    Multipart upload of a file whose state (UploadId, part numbers, ETags, offsets)
+    is persisted in the uploads tables. Running it again for the same file resumes
+    the upload: parts already listed by list_parts are skipped.
+"""
+class ResumableUpload:
+    def __init__(self, client, storage_name: str, bucket: str, key: str, path: str, part_size: int, concurrency: int = 4, name: str = None, log_id: int = None, callback=None):
+        self._client = client
+        self.storage_name = storage_name
+        self.bucket = bucket
+        self.key = key
+        self.path = path
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.concurrency = max(concurrency, 1)
+        self.name = name
+        self.log_id = log_id
+        self._callback = callback
+
+    @staticmethod
+    def owner_alive(upload) -> bool:
+        if upload.hostname != socket.gethostname():
+            return time.time() - upload.updated_at < STALE_AFTER
+        # Same process means the previous attempt already failed here (e.g. a reused RQ worker)
+        if upload.pid == os.getpid():
+            return False
+        try:
+            os.kill(upload.pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def _find_state(self, st: os.stat_result):
+        return Upload.select().where(
+            (Upload.storage == self.storage_name) & (Upload.bucket == self.bucket) & (Upload.key == self.key) &
+            (Upload.source == self.path) & (Upload.size == st.st_size) & (Upload.mtime == st.st_mtime_ns) &
+            (Upload.status == Upload.__ON_PROGRESS__)
+        ).order_by(Upload.id.desc()).first()
+
+    def _part_range(self, size: int, part_number: int) -> tuple:
+        offset = (part_number - 1) * self.part_size
+        return offset, min(self.part_size, size - offset)
+
+    # Parts S3 already holds for this upload, None when the upload doesn't exist anymore
+    def _remote_parts(self, state, size: int):
+        parts = {}
+        marker = 0
+        while True:
+            try:
+                response = self._client.list_parts(Bucket=self.bucket, Key=self.key, UploadId=state.upload_id, PartNumberMarker=marker)
+            except self._client.exceptions.NoSuchUpload:
+                return None
+            for part in response.get('Parts', []):
+                # A part with an unexpected size was written with other settings, upload it again
+                if part['Size'] == self._part_range(size, part['PartNumber'])[1]:
+                    parts[part['PartNumber']] = part['ETag']
+            if not response.get('IsTruncated'):
+                return parts
+            marker = response['NextPartNumberMarker']
+
+    def _upload_part(self, state, size: int, part_number: int) -> str:
+        offset, length = self._part_range(size, part_number)
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        etag = self._client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=state.upload_id, PartNumber=part_number, Body=data)['ETag']
+        UploadPart.insert(upload=state, part_number=part_number, etag=etag, offset=offset, size=length).on_conflict_replace().execute()
+        Upload.update(updated_at=int(time.time())).where(Upload.id == state.id).execute()
+        if self._callback:
+            self._callback(length)
+        return etag
+
+    # Returns the ETag of the completed object
+    def run(self) -> str:
+        st = os.stat(self.path)
+        size = st.st_size
+        state = self._find_state(st)
+        parts = {}
+
+        if state:
+            self.part_size = state.part_size
+            parts = self._remote_parts(state, size)
+            if parts is None:
+                Upload.update(status=Upload.__ABORTED__).where(Upload.id == state.id).execute()
+                state, parts = None, {}
+            else:
+                print(f"Resuming upload of {self.key}, {len(parts)} part(s) already uploaded")
+                Upload.update(pid=os.getpid(), hostname=socket.gethostname(), updated_at=int(time.time())).where(Upload.id == state.id).execute()
+
+        if not state:
+            now = int(time.time())
+            state = Upload.create(
+                name=self.name, log_id=self.log_id, storage=self.storage_name, bucket=self.bucket, key=self.key,
+                upload_id=self._client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId'],
+                source=self.path, size=size, mtime=st.st_mtime_ns, part_size=self.part_size, status=Upload.__ON_PROGRESS__,
+                pid=os.getpid(), hostname=socket.gethostname(), created_at=now, updated_at=now,
+            )
+
+        total = max(-(-size // self.part_size), 1)
+        if total > MAX_PARTS:
+            raise MultipartException(f"Upload of {self.key} needs {total} parts, more than {MAX_PARTS}")
+
+        if self._callback:
+            self._callback(sum(self._part_range(size, number)[1] for number in parts))
+
+        # On failure the state is kept as is, the next run picks it up from here
+        missing = [number for number in range(1, total + 1) if number not in parts]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            futures = {number: pool.submit(self._upload_part, state, size, number) for number in missing}
+            for number, future in futures.items():
+                parts[number] = future.result()
+
+        response = self._client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=state.upload_id,
+            MultipartUpload={"Parts": [{"PartNumber": number, "ETag": parts[number]} for number in sorted(parts)]}
+        )
+        Upload.update(status=Upload.__COMPLETED__, updated_at=int(time.time())).where(Upload.id == state.id).execute()
+        UploadPart.delete().where(UploadPart.upload == state.id).execute()
+        return response.get('ETag')
+
+"""
+    File-like reader of an object fetched with concurrent ranged GETs, the
+    download counterpart of MultipartStream. fetch(start, end) returns the bytes
+    start to end (inclusive). Parts are requested ahead of the reader and handed
+    over in order, at most (concurrency + buffers) parts are held in memory.
+"""
+class RangedReader:
+    def __init__(self, fetch, size: int, part_size: int = MIN_PART_SIZE, concurrency: int = 4, buffers: int = 4):
+        self._fetch = fetch
+        self.size = size
+        self._part_size = max(part_size, 1)
+        self._ahead = max(concurrency, 1) + max(buffers, 0)
+        self._pool = ThreadPoolExecutor(max_workers=max(concurrency, 1))
+        self._futures = deque()
+        self._next = 0
+        self._part = b""
+        self._offset = 0
+        self._closed = False
+        self._started_at = time.time()
+        self._finished_at = None
+        self.bytes_read = 0
+        # Seconds the reader spent waiting for a part
+        self.waited = 0.0
+        self._fill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # Seconds from the first request to the last part received
+    @property
+    def elapsed(self) -> float:
+        return (self._finished_at or time.time()) - self._started_at
+
+    def _get(self, start: int, end: int) -> bytes:
+        data = self._fetch(start, end)
+        if len(data) != end - start + 1:
+            raise MultipartException(f"Expected {end - start + 1} bytes at {start}, got {len(data)}")
+        return data
+
+    def _fill(self):
+        while self._next < self.size and len(self._futures) < self._ahead:
+            end = min(self._next + self._part_size, self.size) - 1
+            self._futures.append(self._pool.submit(self._get, self._next, end))
+            self._next = end + 1
+
+    def read(self, size: int = -1) -> bytes:
+        if self._closed:
+            raise MultipartException("Read on closed download stream")
+
+        chunks = []
+        while size != 0:
+            if self._offset >= len(self._part):
+                if not self._futures:
+                    break
+                waiting_since = time.time()
+                self._part = self._futures.popleft().result()
+                self.waited += time.time() - waiting_since
+                self._offset = 0
+                self.bytes_read += len(self._part)
+                self._fill()
+                if not self._futures and self._next >= self.size:
+                    self._finished_at = time.time()
+                continue
+            take = len(self._part) - self._offset if size < 0 else min(size, len(self._part) - self._offset)
+            chunks.append(self._part[self._offset:self._offset + take])
+            self._offset += take
+            if size > 0:
+                size -= take
+        return b"".join(chunks)
+
+    def readable(self) -> bool:
+        return True
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for future in self._futures:
+            future.cancel()
+        self._futures.clear()
+        self._pool.shutdown(wait=True)
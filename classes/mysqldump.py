@@ -0,0 +1,353 @@
+import json, os, re, shutil, subprocess, tarfile, tempfile, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from classes.codec import Codec, Gzip, get_codec
+from classes.compressor import ParallelCompressor
+from classes.database import DatabaseException
+
+DUMP_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+POST_NAME = 'post.sql'
+# Extended INSERT statements are cut around this size, well under the default max_allowed_packet
+STATEMENT_SIZE = 1024 * 1024
+FETCH_SIZE = 1000
+# Values of these types are written as hex literals, everything else as a quoted string
+BINARY_TYPES = ('binary', 'varbinary', 'tinyblob', 'blob', 'mediumblob', 'longblob', 'bit', 'geometry', 'point', 'linestring', 'polygon', 'multipoint', 'multilinestring', 'multipolygon', 'geometrycollection')
+HEADER = b"SET NAMES utf8mb4;\nSET time_zone='+00:00';\nSET FOREIGN_KEY_CHECKS=0;\nSET UNIQUE_CHECKS=0;\nSET SQL_MODE='NO_AUTO_VALUE_ON_ZERO';\n"
+ESCAPES = ((b'\\', b'\\\\'), (b"'", b"\\'"), (b'\0', b'\\0'), (b'\n', b'\\n'), (b'\r', b'\\r'), (b'\x1a', b'\\Z'))
+
+def connect(credentials: dict):
+    import mysql.connector
+    try:
+        return mysql.connector.connect(
+            user=credentials.get('user'),
+            password=str(credentials.get('password') or ''),
+            host=credentials.get('host') or 'localhost',
+            port=int(credentials.get('port') or 3306),
+            database=credentials.get('name'),
+            charset='utf8mb4',
+        )
+    except mysql.connector.Error as e:
+        raise DatabaseException(f"Failed to connect database, {e}")
+
+# (binary log file, position) the server is writing to
+def binlog_position(cursor) -> tuple:
+    import mysql.connector
+    # Renamed in MySQL 8.4
+    for query in ("SHOW BINARY LOG STATUS", "SHOW MASTER STATUS"):
+        try:
+            cursor.execute(query)
+        except mysql.connector.Error:
+            continue
+        row = cursor.fetchone()
+        if not row:
+            raise DatabaseException("Binary logging is disabled on this server (log_bin)")
+        return row[0], int(row[1])
+    raise DatabaseException("Unable to read the binary log position (REPLICATION CLIENT privilege needed)")
+
+def quote_name(name: str) -> str:
+    return "`" + name.replace("`", "``") + "`"
+
+def literal(value, binary: bool) -> bytes:
+    if value is None:
+        return b'NULL'
+    if binary:
+        return b"0x" + bytes(value).hex().encode() if value else b"''"
+    value = bytes(value)
+    for char, escaped in ESCAPES:
+        if char in value:
+            value = value.replace(char, escaped)
+    return b"'" + value + b"'"
+
+"""
+    Parallel MySQL dump. Tables are exported by a pool of connections sharing
+    one consistent snapshot: the global read lock is held only while every
+    worker opens its transaction (what mydumper does), so the dump matches a
+    single point in time like mysqldump --single-transaction.
+    Each table is compressed with the site codec into its own member of an
+    uncompressed tar, next to a manifest that lets restore load tables in parallel.
+    With binlog the binary log position of the snapshot is read under the lock
+    and written in the manifest, binary logs are replayed from there (classes/binlog.py).
+"""
+class MysqlDump:
+    def __init__(self, credentials: dict, threads: int = 4, codec: Codec = None, tmp_path: str = None, binlog: bool = False):
+        self.credentials = credentials
+        self.threads = max(int(threads), 1)
+        self.codec = codec or Gzip()
+        self.tmp_path = tmp_path
+        self.binlog = binlog
+        # (file, position) of the snapshot when binlog is on
+        self.position = None
+        self.stats = {}
+
+    def _connect(self):
+        connection = connect(self.credentials)
+        cursor = connection.cursor()
+        cursor.execute("SET SESSION time_zone = '+00:00'")
+        cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        cursor.close()
+        return connection
+
+    def _snapshot(self) -> list:
+        import mysql.connector
+        control = self._connect()
+        cursor = control.cursor()
+        locked = False
+        try:
+            cursor.execute("FLUSH TABLES WITH READ LOCK")
+            locked = True
+        except mysql.connector.Error as e:
+            # Without the lock the position can't be matched to the snapshot
+            if self.binlog:
+                cursor.close()
+                control.close()
+                raise DatabaseException(f"Binary log backups need the global read lock (RELOAD privilege), {e}")
+            # Managed servers often refuse the global lock (no RELOAD privilege)
+            if self.threads > 1:
+                print(f"Warning, unable to lock tables ({e}), tables are dumped consistently one by one but not with each other")
+
+        connections = []
+        try:
+            if self.binlog:
+                self.position = binlog_position(cursor)
+            for _ in range(self.threads):
+                connection = self._connect()
+                connection.cursor().execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+                connections.append(connection)
+        finally:
+            if locked:
+                cursor.execute("UNLOCK TABLES")
+            cursor.close()
+            control.close()
+        return connections
+
+    def _tables(self, connection) -> tuple:
+        cursor = connection.cursor()
+        name = self.credentials.get('name')
+        cursor.execute(
+            "SELECT TABLE_NAME, TABLE_TYPE, COALESCE(DATA_LENGTH, 0) FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s",
+            (name,)
+        )
+        rows = cursor.fetchall()
+        tables = {table: size for table, kind, size in rows if kind == 'BASE TABLE'}
+        views = sorted(table for table, kind, _ in rows if kind == 'VIEW')
+
+        # Generated columns can't be inserted, they are left out of the INSERT column list
+        columns = {}
+        cursor.execute(
+            "SELECT TABLE_NAME, COLUMN_NAME, DATA_TYPE, EXTRA FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = %s ORDER BY TABLE_NAME, ORDINAL_POSITION",
+            (name,)
+        )
+        for table, column, data_type, extra in cursor.fetchall():
+            if table in tables and not re.search(r'(VIRTUAL|STORED) GENERATED', extra or '', re.I):
+                columns.setdefault(table, []).append((column, data_type.lower() in BINARY_TYPES))
+        cursor.close()
+
+        # Biggest tables first so the pool doesn't end waiting on one large table
+        return sorted(tables, key=lambda table: -tables[table]), columns, views
+
+    def _dump_table(self, connection, index: int, table: str, columns: list, folder: str) -> dict:
+        cursor = connection.cursor()
+        cursor.execute(f"SHOW CREATE TABLE {quote_name(table)}")
+        create = cursor.fetchone()[1]
+        cursor.close()
+
+        schema_name = f"schema/{index:05d}.sql"
+        data_name = f"data/{index:05d}.sql.{self.codec.extension}"
+        with open(os.path.join(folder, f"{index:05d}.schema"), 'w') as f:
+            # Tables come by size, not by dependency, a parent may be created after its children
+            f.write(f"SET FOREIGN_KEY_CHECKS=0;\nDROP TABLE IF EXISTS {quote_name(table)};\n{create};\n")
+
+        names = ", ".join(quote_name(column) for column, _ in columns)
+        binary = [is_binary for _, is_binary in columns]
+        prefix = f"INSERT INTO {quote_name(table)} ({names}) VALUES ".encode()
+        rows = 0
+        data_path = os.path.join(folder, f"{index:05d}.data")
+        with open(data_path, 'wb') as f, ParallelCompressor(f, 1, codec=self.codec) as writer:
+            writer.write(HEADER)
+            cursor = connection.cursor(raw=True)
+            cursor.execute(f"SELECT {names} FROM {quote_name(table)}")
+            statement = []
+            size = 0
+            while True:
+                batch = cursor.fetchmany(FETCH_SIZE)
+                if not batch:
+                    break
+                for row in batch:
+                    value = b"(" + b",".join(literal(v, is_binary) for v, is_binary in zip(row, binary)) + b")"
+                    statement.append(value)
+                    size += len(value) + 1
+                    rows += 1
+                    if size >= STATEMENT_SIZE:
+                        writer.write(prefix + b",".join(statement) + b";\n")
+                        statement, size = [], 0
+            if statement:
+                writer.write(prefix + b",".join(statement) + b";\n")
+            cursor.close()
+
+        return {
+            "table": table,
+            "schema": schema_name,
+            "data": data_name,
+            "rows": rows,
+            "raw_size": writer.bytes_in,
+            "size": writer.bytes_out,
+            "_files": (os.path.join(folder, f"{index:05d}.schema"), data_path),
+        }
+
+    def _post(self, connection, views: list) -> bytes:
+        cursor = connection.cursor()
+        statements = []
+
+        definitions = {}
+        for view in views:
+            cursor.execute(f"SHOW CREATE VIEW {quote_name(view)}")
+            definitions[view] = cursor.fetchone()[1]
+        # Views using other views are created after them
+        while definitions:
+            ready = [view for view, sql in definitions.items() if not any(quote_name(other) in sql for other in definitions if other != view)] or list(definitions)[:1]
+            for view in ready:
+                statements.append(f"DROP VIEW IF EXISTS {quote_name(view)};\n{definitions.pop(view)};\n")
+
+        # Triggers come last so they don't fire while the data is loaded
+        cursor.execute("SHOW TRIGGERS")
+        for trigger in [row[0] for row in cursor.fetchall()]:
+            cursor.execute(f"SHOW CREATE TRIGGER {quote_name(trigger)}")
+            create = cursor.fetchone()[2]
+            statements.append(f"DROP TRIGGER IF EXISTS {quote_name(trigger)};\nDELIMITER ;;\n{create};;\nDELIMITER ;\n")
+        cursor.close()
+        return ("SET NAMES utf8mb4;\n" + "".join(statements)).encode()
+
+    # output is either a path or a writable file-like object (e.g. an upload stream)
+    def export(self, output) -> int:
+        started_at = time.time()
+        folder = tempfile.mkdtemp(prefix='bqckup-dump-', dir=self.tmp_path)
+        connections = []
+        try:
+            connections = self._snapshot()
+            tables, columns, views = self._tables(connections[0])
+            post = self._post(connections[0], views)
+
+            # Every connection takes the next table until none is left
+            pending = list(enumerate(tables))
+            lock = threading.Lock()
+            results = []
+
+            def worker(connection):
+                while True:
+                    with lock:
+                        if not pending:
+                            return
+                        index, table = pending.pop(0)
+                    result = self._dump_table(connection, index, table, columns.get(table, []), folder)
+                    with lock:
+                        results.append(result)
+
+            with ThreadPoolExecutor(max_workers=len(connections)) as pool:
+                for future in [pool.submit(worker, connection) for connection in connections]:
+                    future.result()
+            results.sort(key=lambda result: result['schema'])
+
+            manifest = {
+                "version": DUMP_VERSION,
+                "database": self.credentials.get('name'),
+                "created_at": int(time.time()),
+                "codec": self.codec.name,
+                "threads": self.threads,
+                "post": POST_NAME,
+                "tables": [{k: v for k, v in result.items() if not k.startswith('_')} for result in results],
+            }
+            if self.position:
+                manifest["binlog"] = {"file": self.position[0], "position": self.position[1]}
+
+            if isinstance(output, str):
+                archive = tarfile.open(output, 'w')
+                counter = None
+            else:
+                counter = _CountingWriter(output)
+                archive = tarfile.open(fileobj=counter, mode='w|')
+            with archive:
+                for name, content in ((MANIFEST_NAME, json.dumps(manifest, indent=1).encode()), (POST_NAME, post)):
+                    info = tarfile.TarInfo(name)
+                    info.size = len(content)
+                    info.mtime = int(time.time())
+                    archive.addfile(info, BytesIO(content))
+                for result in results:
+                    schema_path, data_path = result['_files']
+                    archive.add(schema_path, result['schema'])
+                    archive.add(data_path, result['data'])
+        finally:
+            for connection in connections:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+            shutil.rmtree(folder, ignore_errors=True)
+
+        written = os.stat(output).st_size if counter is None else counter.written
+        elapsed = max(time.time() - started_at, 0.001)
+        raw_size = sum(result['raw_size'] for result in results)
+        self.stats = {"tables": len(results), "raw_size": raw_size, "size": written, "elapsed": elapsed, "threads": self.threads}
+        print(f"Dumped {len(results)} table(s), {raw_size / (1024 * 1024):.2f} MB in {elapsed:.2f}s with {self.threads} thread(s) ({raw_size / elapsed / (1024 * 1024):.2f} MB/s)")
+        return written
+
+    def _mysql_command(self) -> str:
+        host = self.credentials.get('host') or 'localhost'
+        port = int(self.credentials.get('port') or 3306)
+        return f"mysql -u {self.credentials.get('user')} -p'{self.credentials.get('password')}' -h {host} -P {port} {self.credentials.get('name')}"
+
+    def _load(self, command: str, name: str) -> None:
+        result = subprocess.run(f"set -o pipefail; {command}", shell=True, executable='/bin/bash', stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise DatabaseException(f"Failed to import {name}, {result.stderr.decode(errors='replace').strip()}")
+
+    # Loads a dump made by export, tables are imported concurrently
+    def restore(self, path: str) -> None:
+        started_at = time.time()
+        folder = tempfile.mkdtemp(prefix='bqckup-restore-', dir=self.tmp_path)
+        try:
+            with tarfile.open(path) as archive:
+                # Flat regular files only, the data filter (Python 3.12+, backported) refuses anything else
+                if hasattr(tarfile, 'data_filter'):
+                    archive.extractall(folder, filter='data')
+                else:
+                    archive.extractall(folder)
+            with open(os.path.join(folder, MANIFEST_NAME)) as f:
+                manifest = json.load(f)
+            codec = get_codec(manifest['codec'])
+            mysql = self._mysql_command()
+
+            # Schemas first in a single session with foreign key checks off (dumps made before
+            # the schema files had them need it too), then the data in parallel
+            schema = os.path.join(folder, 'schema.sql')
+            with open(schema, 'wb') as f:
+                f.write(b"SET FOREIGN_KEY_CHECKS=0;\n")
+                for table in manifest['tables']:
+                    with open(os.path.join(folder, table['schema']), 'rb') as part:
+                        shutil.copyfileobj(part, f)
+            self._load(f"{mysql} < {schema}", 'the table schemas')
+
+            with ThreadPoolExecutor(max_workers=self.threads) as pool:
+                futures = []
+                for table in sorted(manifest['tables'], key=lambda table: -table['size']):
+                    data = os.path.join(folder, table['data'])
+                    futures.append(pool.submit(self._load, f"{codec.decompress_command()} < {data} | {mysql}", table['table']))
+                for future in futures:
+                    future.result()
+
+            post = os.path.join(folder, manifest['post'])
+            self._load(f"{mysql} < {post}", 'views and triggers')
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+        print(f"Restored {len(manifest['tables'])} table(s) in {time.time() - started_at:.2f}s with {self.threads} thread(s)")
+
+# Counts what goes through to a non seekable output
+class _CountingWriter:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.written = 0
+
+    def write(self, data) -> int:
+        self.fileobj.write(data)
+        self.written += len(data)
+        return len(data)
@@ -0,0 +1,101 @@
+import os, threading
+from classes.yml_parser import Yml_Parser
+from constant import SITE_CONFIG_PATH
+
+"""
+    Process-wide cache of the site configs (sites/*.yml).
+    A file is parsed again only when its mtime or size changes and sites are
+    indexed by name, so listing or looking up a site doesn't re-read every yaml.
+"""
+class SiteRegistry:
+    # path => (mtime_ns, size, parsed bqckup section)
+    _files = {}
+    # site name => path
+    _names = {}
+    # mtime of the sites folder, changes when a file is added, removed or renamed
+    _folder_version = None
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _folder_mtime():
+        try:
+            return os.stat(SITE_CONFIG_PATH).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    # Parse path again if it changed, returns True when it did
+    @classmethod
+    def _load(cls, path: str, st: os.stat_result) -> bool:
+        cached = cls._files.get(path)
+        if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+            return False
+        try:
+            config = Yml_Parser.parse(path)['bqckup']
+        except Exception as e:
+            print(f"Skipped {os.path.basename(path)}, {e}")
+            config = None
+        cls._files[path] = (st.st_mtime_ns, st.st_size, config)
+        return True
+
+    @classmethod
+    def _index(cls) -> None:
+        cls._names = {
+            cached[2]['name']: path
+            for path, cached in sorted(cls._files.items())
+            if cached[2] and cached[2].get('name')
+        }
+
+    @classmethod
+    def _refresh(cls) -> None:
+        cls._folder_version = cls._folder_mtime()
+        try:
+            entries = [entry for entry in os.scandir(SITE_CONFIG_PATH) if entry.name.endswith('.yml') and entry.is_file()]
+        except FileNotFoundError:
+            entries = []
+
+        seen = set()
+        changed = False
+        for entry in entries:
+            seen.add(entry.path)
+            changed = cls._load(entry.path, entry.stat()) or changed
+
+        for path in set(cls._files) - seen:
+            del cls._files[path]
+            changed = True
+
+        if changed:
+            cls._index()
+
+    # [(file name, config)] in file name order, configs are copies the caller may change
+    @classmethod
+    def sites(cls) -> list:
+        with cls._lock:
+            cls._refresh()
+            return [
+                (os.path.basename(path), dict(cached[2]))
+                for path, cached in sorted(cls._files.items())
+                if cached[2]
+            ]
+
+    # (file name, config) of a site, only its own file is checked when the folder didn't change
+    @classmethod
+    def get(cls, name: str):
+        with cls._lock:
+            if cls._folder_mtime() != cls._folder_version:
+                cls._refresh()
+
+            path = cls._names.get(name)
+            if path:
+                try:
+                    if cls._load(path, os.stat(path)):
+                        cls._index()
+                except FileNotFoundError:
+                    cls._refresh()
+            # Not found, or renamed by an edit of its file
+            if not path or cls._names.get(name) != path:
+                cls._refresh()
+
+            path = cls._names.get(name)
+            if not path:
+                return None
+            return os.path.basename(path), dict(cls._files[path][2])
@@ -0,0 +1,144 @@
+import queue, threading, time
+
+# Chunks waiting for a target, a target this far behind makes the writer wait
+TARGET_BUFFERS = 8
+# Chunk size when a file is read to be replicated
+READ_SIZE = 8 * 1024 * 1024
+
+class ReplicationException(Exception): pass
+
+"""
+    Writable file-like copying everything written to it to several writers
+    (one upload stream per storage). Every target is fed by its own thread
+    through a bounded queue, the data is read once and the targets upload at
+    the same time, so the whole takes as long as the slowest one.
+    A failing target is aborted and dropped, the others go on. Writes only fail
+    once every target did. close() returns storage => error (None when it went through).
+"""
+class Tee:
+    def __init__(self, targets: dict, buffers: int = TARGET_BUFFERS):
+        # storage => writer (write, close, abort)
+        self.targets = targets
+        self.errors = {name: None for name in targets}
+        # storage => seconds until its writer was closed
+        self.elapsed = {}
+        self.bytes_written = 0
+        self._started_at = time.time()
+        self._closed = False
+        self._aborted = False
+        self._queues = {name: queue.Queue(maxsize=max(buffers, 1)) for name in targets}
+        self._threads = [threading.Thread(target=self._worker, args=(name,), daemon=True) for name in targets]
+        for thread in self._threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+    def _worker(self, name: str):
+        writer = self.targets[name]
+        while True:
+            data = self._queues[name].get()
+            if data is None:
+                break
+            if self.errors[name]:
+                # Keep draining, the writer must never wait on a dropped target
+                continue
+            try:
+                writer.write(data)
+            except Exception as e:
+                self._fail(name, e)
+
+        # Aborted uploads are not completed
+        if self.errors[name] or self._aborted:
+            return
+        try:
+            writer.close()
+        except Exception as e:
+            self.errors[name] = e
+        self.elapsed[name] = time.time() - self._started_at
+
+    def _fail(self, name: str, e: Exception):
+        self.errors[name] = e
+        print(f"Replication to {name} failed, {e}")
+        try:
+            self.targets[name].abort()
+        except Exception:
+            pass
+
+    def write(self, data) -> int:
+        if self._closed or self._aborted:
+            raise ReplicationException("Write on closed replication stream")
+        if all(self.errors.values()):
+            raise ReplicationException("Every storage failed, " + ", ".join(f"{name}: {e}" for name, e in self.errors.items()))
+        # One immutable copy shared by every target
+        data = bytes(data)
+        for name, pending in self._queues.items():
+            if not self.errors[name]:
+                pending.put(data)
+        self.bytes_written += len(data)
+        return len(data)
+
+    def _stop(self):
+        for pending in self._queues.values():
+            pending.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    # Completes every upload, raises when none went through
+    def close(self) -> dict:
+        if self._closed or self._aborted:
+            return self.errors
+        self._closed = True
+        self._stop()
+        if all(self.errors.values()):
+            raise ReplicationException("Every storage failed, " + ", ".join(f"{name}: {e}" for name, e in self.errors.items()))
+        return self.errors
+
+    def abort(self):
+        if self._closed or self._aborted:
+            return
+        self._aborted = True
+        self._stop()
+        for name, writer in self.targets.items():
+            if self.errors[name]:
+                continue
+            try:
+                writer.abort()
+            except Exception as e:
+                print(f"Failed to abort the upload to {name}, {e}")
+
+# Tee of an upload stream of key on every storage (name => s3), the storages that refuse it are failed from the start
+def open_tee(storages: dict, key: str) -> Tee:
+    writers, errors = {}, {}
+    for name, storage in storages.items():
+        try:
+            writers[name] = storage.upload_stream(key)
+        except Exception as e:
+            print(f"Replication to {name} failed, {e}")
+            errors[name] = e
+    if not writers:
+        raise ReplicationException("Every storage failed, " + ", ".join(f"{name}: {e}" for name, e in errors.items()))
+    tee = Tee(writers)
+    tee.errors.update(errors)
+    return tee
+
+# Uploads a file as key to every storage (name => s3) in a single read pass, returns (storage => error, storage => seconds)
+def replicate(path: str, storages: dict, key: str) -> tuple:
+    tee = open_tee(storages, key)
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(READ_SIZE)
+                if not chunk:
+                    break
+                tee.write(chunk)
+    except Exception:
+        tee.abort()
+        raise
+    return tee.close(), tee.elapsed
@@ -0,0 +1,380 @@
+import glob, json, os, stat, threading, time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from hashlib import sha256
+from typing import Union
+from peewee import chunked
+from classes.chunker import MIN_CHUNK_SIZE, chunk_file
+from classes.codec import Codec, Gzip, compress_block, decompress_block, open_decompressor
+from classes.compressor import ParallelCompressor
+from classes.config import Config
+from classes.lock import SiteLock
+from classes.manifest import walk
+from classes.restore import _inside
+from classes.tar import Tar
+from constant import BQ_PATH
+from models import database
+from models.chunk import Chunk
+from models.log import Log
+from models.run import Artifact
+
+# Chunks live under <root>/chunks/<first 2 chars of hash>/<hash>, shared by every site of a storage
+CHUNK_FOLDER = 'chunks'
+SNAPSHOT_VERSION = 1
+# In the name of every snapshot artifact, <time>.snapshot.json.<codec extension>
+SNAPSHOT_MARKER = '.snapshot.json.'
+
+class RepositoryException(Exception): pass
+
+"""
+    Deduplicating backup format. Files are split into content-defined chunks,
+    each chunk is stored once per storage under its sha256 and a run only uploads
+    chunks the storage doesn't hold yet. The run itself is a snapshot (json)
+    listing every entry and its chunks, it is written like a regular archive.
+    Chunks no snapshot lists anymore are deleted by collect once the retention ran.
+"""
+class Repository:
+    def __init__(self, name: str, storage=None, destination: str = None, codec: Codec = None, workers: int = None):
+        if not storage and not destination:
+            raise RepositoryException("Dedup format needs an s3 storage or a local destination")
+
+        config = Config()
+        self.name = name
+        self._s3 = storage
+        self.destination = destination
+        self.codec = codec or Gzip()
+        self.workers = config.read_int('compression', 'workers', 1) if workers is None else workers
+        if self.workers <= 0:
+            self.workers = os.cpu_count() or 1
+        self.upload_concurrency = storage.tuner.get_concurrency() if storage else 4
+        self.storage_key = storage.storage_name if storage else f"local:{destination}"
+        # Chunk lists of the previous run, only valid for the storage they were uploaded to
+        storage_hash = sha256(self.storage_key.encode()).hexdigest()[:8]
+        self.cache_path = os.path.join(BQ_PATH, 'cache', f"{name}.{storage_hash}.json")
+        self.cache_pattern = os.path.join(BQ_PATH, 'cache', f"*.{storage_hash}.json")
+        # Held shared by every compress on the storage, exclusive by collect
+        self.chunks_lock = SiteLock(os.path.join(BQ_PATH, 'cache'), f"{storage_hash}.chunks")
+        self.stats = {}
+
+    def _chunk_key(self, chunk_hash: str) -> str:
+        return f"{CHUNK_FOLDER}/{chunk_hash[:2]}/{chunk_hash}"
+
+    def _exists(self, chunk_hash: str) -> bool:
+        key = self._chunk_key(chunk_hash)
+        if not self._s3:
+            return os.path.exists(os.path.join(self.destination, key))
+        try:
+            self._s3.client.head_object(Bucket=self._s3.bucket_name, Key=os.path.join(self._s3.root_folder_name, key))
+        except Exception:
+            return False
+        return True
+
+    def _put(self, chunk_hash: str, data: bytes) -> None:
+        key = self._chunk_key(chunk_hash)
+        if self._s3:
+            key = os.path.join(self._s3.root_folder_name, key)
+            response = self._s3.client.put_object(Bucket=self._s3.bucket_name, Key=key, Body=data)
+            self._s3.catalog.record(key, len(data), response.get('ETag'))
+            return
+
+        path = os.path.join(self.destination, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so a crash never leaves a truncated chunk behind
+        with open(f"{path}.tmp", 'wb') as f:
+            f.write(data)
+        os.replace(f"{path}.tmp", path)
+
+    def _store(self, path: str, offset: int, length: int, chunk_hash: str, verify: bool) -> int:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        if sha256(data).hexdigest() != chunk_hash:
+            raise RepositoryException(f"{path} changed during backup")
+        if verify and self._exists(chunk_hash):
+            return 0
+
+        data = compress_block(self.codec.name, data, self.codec.level)
+        self._put(chunk_hash, data)
+        return len(data)
+
+    def _get(self, chunk_hash: str) -> bytes:
+        key = self._chunk_key(chunk_hash)
+        if self._s3:
+            return self._s3.client.get_object(Bucket=self._s3.bucket_name, Key=os.path.join(self._s3.root_folder_name, key))['Body'].read()
+        with open(os.path.join(self.destination, key), 'rb') as f:
+            return f.read()
+
+    def _load_cache(self) -> dict:
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_cache(self, cache: dict) -> None:
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        with open(f"{self.cache_path}.tmp", 'w') as f:
+            json.dump(cache, f)
+        os.replace(f"{self.cache_path}.tmp", self.cache_path)
+
+    def _entries(self, source: Union[str, list, dict]) -> list:
+        sources = [source] if type(source) == str else list(source)
+        entries = []
+        for root in sources:
+            if not os.path.exists(root):
+                print(f"Skipped, {root} not found")
+                continue
+            for path, st in walk(root):
+                entry = {"path": Tar.arcname(sources, path), "mode": st.st_mode, "mtime": st.st_mtime_ns, "size": 0}
+                if stat.S_ISREG(st.st_mode):
+                    entry.update(type="file", size=st.st_size, source=path, inode=st.st_ino)
+                elif stat.S_ISDIR(st.st_mode):
+                    entry["type"] = "dir"
+                elif stat.S_ISLNK(st.st_mode):
+                    entry.update(type="symlink", link=os.readlink(path))
+                else:
+                    continue
+                entries.append(entry)
+        return entries
+
+    def _chunk(self, files: list) -> dict:
+        results = {}
+        small = [entry for entry in files if entry["size"] <= MIN_CHUNK_SIZE]
+        large = [entry for entry in files if entry["size"] > MIN_CHUNK_SIZE]
+
+        # Small files are a single chunk, hashing them here is cheaper than a round trip to the pool
+        for entry in small:
+            with open(entry["source"], 'rb') as f:
+                data = f.read()
+            results[entry["source"]] = [(0, len(data), sha256(data).hexdigest())] if data else []
+
+        if large and self.workers > 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                paths = [entry["source"] for entry in large]
+                for path, chunks in zip(paths, pool.map(chunk_file, paths, chunksize=4)):
+                    results[path] = chunks
+        else:
+            for entry in large:
+                results[entry["source"]] = chunk_file(entry["source"])
+        return results
+
+    # Same interface as Tar.compress, output receives the snapshot
+    def compress(self, source: Union[str, list, dict], output, only: set = None, deleted: set = None) -> str:
+        # Chunks known to the index are not collected until the snapshot using them is cached
+        self.chunks_lock.acquire(shared=True, wait=True)
+        try:
+            return self._compress(source, output)
+        finally:
+            self.chunks_lock.release()
+
+    def _compress(self, source: Union[str, list, dict], output) -> str:
+        started_at = time.time()
+        entries = self._entries(source)
+        files = [entry for entry in entries if entry["type"] == "file"]
+        cache = self._load_cache()
+        known = set(chunk.hash for chunk in Chunk.select(Chunk.hash).where(Chunk.storage == self.storage_key))
+        # An empty index (new host or lost database) means checking the storage before uploading
+        verify = not known
+
+        # Unchanged files (same size, mtime and inode) reuse the chunk list of the previous run,
+        # unless one of its chunks was collected since
+        to_chunk = []
+        for entry in files:
+            cached = cache.get(entry["source"])
+            if cached and cached["key"] == [entry["size"], entry["mtime"], entry["inode"]] and all(chunk_hash in known for chunk_hash, _ in cached["chunks"]):
+                entry["chunks"] = cached["chunks"]
+            else:
+                to_chunk.append(entry)
+
+        chunked_files = self._chunk(to_chunk)
+
+        new_chunks = {}
+        for entry in to_chunk:
+            chunks = chunked_files[entry["source"]]
+            entry["chunks"] = [[chunk_hash, length] for _, length, chunk_hash in chunks]
+            for offset, length, chunk_hash in chunks:
+                if chunk_hash not in known and chunk_hash not in new_chunks:
+                    new_chunks[chunk_hash] = (entry["source"], offset, length)
+
+        stored = {}
+        with ThreadPoolExecutor(max_workers=self.upload_concurrency) as pool:
+            futures = {chunk_hash: pool.submit(self._store, *location, chunk_hash, verify) for chunk_hash, location in new_chunks.items()}
+            for chunk_hash, future in futures.items():
+                stored[chunk_hash] = future.result()
+
+        now = int(time.time())
+        with database.atomic():
+            rows = [
+                {"storage": self.storage_key, "hash": chunk_hash, "size": new_chunks[chunk_hash][2], "stored_size": size, "created_at": now}
+                for chunk_hash, size in stored.items()
+            ]
+            for batch in chunked(rows, 100):
+                Chunk.insert_many(batch).on_conflict_ignore().execute()
+
+        snapshot = {
+            "version": SNAPSHOT_VERSION,
+            "name": self.name,
+            "created_at": now,
+            "codec": self.codec.name,
+            "chunk_folder": CHUNK_FOLDER,
+            "entries": [{k: v for k, v in entry.items() if k not in ("source", "inode")} for entry in entries],
+        }
+        content = json.dumps(snapshot).encode()
+
+        if isinstance(output, str):
+            with open(output, 'wb') as f, ParallelCompressor(f, 1, codec=self.codec) as writer:
+                writer.write(content)
+        else:
+            with ParallelCompressor(output, 1, codec=self.codec) as writer:
+                writer.write(content)
+
+        self._save_cache({
+            entry["source"]: {"key": [entry["size"], entry["mtime"], entry["inode"]], "chunks": entry["chunks"]}
+            for entry in files
+        })
+
+        raw_size = sum(entry["size"] for entry in files)
+        elapsed = max(time.time() - started_at, 0.001)
+        self.stats = {
+            "raw_size": raw_size,
+            "compressed_size": writer.bytes_out,
+            "elapsed": elapsed,
+            "throughput": raw_size / elapsed / (1024 * 1024),
+            "workers": self.workers,
+            "codec": self.codec.name,
+            "new_chunks": len(stored),
+            "new_bytes": sum(stored.values()),
+        }
+        print(f"Deduplicated {raw_size / (1024 * 1024):.2f} MB in {elapsed:.2f}s, {len(stored)} new chunk(s), {self.stats['new_bytes'] / (1024 * 1024):.2f} MB stored ({self.stats['throughput']:.2f} MB/s)")
+        return output
+
+    def _read_snapshot(self, key: str, compression: str) -> dict:
+        source = self._s3.open_stream(key) if self._s3 else open(os.path.join(self.destination, key), 'rb')
+        with source, open_decompressor(compression or self.codec.name, source) as reader:
+            return json.loads(reader.read())
+
+    # Chunk keys deleted from the storage, returns the ones that could not be
+    def _delete(self, keys: list, concurrency: int) -> list:
+        if self._s3:
+            return self._s3.delete_many(keys, concurrency)
+        failed = []
+        for key in keys:
+            try:
+                os.unlink(os.path.join(self.destination, key))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Failed to delete {key}, {e}")
+                failed.append(key)
+        return failed
+
+    # Mark and sweep of the chunks of the storage, shared by every site: the indexed chunks neither a delivered
+    # snapshot nor the chunk cache of a site (a snapshot not delivered yet) lists are deleted with their index rows.
+    # Skipped while a backup compresses to the storage, returns (chunks, bytes) deleted
+    def collect(self, concurrency: int = 8) -> tuple:
+        if not self.chunks_lock.acquire():
+            print(f"Chunks of {self.storage_key} are in use, they are collected by the next retention")
+            return 0, 0
+        try:
+            referenced = set()
+            snapshots = Artifact.select(Artifact.key, Artifact.compression).where(
+                (Artifact.storage == self.storage_key) & (Artifact.status == Log.__SUCCESS__) & Artifact.key.contains(SNAPSHOT_MARKER)
+            )
+            # A snapshot that can't be read stops the sweep, its chunks would be deleted
+            for key, compression in snapshots.tuples():
+                for entry in self._read_snapshot(key, compression)["entries"]:
+                    referenced.update(chunk_hash for chunk_hash, _ in entry.get("chunks", []))
+            for path in glob.glob(self.cache_pattern):
+                with open(path) as f:
+                    for cached in json.load(f).values():
+                        referenced.update(chunk_hash for chunk_hash, _ in cached["chunks"])
+
+            garbage = {
+                self._chunk_key(chunk_hash): (chunk_hash, stored_size)
+                for chunk_hash, stored_size in Chunk.select(Chunk.hash, Chunk.stored_size).where(Chunk.storage == self.storage_key).tuples()
+                if chunk_hash not in referenced
+            }
+            if not garbage:
+                return 0, 0
+            failed = set(self._delete(list(garbage), concurrency))
+            deleted = [garbage[key] for key in garbage if key not in failed]
+            with database.atomic():
+                for batch in chunked([chunk_hash for chunk_hash, _ in deleted], 100):
+                    Chunk.delete().where((Chunk.storage == self.storage_key) & Chunk.hash.in_(batch)).execute()
+            return len(deleted), sum(stored_size for _, stored_size in deleted)
+        finally:
+            self.chunks_lock.release()
+
+    # Writes the entries of a snapshot to folder, chunks are fetched concurrently and written in place
+    # stats is a RestoreStats (classes/restore.py), returns the number of files restored
+    def restore(self, snapshot: dict, folder: str, stats) -> int:
+        codec = snapshot.get("codec") or self.codec.name
+        entries = snapshot["entries"]
+        # Thread seconds spent per stage
+        spent = {"download": 0.0, "decompress": 0.0, "extract": 0.0}
+        sizes = {"download": 0, "decompress": 0}
+        lock = threading.Lock()
+
+        def restore_chunk(path: str, offset: int, chunk_hash: str) -> None:
+            started_at = time.time()
+            data = self._get(chunk_hash)
+            downloaded_at = time.time()
+            size = len(data)
+            data = decompress_block(codec, data)
+            if sha256(data).hexdigest() != chunk_hash:
+                raise RepositoryException(f"Chunk {chunk_hash} of {path} is corrupted")
+            decompressed_at = time.time()
+            with open(path, 'r+b') as f:
+                f.seek(offset)
+                f.write(data)
+            with lock:
+                spent["download"] += downloaded_at - started_at
+                spent["decompress"] += decompressed_at - downloaded_at
+                spent["extract"] += time.time() - decompressed_at
+                sizes["download"] += size
+                sizes["decompress"] += len(data)
+
+        started_at = time.time()
+        jobs = []
+        for entry in entries:
+            # An absolute or ../ path, or one through a symlink, would be written outside of folder
+            if not _inside(folder, entry["path"]):
+                print(f"Skipped {entry['path']}, outside of {folder}")
+                continue
+            path = os.path.join(folder, entry["path"])
+            if entry["type"] == "dir":
+                os.makedirs(path, exist_ok=True)
+            elif entry["type"] == "file":
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.truncate(entry["size"])
+                offset = 0
+                for chunk_hash, length in entry["chunks"]:
+                    jobs.append((path, offset, chunk_hash))
+                    offset += length
+
+        with ThreadPoolExecutor(max_workers=self.upload_concurrency) as pool:
+            for future in [pool.submit(restore_chunk, *job) for job in jobs]:
+                future.result()
+
+        # Links, then modes and times, folders last as writing in them changes their mtime
+        for entry in entries:
+            if entry["type"] != "symlink" or not _inside(folder, entry["path"]):
+                continue
+            path = os.path.join(folder, entry["path"])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.lexists(path):
+                os.unlink(path)
+            os.symlink(entry["link"], path)
+        for entry in sorted(entries, key=lambda entry: entry["type"] == "dir"):
+            # A symlink restored above can now lead a path out of folder
+            if entry["type"] == "symlink" or not _inside(folder, entry["path"]):
+                continue
+            path = os.path.join(folder, entry["path"])
+            os.chmod(path, stat.S_IMODE(entry["mode"]))
+            os.utime(path, ns=(entry["mtime"], entry["mtime"]))
+
+        elapsed = time.time() - started_at
+        stats.add('download', sizes["download"], min(spent["download"] / self.upload_concurrency, elapsed))
+        stats.add('decompress', sizes["decompress"], spent["decompress"] / self.upload_concurrency)
+        stats.add('extract', sizes["decompress"], spent["extract"] / self.upload_concurrency)
+        return sum(1 for entry in entries if entry["type"] == "file")
@@ -0,0 +1,188 @@
+import os, queue, shutil, tarfile, threading, time
+from classes.codec import open_decompressor
+from classes.tar import DELETED_MEMBER
+
+# Decompressed bytes handed to the extraction at a time
+CHUNK_SIZE = 1024 * 1024
+# Chunks waiting between the decompression and the extraction
+PIPE_CHUNKS = 16
+
+class RestoreException(Exception): pass
+
+# Whether name lands inside folder, through the symlinks already extracted (a symlink member itself may point anywhere)
+def _inside(folder: str, name: str) -> bool:
+    root = os.path.realpath(folder)
+    parent = os.path.realpath(os.path.join(folder, os.path.dirname(name)))
+    target = os.path.normpath(os.path.join(parent, os.path.basename(name)))
+    return os.path.commonpath([target, root]) == root
+
+# Counts what is read from a stream and the time spent waiting for it
+class _TimedReader:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.bytes_read = 0
+        self.seconds = 0.0
+
+    def read(self, size: int = -1) -> bytes:
+        started_at = time.time()
+        data = self.fileobj.read(size)
+        self.seconds += time.time() - started_at
+        self.bytes_read += len(data)
+        return data
+
+    def readable(self) -> bool:
+        return True
+
+"""
+    Decompresses a stream in its own thread, the extraction reads the result
+    through a bounded queue, so download, decompression and extraction overlap.
+"""
+class _DecompressPipe:
+    def __init__(self, source, codec_name: str):
+        self._source = _TimedReader(source)
+        self._codec_name = codec_name
+        self._queue = queue.Queue(maxsize=PIPE_CHUNKS)
+        self._chunk = b""
+        self._offset = 0
+        self._done = False
+        self._stopped = False
+        self._error = None
+        self.bytes_out = 0
+        # Time spent decompressing, waiting for the source excluded
+        self.seconds = 0.0
+        # Time the extraction spent waiting for decompressed data
+        self.waited = 0.0
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    @property
+    def bytes_in(self) -> int:
+        return self._source.bytes_read
+
+    # Time spent waiting for the source
+    @property
+    def source_seconds(self) -> float:
+        return self._source.seconds
+
+    def _worker(self):
+        started_at = time.time()
+        blocked = 0.0
+        try:
+            with open_decompressor(self._codec_name, self._source) as reader:
+                while not self._stopped:
+                    chunk = reader.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    put_at = time.time()
+                    self._queue.put(chunk)
+                    blocked += time.time() - put_at
+        except Exception as e:
+            self._error = e
+        finally:
+            self.seconds = time.time() - started_at - blocked - self._source.seconds
+            self._queue.put(None)
+
+    def read(self, size: int = -1) -> bytes:
+        chunks = []
+        while size != 0:
+            if self._offset >= len(self._chunk):
+                if self._done:
+                    break
+                waiting_since = time.time()
+                chunk = self._queue.get()
+                self.waited += time.time() - waiting_since
+                if chunk is None:
+                    self._done = True
+                    if self._error:
+                        raise RestoreException(f"Failed to decompress, {self._error}")
+                    continue
+                self._chunk, self._offset = chunk, 0
+                continue
+            take = len(self._chunk) - self._offset if size < 0 else min(size, len(self._chunk) - self._offset)
+            chunks.append(self._chunk[self._offset:self._offset + take])
+            self._offset += take
+            self.bytes_out += take
+            if size > 0:
+                size -= take
+        return b"".join(chunks)
+
+    def readable(self) -> bool:
+        return True
+
+    def close(self):
+        self._stopped = True
+        # Unblock the worker if it waits on a full queue
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self._thread.join()
+
+# Throughput of every restore stage, stage => [bytes, seconds]
+class RestoreStats:
+    def __init__(self):
+        self.stages = {}
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, size: int, seconds: float) -> None:
+        with self._lock:
+            current = self.stages.setdefault(stage, [0, 0.0])
+            current[0] += size
+            current[1] += max(seconds, 0.0)
+
+    def report(self) -> None:
+        elapsed = time.time() - self.started_at
+        for stage, (size, seconds) in self.stages.items():
+            throughput = size / max(seconds, 0.001) / (1024 * 1024)
+            print(f"  {stage:<12} {size / (1024 * 1024):10.2f} MB {seconds:8.2f}s {throughput:10.2f} MB/s")
+        print(f"  {'total':<12} {'':>13} {elapsed:8.2f}s")
+
+    def as_dict(self) -> dict:
+        return {stage: {"bytes": size, "seconds": round(seconds, 3)} for stage, (size, seconds) in self.stages.items()}
+
+"""
+    Extracts a files archive from a readable stream (a RangedReader on S3,
+    a local file otherwise) into folder without writing the archive anywhere.
+    The deleted list of an incremental archive is applied once its members are
+    extracted. Members resolving outside of folder are skipped, like restore-file
+    does, and the tar filter is applied where tarfile has one ('data' would refuse
+    the absolute symlinks sites often hold). source is closed when done.
+"""
+def extract_stream(source, codec_name: str, folder: str, stats: RestoreStats) -> int:
+    started_at = time.time()
+    pipe = _DecompressPipe(source, codec_name)
+    extracted = 0
+    deleted = []
+    try:
+        with tarfile.open(fileobj=pipe, mode='r|') as archive:
+            for member in archive:
+                if member.name == DELETED_MEMBER:
+                    deleted = [name for name in archive.extractfile(member).read().decode().split("\n") if name]
+                    continue
+                if not _inside(folder, member.name):
+                    print(f"Skipped {member.name}, outside of {folder}")
+                    continue
+                if hasattr(tarfile, 'tar_filter'):
+                    archive.extract(member, folder, filter='tar')
+                else:
+                    archive.extract(member, folder)
+                extracted += 1
+    finally:
+        pipe.close()
+        source.close()
+
+    for name in deleted:
+        if not _inside(folder, name):
+            continue
+        path = os.path.join(folder, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.lexists(path):
+            os.unlink(path)
+
+    stats.add('download', pipe.bytes_in, getattr(source, 'elapsed', pipe.source_seconds))
+    stats.add('decompress', pipe.bytes_out, pipe.seconds)
+    stats.add('extract', pipe.bytes_out, time.time() - started_at - pipe.waited)
+    return extracted
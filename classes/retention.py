@@ -0,0 +1,338 @@
+import bisect, os, time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from classes.config import Config
+from classes.repository import Repository, SNAPSHOT_MARKER
+from models import database
+from models.log import Log
+from models.run import Run, Artifact
+from models.binlog import BinlogChain, BinlogSegment
+
+# From the hottest to the coldest, a run kept by several tiers belongs to the first one
+TIERS = ('last', 'daily', 'weekly', 'monthly', 'yearly')
+# Period a run belongs to for each tier, from its start in local time
+PERIODS = {
+    'daily': lambda moment: (moment.year, moment.month, moment.day),
+    'weekly': lambda moment: tuple(moment.isocalendar())[:2],
+    'monthly': lambda moment: (moment.year, moment.month),
+    'yearly': lambda moment: moment.year,
+}
+# S3 storage classes from the hottest to the coldest, objects only ever move to a colder one.
+# Only classes read right away: restores use plain and ranged GETs, never restore_object
+STORAGE_CLASSES = ('STANDARD', 'INTELLIGENT_TIERING', 'STANDARD_IA', 'ONEZONE_IA', 'GLACIER_IR')
+# Archive classes, their objects have to be thawed before a GET
+ARCHIVE_CLASSES = ('GLACIER', 'DEEP_ARCHIVE')
+
+class RetentionException(Exception): pass
+
+"""
+    Retention policy of a site. options.retention is either a number of runs
+    (the last ones) or tiers, e.g. {daily: 7, weekly: 4, monthly: 12}: a tier
+    keeps the newest run of each of its last N periods (days, ISO weeks,
+    months, years) holding one, `last` keeps the last N runs.
+    A tier can be a mapping {keep: N, storage_class: GLACIER_IR}, the runs it
+    keeps are then moved to that storage class on S3.
+"""
+class Policy:
+    def __init__(self, value):
+        # tier => runs or periods kept
+        self.tiers = {}
+        # tier => S3 storage class of the runs it keeps
+        self.storage_classes = {}
+
+        if not isinstance(value, dict):
+            value = {'last': value}
+        for tier, setting in value.items():
+            if tier not in TIERS:
+                raise RetentionException(f"Unknown retention tier {tier}, use {', '.join(TIERS)}")
+            if isinstance(setting, dict):
+                storage_class = setting.get('storage_class')
+                if storage_class:
+                    storage_class = str(storage_class).upper()
+                    if storage_class in ARCHIVE_CLASSES:
+                        raise RetentionException(f"{storage_class} objects can't be restored without thawing them first, use GLACIER_IR for the {tier} retention")
+                    if storage_class not in STORAGE_CLASSES:
+                        raise RetentionException(f"Unknown storage class {storage_class} for the {tier} retention, use {', '.join(STORAGE_CLASSES)}")
+                    self.storage_classes[tier] = storage_class
+                setting = setting.get('keep')
+            if not str(setting).isdigit():
+                raise RetentionException(f"Retention {tier} should be a number, got {setting}")
+            if int(setting) > 0:
+                self.tiers[tier] = int(setting)
+
+    # Runs kept among runs [(id, started_at)] newest first, run id => tier
+    def select(self, runs: list) -> dict:
+        kept = {}
+        for tier in TIERS:
+            count = self.tiers.get(tier)
+            if not count:
+                continue
+            if tier == 'last':
+                for run_id, _ in runs[:count]:
+                    kept.setdefault(run_id, tier)
+                continue
+
+            periods = set()
+            for run_id, started_at in runs:
+                period = PERIODS[tier](datetime.fromtimestamp(started_at))
+                if period in periods:
+                    continue
+                if len(periods) == count:
+                    break
+                periods.add(period)
+                kept.setdefault(run_id, tier)
+        return kept
+
+"""
+    Works out what a site keeps and deletes from the run catalog (runs, logs
+    and artifacts tables), the storages are never listed.
+    Runs kept by the policy are kept along with everything a restore of them
+    needs: the full archive their incrementals start from, the last real
+    archive or dump of a run skipped as unchanged and the full dump and
+    binary log bundles of a binlog chain. Binary log captures don't count as runs.
+    Expired artifacts are deleted with delete_objects batches sent concurrently
+    on S3 and removed by a thread pool on local destinations. Kept S3 artifacts
+    move to the storage class of their tier with a server-side copy.
+    Deleting a dedup snapshot collects the chunks no other snapshot lists.
+"""
+class Retention:
+    def __init__(self, name: str, policy):
+        self.name = name
+        self.policy = policy if isinstance(policy, Policy) else Policy(policy)
+        config = Config()
+        self.concurrency = max(config.read_int('retention', 'concurrency', 8), 1)
+
+    # Logs a restore of the state at last_log_id reads, logs sorted by id
+    @staticmethod
+    def _chain(logs: list, ids: list, last_log_id: int) -> list:
+        needed = []
+        position = bisect.bisect_right(ids, last_log_id) - 1
+        while position >= 0:
+            log = logs[position]
+            needed.append(log.id)
+            if log.mode != Log.__INCREMENTAL__:
+                break
+            position -= 1
+        return needed
+
+    # Kept runs (run id => tier) and the logs they need (log id => tier of the hottest run needing it)
+    def _keep(self) -> tuple:
+        logs_by_run = defaultdict(list)
+        files_logs, database_logs = [], []
+        # Plain tuples, building models for every row would cost more than the whole plan
+        for log in Log.select(Log.id, Log.run_id, Log.type, Log.mode, Log.status).where(Log.name == self.name).order_by(Log.id).namedtuples():
+            logs_by_run[log.run_id].append(log)
+            if log.status != Log.__SUCCESS__:
+                continue
+            (files_logs if log.type == Log.__FILES__ else database_logs).append(log)
+        files_ids = [log.id for log in files_logs]
+        database_ids = [log.id for log in database_logs]
+
+        # Capture log => (chain, full dump log), segments log ids per chain
+        captures = {}
+        chain_logs = defaultdict(list)
+        segments = BinlogSegment.select(BinlogSegment.log_id, BinlogChain.id, BinlogChain.log_id).join(BinlogChain).where(BinlogChain.name == self.name)
+        for log_id, chain_id, dump_log_id in segments.tuples():
+            captures[log_id] = (chain_id, dump_log_id)
+            chain_logs[chain_id].append(log_id)
+
+        runs = []
+        last_log_ids = {}
+        for run_id, started_at in Run.select(Run.id, Run.started_at).where((Run.name == self.name) & (Run.status == Run.__SUCCESS__)).order_by(Run.id.desc()).tuples():
+            logs = logs_by_run.get(run_id)
+            if not logs or all(log.id in captures for log in logs):
+                continue
+            runs.append((run_id, started_at))
+            last_log_ids[run_id] = max(log.id for log in logs)
+
+        # Until the last N runs exist nothing expires, as with a plain count
+        if len(runs) < self.policy.tiers.get('last', 0):
+            return {}, {}
+        kept = self.policy.select(runs)
+
+        needed = {}
+        for run_id, tier in sorted(kept.items(), key=lambda item: TIERS.index(item[1])):
+            last_log_id = last_log_ids[run_id]
+            log_ids = self._chain(files_logs, files_ids, last_log_id)
+            position = bisect.bisect_right(database_ids, last_log_id) - 1
+            if position >= 0:
+                database_log_id = database_ids[position]
+                log_ids.append(database_log_id)
+                if database_log_id in captures:
+                    chain_id, dump_log_id = captures[database_log_id]
+                    log_ids.append(dump_log_id)
+                    log_ids.extend(log_id for log_id in chain_logs[chain_id] if log_id <= database_log_id)
+            for log_id in log_ids:
+                needed.setdefault(log_id, tier)
+        return kept, needed
+
+    # Condition matching the expired artifacts, None when nothing expires
+    def _expired(self, kept: dict, needed: dict):
+        if not kept:
+            return None
+        # Runs between the kept ones go too, newer ones are running or were just added
+        boundary = max(kept)
+        last = [run_id for run_id, tier in kept.items() if tier == 'last']
+        if last:
+            # The last N runs are kept whole, failed ones included
+            boundary = min(last)
+        expired_runs = Run.select(Run.id).where((Run.name == self.name) & (Run.id < boundary) & Run.id.not_in(list(kept)))
+        # needed is small (the kept runs and their chains), the expired set is not, it stays a condition
+        return (
+            Artifact.run.in_(expired_runs) &
+            (Artifact.status == Log.__SUCCESS__) &
+            (Artifact.log_id.is_null() | Artifact.log_id.not_in(list(needed)))
+        )
+
+    # Kept S3 artifacts to move to a colder storage class, [(artifact, storage class)]
+    def _promotions(self, needed: dict) -> list:
+        wanted = {}
+        for log_id, tier in needed.items():
+            if self.policy.storage_classes.get(tier):
+                wanted[log_id] = self.policy.storage_classes[tier]
+        if not wanted:
+            return []
+
+        promotions = []
+        artifacts = Artifact.select(Artifact.id, Artifact.log_id, Artifact.type, Artifact.storage, Artifact.key, Artifact.storage_class).where(
+            Artifact.log_id.in_(list(wanted)) & (Artifact.status == Log.__SUCCESS__)
+        )
+        for artifact in artifacts.namedtuples():
+            # Indexes are small and read first by restore-file, they stay hot
+            if artifact.storage.startswith('local:') or artifact.type == Artifact.__INDEX__:
+                continue
+            current = STORAGE_CLASSES.index(artifact.storage_class) if artifact.storage_class in STORAGE_CLASSES else 0
+            if STORAGE_CLASSES.index(wanted[artifact.log_id]) > current:
+                promotions.append((artifact, wanted[artifact.log_id]))
+        return promotions
+
+    # Artifacts (id, log_id, storage, key, size) that can be deleted
+    def plan(self) -> list:
+        condition = self._expired(*self._keep())
+        if condition is None:
+            return []
+        artifacts = Artifact.select(Artifact.id, Artifact.log_id, Artifact.storage, Artifact.key, Artifact.size).where(condition)
+        return list(artifacts.namedtuples())
+
+    def _delete_local(self, destination: str, keys: list) -> list:
+        def remove(key: str):
+            try:
+                os.unlink(os.path.join(destination, key))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Failed to delete {key}, {e}")
+                return key
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            failed = [key for key in pool.map(remove, keys) if key]
+
+        # Date folders left empty
+        for folder in sorted({os.path.dirname(os.path.join(destination, key)) for key in keys}, reverse=True):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                pass
+        return failed
+
+    # Server-side copies to the new storage classes, returns how many went through
+    def _promote(self, promotions: list) -> int:
+        from classes.s3 import s3
+        storages = {}
+
+        def promote(promotion: tuple) -> bool:
+            artifact, storage_class = promotion
+            try:
+                storage = storages.get(artifact.storage) or storages.setdefault(artifact.storage, s3(artifact.storage))
+                storage.set_storage_class(artifact.key, storage_class)
+            except Exception as e:
+                print(f"Failed to move {artifact.key} to {storage_class}, {e}")
+                return False
+            Artifact.update(storage_class=storage_class).where(Artifact.id == artifact.id).execute()
+            return True
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            return sum(pool.map(promote, promotions))
+
+    # Deletes the expired artifacts and moves the kept ones to their storage class (nothing when dry_run)
+    # returns {"kept": {tier: runs}, "artifacts", "chunks", "bytes", "failed", "promoted", "elapsed"}
+    def apply(self, dry_run: bool = False) -> dict:
+        started_at = time.time()
+        kept, needed = self._keep()
+        condition = self._expired(kept, needed)
+        expired = list(Artifact.select(Artifact.id, Artifact.log_id, Artifact.storage, Artifact.key, Artifact.size).where(condition).namedtuples()) if condition is not None else []
+        promotions = self._promotions(needed)
+        tiers = {tier: list(kept.values()).count(tier) for tier in self.policy.tiers}
+        if dry_run:
+            size = sum(artifact.size or 0 for artifact in expired)
+            return {"kept": tiers, "artifacts": len(expired), "chunks": 0, "bytes": size, "failed": 0, "promoted": len(promotions), "elapsed": time.time() - started_at}
+
+        by_storage = defaultdict(list)
+        for artifact in expired:
+            by_storage[artifact.storage].append(artifact)
+
+        deleted, failed = [], []
+        for storage, artifacts in by_storage.items():
+            keys = [artifact.key for artifact in artifacts]
+            try:
+                if storage.startswith('local:'):
+                    failed_keys = set(self._delete_local(storage[len('local:'):], keys))
+                else:
+                    from classes.s3 import s3
+                    failed_keys = set(s3(storage).delete_many(keys, self.concurrency))
+            except Exception as e:
+                print(f"Failed to delete the expired backups of {self.name} on {storage}, {e}")
+                failed.extend(artifact.id for artifact in artifacts)
+                continue
+            for artifact in artifacts:
+                (failed.append(artifact.id) if artifact.key in failed_keys else deleted.append(artifact))
+
+        if expired:
+            self._forget(condition, failed)
+        chunks, chunks_size = self._collect({artifact.storage for artifact in deleted if SNAPSHOT_MARKER in artifact.key})
+        promoted = self._promote(promotions) if promotions else 0
+
+        elapsed = time.time() - started_at
+        size = sum(artifact.size or 0 for artifact in deleted) + chunks_size
+        if expired or promoted:
+            print(
+                f"Retention of {self.name}: {len(deleted)} expired backup(s)" + (f" and {chunks} chunk(s)" if chunks else "")
+                + f", {size / (1024 * 1024):.2f} MB deleted"
+                + (f", {promoted} moved to a colder storage class" if promoted else "")
+                + f" in {elapsed:.2f}s" + (f", {len(failed)} failed" if failed else "")
+            )
+        return {"kept": tiers, "artifacts": len(deleted), "chunks": chunks, "bytes": size, "failed": len(failed), "promoted": promoted, "elapsed": elapsed}
+
+    # Unused dedup chunks of the storages snapshots were deleted from, returns (chunks, bytes) deleted
+    def _collect(self, storages: set) -> tuple:
+        chunks = size = 0
+        for storage in storages:
+            try:
+                if storage.startswith('local:'):
+                    repository = Repository(self.name, destination=storage[len('local:'):])
+                else:
+                    from classes.s3 import s3
+                    repository = Repository(self.name, s3(storage))
+                collected, collected_size = repository.collect(self.concurrency)
+            except Exception as e:
+                print(f"Failed to collect the unused chunks of {storage}, {e}")
+                continue
+            chunks += collected
+            size += collected_size
+        return chunks, size
+
+    # Marks the expired artifacts deleted (but the failed ones), drops the binlog chains and segments left without a bundle
+    def _forget(self, condition, failed: list) -> None:
+        if failed:
+            condition &= Artifact.id.not_in(failed)
+        with database.atomic():
+            Artifact.update(status=Artifact.__DELETED__).where(condition).execute()
+
+            delivered = Artifact.select(Artifact.log_id).where((Artifact.status == Log.__SUCCESS__) & Artifact.log_id.is_null(False))
+            chains = BinlogChain.select(BinlogChain.id).where(BinlogChain.name == self.name)
+            BinlogSegment.delete().where(BinlogSegment.chain.in_(chains) & BinlogSegment.log_id.not_in(delivered)).execute()
+            gone = [chain_id for chain_id, in chains.where(BinlogChain.log_id.not_in(delivered)).tuples()]
+            if gone:
+                BinlogSegment.delete().where(BinlogSegment.chain.in_(gone)).execute()
+                BinlogChain.delete().where(BinlogChain.id.in_(gone)).execute()
@@ -0,0 +1,89 @@
+import threading, time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from classes.config import Config
+from models.run import Run
+
+# Number of past runs averaged to estimate how long a site takes
+HISTORY = 5
+
+# Limits used when do_backup runs on its own, nothing to share
+class Unlimited:
+    def compressing(self):
+        return nullcontext()
+
+    def dumping(self, host: str):
+        return nullcontext()
+
+    def uploading(self, storage: str):
+        return nullcontext()
+
+"""
+    Runs the backups of several sites at the same time.
+    Every site gets its own thread, the expensive steps are bounded separately:
+    - compressions, CPU bound (each one already uses [compression] workers processes)
+    - database dumps per database host
+    - uploads per storage
+    Sites are started longest first (from the durations in the log) so a big
+    site doesn't end up starting last and stretching the whole run.
+"""
+class Runner:
+    def __init__(self, workers: int = None):
+        config = Config()
+        self.workers = workers or config.read_int('runner', 'workers', 4)
+        self._compressions = threading.BoundedSemaphore(max(config.read_int('runner', 'compressions', 1), 1))
+        self.dumps_per_host = max(config.read_int('runner', 'dumps_per_host', 1), 1)
+        self.uploads_per_storage = max(config.read_int('runner', 'uploads_per_storage', 2), 1)
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def _semaphore(self, key: str, size: int) -> threading.BoundedSemaphore:
+        with self._lock:
+            if key not in self._semaphores:
+                self._semaphores[key] = threading.BoundedSemaphore(size)
+            return self._semaphores[key]
+
+    def compressing(self):
+        return self._compressions
+
+    def dumping(self, host: str):
+        return self._semaphore(f"database:{host}", self.dumps_per_host)
+
+    def uploading(self, storage: str):
+        return self._semaphore(f"storage:{storage}", self.uploads_per_storage)
+
+    # Average duration in seconds of the last successful runs, None when never timed
+    @staticmethod
+    def estimate(name: str):
+        runs = (
+            Run.select(Run.started_at, Run.finished_at)
+            .where((Run.name == name) & (Run.status == Run.__SUCCESS__))
+            .order_by(Run.id.desc())
+            .limit(HISTORY)
+        )
+        durations = [run.finished_at - run.started_at for run in runs]
+        return sum(durations) / len(durations) if durations else None
+
+    # backups are parsed site configs, bqckup the Bqckup instance running them
+    def run(self, bqckup, backups: list) -> dict:
+        estimates = {backup['name']: self.estimate(backup['name']) for backup in backups}
+        # Sites never timed go first, they could be the longest
+        ordered = sorted(backups, key=lambda backup: -(estimates[backup['name']] if estimates[backup['name']] is not None else float('inf')))
+
+        started_at = time.time()
+        results = {}
+
+        def job(backup):
+            job_started_at = time.time()
+            result = bqckup.do_backup(backup['file_name'], limits=self)
+            results[backup['name']] = (result is not False, time.time() - job_started_at)
+
+        print(f"Running {len(ordered)} backup(s), {min(self.workers, len(ordered))} at a time")
+        with ThreadPoolExecutor(max_workers=max(self.workers, 1)) as pool:
+            for future in [pool.submit(job, backup) for backup in ordered]:
+                future.result()
+
+        print(f"\nFinished {len(ordered)} backup(s) in {time.time() - started_at:.2f}s")
+        for name, (success, elapsed) in results.items():
+            print(f"- {name}: {'done' if success else 'failed'} in {elapsed:.2f}s")
+        return results
@@ -1,82 +1,261 @@
-import os, sys, boto3
-from boto3.s3.transfer import TransferConfig
+import os, sys, threading, time, boto3
+from concurrent.futures import ThreadPoolExecutor
+from peewee import chunked
 from botocore.config import Config
 from classes.config import Config as bqckup_config
 from classes.progresspercentage import ProgressPercentage
 from classes.storage import Storage
+from classes.multipart import MultipartStream, RangedReader, ResumableUpload
+from models.upload import Upload
+from classes.transfer import TransferTuner
+from classes.catalog import Catalog
+from constant import STORAGE_CONFIG_PATH, CONFIG_PATH
+
+# Keys per delete_objects request, the S3 maximum
+DELETE_BATCH = 1000
+# Largest object a single copy_object can copy
+COPY_LIMIT = 5 * 1024 ** 3
+
+# Process-wide pool, storage name => (config version, storage detail, client, root folder name)
+# boto3 clients are thread safe and keep their HTTP connections alive, so they are shared
+_clients = {}
+_clients_lock = threading.Lock()
+
+def _config_version() -> tuple:
+    version = []
+    for path in (STORAGE_CONFIG_PATH, CONFIG_PATH):
+        try:
+            version.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            version.append(None)
+    return tuple(version)
+
+def invalidate_clients(storage_name: str = None) -> None:
+    with _clients_lock:
+        if storage_name:
+            _clients.pop(storage_name, None)
+        else:
+            _clients.clear()
 
 class s3(object):
     def __init__(self, storage_name: str):
-        self.storage = Storage().get_storage_detail(storage_name)
-        self.root_folder_name = bqckup_config().read('bqckup', 'root_folder_name')
-        self.clientInit()
+        self.storage_name = storage_name
+        self.storage, self.client, self.root_folder_name = self._pooled(storage_name)
         self.bucket_name = self.storage['bucket']
-        
-    def clientInit(self):
-        session = boto3.session.Session()
+        self.tuner = TransferTuner(storage_name, self.storage)
+        self.catalog = Catalog(storage_name)
+
+    @staticmethod
+    def _pooled(storage_name: str) -> tuple:
+        version = _config_version()
+        with _clients_lock:
+            pooled = _clients.get(storage_name)
+            # Entries are dropped as soon as storages.yml or bqckup.cnf change on disk
+            if pooled and pooled[0] == version:
+                return pooled[1:]
+
+            storage = Storage().get_storage_detail(storage_name)
+            root_folder_name = bqckup_config().read('bqckup', 'root_folder_name')
+            client = s3.clientInit(storage)
+            if client:
+                _clients[storage_name] = (version, storage, client, root_folder_name)
+            return storage, client, root_folder_name
+
+    @staticmethod
+    def clientInit(storage: dict):
         try:
-            self.client = session.client(
+            return boto3.session.Session().client(
                 "s3",
-                region_name=self.storage['region'],
-                endpoint_url=self.storage['endpoint'],
-                aws_access_key_id=self.storage['access_key_id'],
-                aws_secret_access_key=self.storage['secret_access_key'],
+                region_name=storage['region'],
+                endpoint_url=storage['endpoint'],
+                aws_access_key_id=storage['access_key_id'],
+                aws_secret_access_key=storage['secret_access_key'],
                 config=Config(
                     retries = dict(
                         max_attempts = 5
-                    )
+                    ),
+                    # Enough connections for concurrent part uploads sharing the client
+                    max_pool_connections = 50
                 )
             )
         except Exception as e:
             print(f"Failed to connect because : {e}") 
-            self.client = False
+            return False
 
     def isAuthorized(self):
         return True if self.client else False
 
     def get_total_used(self, prefix=""):
-        files = self.list(prefix)
+        self.sync_catalog(prefix)
+        return self.catalog.total_size(prefix)
 
-        if not len(files):
-            return 0
+    # prefix for filtering, yields every object page by page (list_objects_v2 stops at 1000 keys per call)
+    def list(self, prefix=""):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            yield from page.get('Contents', [])
 
+    # List the prefix into the local catalog unless a recent listing already covers it
+    def sync_catalog(self, prefix="", force=False) -> None:
+        if force or not self.catalog.synced(prefix):
+            self.catalog.sync(self.list(prefix), prefix)
 
-        return sum([int(f["Size"]) for f in files.get('Contents')])
-
-    # prefix for filtering
-    def list(self, prefix="", Delimiter=""):
-        try:
-            files = self.client.list_objects_v2(Bucket=self.bucket_name, Prefix=prefix, Delimiter=Delimiter)
-        except KeyError:
-            return []  # empty array
-        else:
-            return files
+    # Objects under prefix from the local catalog (S3Object rows), ordered by key
+    def catalog_list(self, prefix="", refresh=False):
+        self.sync_catalog(prefix, refresh)
+        return self.catalog.objects(prefix)
 
     """
         No directoris/folders in s3
         format name : token_site.com_date.zip
     """
-    def upload(self, pathFile, newFileName, showProgress=True):
+    def upload(self, pathFile, newFileName, showProgress=True, name=None, log_id=None):
         newFileName = os.path.join(self.root_folder_name, newFileName)
-        config = TransferConfig(
-            multipart_threshold=1024 * 25,
-            max_concurrency=10,
-            multipart_chunksize=1024 * 25,
-            use_threads=True,
-        )
+        size = os.path.getsize(pathFile)
+        config = self.tuner.get_config(size)
+        callback = ProgressPercentage(pathFile) if showProgress else None
+        started_at = time.time()
         try:
-            self.client.upload_file(
-                pathFile,
-                self.bucket_name,
-                newFileName,
-                Config=config,
-                Callback=ProgressPercentage(pathFile) if showProgress else None,
-            )
+            # Big files go through a resumable multipart upload, see resume_uploads
+            if size >= config.multipart_threshold:
+                etag = ResumableUpload(
+                    self.client, self.storage_name, self.bucket_name, newFileName, pathFile,
+                    config.multipart_chunksize, config.max_request_concurrency,
+                    name=name, log_id=log_id, callback=callback
+                ).run()
+            else:
+                # upload_file doesn't return the ETag, the next listing fills it in
+                etag = None
+                self.client.upload_file(
+                    pathFile,
+                    self.bucket_name,
+                    newFileName,
+                    Config=config,
+                    Callback=callback,
+                )
         except Exception as errorMsg:
             print(
                 "File: {} , Upload error, reason: {}\n".format(pathFile, errorMsg)
             )
             raise Exception("Msg : {}\n".format(errorMsg))
+        else:
+            self.tuner.record(size, time.time() - started_at, config.max_request_concurrency, config.multipart_chunksize)
+            self.catalog.record(newFileName, size, etag)
+
+    # Returns a file-like object, everything written to it is uploaded without touching the disk
+    def upload_stream(self, newFileName) -> MultipartStream:
+        config = bqckup_config()
+        # The final size is unknown, the stream grows its parts by itself past 1000 parts
+        part_size = self.tuner.part_size or config.read_int('upload', 'stream_part_size_mb', 16) * 1024 * 1024
+        key = os.path.join(self.root_folder_name, newFileName)
+
+        def on_complete(size, elapsed, concurrency, part_size):
+            self.tuner.record(size, elapsed, concurrency, part_size)
+            self.catalog.record(key, size, stream.etag)
+
+        stream = MultipartStream(
+            self.client,
+            self.bucket_name,
+            key,
+            part_size=part_size,
+            concurrency=self.tuner.get_concurrency(),
+            buffers=config.read_int('upload', 'stream_buffers', 4),
+            on_complete=on_complete,
+        )
+        return stream
+
+    # Finish (or abort when the file is gone) the uploads of a site left behind by dead workers
+    # Returns [(Upload, uploaded)]
+    def resume_uploads(self, name: str) -> list:
+        results = []
+        pending = Upload.select().where((Upload.name == name) & (Upload.storage == self.storage_name) & (Upload.status == Upload.__ON_PROGRESS__))
+        for upload in pending:
+            if ResumableUpload.owner_alive(upload):
+                continue
+
+            if os.path.exists(upload.source) and os.stat(upload.source).st_mtime_ns == upload.mtime:
+                print(f"Resuming interrupted upload {upload.key}")
+                try:
+                    etag = ResumableUpload(
+                        self.client, self.storage_name, upload.bucket, upload.key, upload.source,
+                        upload.part_size, self.tuner.get_concurrency(upload.size), name=upload.name, log_id=upload.log_id
+                    ).run()
+                except Exception as e:
+                    print(f"Failed to resume upload {upload.key}, {e}")
+                    results.append((upload, False))
+                else:
+                    self.catalog.record(upload.key, upload.size, etag)
+                    results.append((upload, True))
+                continue
+
+            print(f"Aborting interrupted upload {upload.key}, {upload.source} doesn't exist anymore")
+            self.abort_upload(upload.key, upload.upload_id)
+            Upload.update(status=Upload.__ABORTED__).where(Upload.id == upload.id).execute()
+            results.append((upload, False))
+        return results
+
+    def abort_upload(self, key: str, upload_id: str) -> None:
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=key, UploadId=upload_id)
+        except Exception as e:
+            print(f"Failed to abort upload {key}, {e}")
+
+    # Abort multipart uploads nobody tracks anymore (e.g. a stream cut by a crash), they are billed until aborted
+    def abort_orphaned_uploads(self, prefix: str = "", older_than: int = 86400) -> int:
+        tracked = set(upload.upload_id for upload in Upload.select(Upload.upload_id).where((Upload.storage == self.storage_name) & (Upload.status == Upload.__ON_PROGRESS__)))
+        aborted = 0
+        paginator = self.client.get_paginator('list_multipart_uploads')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=os.path.join(self.root_folder_name, prefix)):
+            for upload in page.get('Uploads', []):
+                if upload['UploadId'] in tracked or time.time() - upload['Initiated'].timestamp() < older_than:
+                    continue
+                print(f"Aborting orphaned upload {upload['Key']}")
+                self.abort_upload(upload['Key'], upload['UploadId'])
+                aborted += 1
+        return aborted
+
+    # fileName is the object name without the root folder, like upload
+    def download(self, fileName, path):
+        try:
+            self.client.download_file(self.bucket_name, os.path.join(self.root_folder_name, fileName), path)
+        except Exception as errorMsg:
+            print(
+                "File: {} Download failed, reason: {}\n".format(fileName, errorMsg)
+            )
+            raise Exception("Msg : {}\n".format(errorMsg))
+
+    # Bytes start to end (inclusive) of an object, a ranged GET
+    def get_range(self, fileName, start: int, end: int) -> bytes:
+        response = self.client.get_object(
+            Bucket=self.bucket_name, Key=os.path.join(self.root_folder_name, fileName), Range=f"bytes={start}-{end}"
+        )
+        return response['Body'].read()
+
+    # Readable stream of an object, fetched with concurrent ranged GETs ([restore] settings)
+    def open_stream(self, fileName) -> RangedReader:
+        config = bqckup_config()
+        size = self.client.head_object(Bucket=self.bucket_name, Key=os.path.join(self.root_folder_name, fileName))['ContentLength']
+        return RangedReader(
+            lambda start, end: self.get_range(fileName, start, end),
+            size,
+            part_size=config.read_int('restore', 'part_size_mb', 8) * 1024 * 1024,
+            concurrency=config.read_int('restore', 'concurrency', 8),
+            buffers=config.read_int('restore', 'buffers', 4),
+        )
+
+    # Moves an object to another storage class in place, nothing goes through this host:
+    # one copy_object up to 5 GB, a multipart copy (UploadPartCopy) past that
+    def set_storage_class(self, fileName, storage_class: str) -> None:
+        key = os.path.join(self.root_folder_name, fileName)
+        size = self.client.head_object(Bucket=self.bucket_name, Key=key)['ContentLength']
+        source = {"Bucket": self.bucket_name, "Key": key}
+        if size <= COPY_LIMIT:
+            response = self.client.copy_object(Bucket=self.bucket_name, Key=key, CopySource=source, StorageClass=storage_class, MetadataDirective='COPY')
+            etag = response.get('CopyObjectResult', {}).get('ETag')
+        else:
+            self.client.copy(source, self.bucket_name, key, ExtraArgs={"StorageClass": storage_class, "MetadataDirective": 'COPY'}, Config=self.tuner.get_config(size))
+            etag = None
+        self.catalog.record(key, size, etag)
 
     # fileName = Key
     def delete(self, fileName):
@@ -87,6 +266,30 @@ class s3(object):
                 "File: {} Delete failed, reason: {}\n".format(fileName, errorMsg)
             )
             raise Exception("Msg : {}\n".format(errorMsg))
+        else:
+            self.catalog.forget(fileName)
+
+    # Deletes objects (names without the root folder) with delete_objects batches of 1000 keys sent
+    # concurrently, returns the names that could not be deleted
+    def delete_many(self, fileNames: list, concurrency: int = 8) -> list:
+        keys = {os.path.join(self.root_folder_name, name): name for name in fileNames}
+
+        def delete(batch: list) -> list:
+            try:
+                response = self.client.delete_objects(Bucket=self.bucket_name, Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True})
+            except Exception as e:
+                print(f"Failed to delete {len(batch)} object(s), {e}")
+                return batch
+            for error in response.get('Errors', []):
+                print(f"Failed to delete {error.get('Key')}, {error.get('Message')}")
+            return [error['Key'] for error in response.get('Errors', [])]
+
+        failed = set()
+        with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as pool:
+            for errors in pool.map(delete, chunked(list(keys), DELETE_BATCH)):
+                failed.update(errors)
+        self.catalog.forget_many([key for key in keys if key not in failed])
+        return [keys[key] for key in failed if key in keys]
 
     def generate_link(self, file_name=False, time_to_expire=86400):
         try:
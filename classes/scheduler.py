@@ -0,0 +1,250 @@
+import heapq, os, signal, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from hashlib import sha256
+from classes.config import Config
+from classes.runner import Runner
+from constant import SITE_CONFIG_PATH
+
+# Sites without a schedule keep their interval, as cron expressions
+INTERVALS = {
+    'daily': '0 0 * * *',
+    'weekly': '0 0 * * 0',
+    'monthly': '0 0 1 * *',
+}
+MACROS = {
+    '@hourly': '0 * * * *',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@weekly': '0 0 * * 0',
+    '@monthly': '0 0 1 * *',
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+}
+MONTHS = {name: i + 1 for i, name in enumerate(('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'))}
+WEEKDAYS = {name: i for i, name in enumerate(('sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat'))}
+# Site configs are checked for changes at least this often (seconds)
+RELOAD_EVERY = 60
+
+class CronException(Exception): pass
+
+"""
+    Standard 5 fields cron expression (minute hour day-of-month month day-of-week)
+    with lists, ranges, steps, month and day names and the @daily like macros.
+    As in cron, when both day fields are restricted a day matching either one runs.
+"""
+class Cron:
+    def __init__(self, expression: str):
+        self.expression = str(expression).strip()
+        fields = MACROS.get(self.expression.lower(), self.expression).split()
+        if len(fields) != 5:
+            raise CronException(f"Invalid cron expression '{self.expression}', 5 fields expected")
+
+        self.minutes = self._parse(fields[0], 0, 59)
+        self.hours = self._parse(fields[1], 0, 23)
+        self.days = self._parse(fields[2], 1, 31)
+        self.months = self._parse(fields[3], 1, 12, MONTHS)
+        # 7 is sunday too
+        self.weekdays = set(day % 7 for day in self._parse(fields[4], 0, 7, WEEKDAYS))
+        self.any_day = fields[2].startswith('*')
+        self.any_weekday = fields[4].startswith('*')
+
+    def _parse(self, field: str, low: int, high: int, names: dict = None) -> set:
+        def value(text: str) -> int:
+            text = text.lower()
+            if names and text in names:
+                return names[text]
+            if not text.isdigit():
+                raise CronException(f"Invalid value '{text}' in cron expression '{self.expression}'")
+            return int(text)
+
+        values = set()
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/', 1)
+                step = value(step)
+                if step < 1:
+                    raise CronException(f"Invalid step in cron expression '{self.expression}'")
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = (value(bound) for bound in part.split('-', 1))
+            else:
+                start = value(part)
+                # 5/15 means from 5 to the end every 15
+                end = high if step > 1 else start
+            if start < low or end > high or start > end:
+                raise CronException(f"Value out of range in cron expression '{self.expression}'")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, moment: datetime) -> bool:
+        day = moment.day in self.days
+        # python counts from monday, cron from sunday
+        weekday = (moment.weekday() + 1) % 7 in self.weekdays
+        if not self.any_day and not self.any_weekday:
+            return day or weekday
+        return day and weekday
+
+    # First matching minute strictly after moment
+    def next(self, moment: datetime) -> datetime:
+        moment = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise CronException(f"Cron expression '{self.expression}' never matches")
+
+"""
+    When a site runs: options.schedule (cron, defaults to options.interval),
+    options.window ("HH:MM-HH:MM", may cross midnight) to only start inside
+    those hours, and a jitter (options.jitter or [scheduler] jitter, seconds)
+    derived from the site name so sites sharing a schedule don't all start
+    at the same second, yet keep the same offset from one run to the next.
+"""
+class Schedule:
+    def __init__(self, name: str, options: dict):
+        self.name = name
+        self.cron = Cron(options.get('schedule') or INTERVALS.get(options.get('interval'), INTERVALS['daily']))
+        self.window = self._parse_window(options.get('window')) if options.get('window') else None
+
+        jitter = options.get('jitter')
+        jitter = Config().read_int('scheduler', 'jitter', 300) if jitter is None else int(jitter)
+        self.offset = int(sha256(name.encode()).hexdigest(), 16) % (jitter + 1) if jitter > 0 else 0
+
+    @staticmethod
+    def _parse_window(window: str) -> tuple:
+        try:
+            start, end = (datetime.strptime(bound.strip(), '%H:%M') for bound in str(window).split('-'))
+        except ValueError:
+            raise CronException(f"Invalid window '{window}', expected HH:MM-HH:MM")
+        return start.hour * 60 + start.minute, end.hour * 60 + end.minute
+
+    def in_window(self, moment: datetime) -> bool:
+        if not self.window:
+            return True
+        start, end = self.window
+        minute = moment.hour * 60 + moment.minute
+        if start <= end:
+            return start <= minute < end
+        return minute >= start or minute < end
+
+    def _window_start(self, moment: datetime) -> datetime:
+        start = moment.replace(hour=self.window[0] // 60, minute=self.window[0] % 60, second=0, microsecond=0)
+        return start if start > moment else start + timedelta(days=1)
+
+    # Timestamp of the first run after the timestamp given
+    def next_run(self, after: float) -> float:
+        moment = self.cron.next(datetime.fromtimestamp(after))
+        if not self.in_window(moment):
+            moment = self._window_start(moment)
+        run_at = moment.timestamp() + self.offset
+        # The jitter never pushes a run out of its window
+        if not self.in_window(datetime.fromtimestamp(run_at)):
+            run_at = moment.timestamp()
+        return run_at
+
+    # First run when the daemon starts, a run missed while it was down happens right away (in the window)
+    def first_run(self, last_run: float, now: float) -> float:
+        if not last_run:
+            return self.next_run(now)
+        run_at = self.next_run(last_run)
+        if run_at > now:
+            return run_at
+        if self.in_window(datetime.fromtimestamp(now)):
+            return now
+        return self._window_start(datetime.fromtimestamp(now)).timestamp()
+
+"""
+    Resident scheduler (bqckup daemon). Next runs are kept in a heap so waking
+    up only looks at the sites that are due. Due sites run on a pool sharing
+    the Runner limits, site configs are reloaded when they change on disk.
+"""
+class Scheduler:
+    def __init__(self, bqckup, workers: int = None):
+        self.bqckup = bqckup
+        self.runner = Runner(workers)
+        self.heap = []
+        self.sites = {}
+        self.schedules = {}
+        self.running = {}
+        self._version = None
+        # Site configs are looked at on their own timer, not on every wake
+        self._check_at = 0
+        self._stop = threading.Event()
+
+    def _config_version(self) -> tuple:
+        try:
+            return tuple(sorted((entry.name, entry.stat().st_mtime_ns) for entry in os.scandir(SITE_CONFIG_PATH) if entry.name.endswith('.yml')))
+        except OSError:
+            return ()
+
+    def load(self) -> None:
+        self._version = self._config_version()
+        now = time.time()
+        self.sites, self.schedules, heap = {}, {}, []
+        # list() takes the last backup of every site from a single query
+        for backup in self.bqckup.list().values():
+            try:
+                schedule = Schedule(backup['name'], backup.get('options') or {})
+            except CronException as e:
+                print(f"Skipped {backup['name']}, {e}")
+                continue
+            self.sites[backup['name']] = backup
+            self.schedules[backup['name']] = schedule
+            heap.append((schedule.first_run(backup.get('last_backup'), now), backup['name']))
+        heapq.heapify(heap)
+        self.heap = heap
+        print(f"Scheduling {len(heap)} site(s)" + (f", next run at {datetime.fromtimestamp(heap[0][0]).strftime('%d/%m/%Y %H:%M:%S')}" if heap else ""))
+
+    def stop(self, *args) -> None:
+        print("Stopping, waiting for the running backups ...")
+        self._stop.set()
+
+    def _start_due(self, pool: ThreadPoolExecutor) -> None:
+        now = time.time()
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            due.append(heapq.heappop(self.heap)[1])
+
+        # Longest first, like a regular run
+        estimates = {name: Runner.estimate(name) for name in due}
+        due.sort(key=lambda name: -(estimates[name] if estimates[name] is not None else float('inf')))
+        for name in due:
+            running = self.running.get(name)
+            if running and not running.done():
+                print(f"Backup for {name} is still running, skipping this run")
+            else:
+                print(f"Starting backup for {name}")
+                self.running[name] = pool.submit(self.bqckup.do_backup, self.sites[name]['file_name'], self.runner)
+            heapq.heappush(self.heap, (self.schedules[name].next_run(now), name))
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.load()
+
+        with ThreadPoolExecutor(max_workers=max(self.runner.workers, 1)) as pool:
+            self._check_at = time.time() + RELOAD_EVERY
+            while not self._stop.is_set():
+                # Scanning the sites folder costs a stat per site, it's done once per RELOAD_EVERY
+                if time.time() >= self._check_at:
+                    self._check_at = time.time() + RELOAD_EVERY
+                    if self._config_version() != self._version:
+                        self.load()
+                self._start_due(pool)
+                self.running = {name: future for name, future in self.running.items() if not future.done()}
+
+                wake_at = self._check_at
+                if self.heap:
+                    wake_at = min(self.heap[0][0], wake_at)
+                self._stop.wait(max(wake_at - time.time(), 0))
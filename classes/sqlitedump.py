@@ -0,0 +1,129 @@
+import os, sqlite3, tempfile, time, shutil
+from classes.codec import CODECS, Codec, Gzip
+from classes.compressor import ParallelCompressor
+from classes.config import Config
+from classes.database import DatabaseException
+
+# Pages copied per step, the database is free for writers between two steps
+PAGES_PER_STEP = 1024
+# Pause after every step so writers waiting for the lock get it
+STEP_PAUSE = 0.001
+# Copies restarted by writes before the last one is done in a single step (rollback journal only)
+MAX_RESTARTS = 3
+
+class _Restarted(Exception): pass
+
+"""
+    SQLite dump through the online backup API. Pages are copied a batch at a
+    time instead of in one step, so the application keeps writing during the backup.
+    In WAL mode a read transaction is held on the source for the whole copy,
+    it reads one snapshot while writers go on. With a rollback journal a
+    write restarts the copy, after MAX_RESTARTS the source is copied in a
+    single step (locked as long as it takes).
+    The copy is then compressed with the site codec.
+"""
+class SqliteDump:
+    def __init__(self, credentials: dict, codec: Codec = None, tmp_path: str = None):
+        # database.path, or database.name for a path
+        self.path = credentials.get('path') or credentials.get('name')
+        self.codec = codec or Gzip()
+        self.tmp_path = tmp_path
+        self.stats = {}
+
+    def _open(self) -> sqlite3.Connection:
+        if not self.path or not os.path.isfile(self.path):
+            raise DatabaseException(f"SQLite database {self.path} not found")
+        try:
+            return sqlite3.connect(self.path, isolation_level=None)
+        except sqlite3.Error as e:
+            raise DatabaseException(f"Failed to open database {self.path}, {e}")
+
+    def test_connection(self) -> None:
+        connection = self._open()
+        try:
+            connection.execute("SELECT count(*) FROM sqlite_master").fetchone()
+        except sqlite3.Error as e:
+            raise DatabaseException(f"Failed to read database {self.path}, {e}")
+        finally:
+            connection.close()
+
+    # output is either a path or a writable file-like object (e.g. an upload stream)
+    def export(self, output) -> int:
+        started_at = time.time()
+        fd, copy_path = tempfile.mkstemp(prefix='bqckup-sqlite-', suffix='.db', dir=self.tmp_path)
+        os.close(fd)
+        steps = restarts = 0
+        try:
+            source = self._open()
+            target = sqlite3.connect(copy_path)
+            last_remaining = None
+
+            def progress(status, remaining, total):
+                nonlocal steps, restarts, last_remaining
+                steps += 1
+                if last_remaining is not None and remaining > last_remaining:
+                    restarts += 1
+                    if restarts > MAX_RESTARTS:
+                        raise _Restarted()
+                last_remaining = remaining
+                time.sleep(STEP_PAUSE)
+
+            try:
+                wal = source.execute("PRAGMA journal_mode").fetchone()[0].lower() == 'wal'
+                if wal:
+                    source.execute("BEGIN")
+                    source.execute("SELECT count(*) FROM sqlite_master").fetchone()
+                try:
+                    source.backup(target, pages=PAGES_PER_STEP, progress=progress)
+                except _Restarted:
+                    print(f"{os.path.basename(self.path)} changed {restarts} times during the copy, copying it in one step")
+                    source.backup(target)
+                if wal:
+                    source.execute("COMMIT")
+            except sqlite3.Error as e:
+                raise DatabaseException(f"Failed to backup database {self.path}, {e}")
+            finally:
+                target.close()
+                source.close()
+            copied_at = time.time()
+
+            workers = Config().read_int('compression', 'workers', 1)
+            workers = workers if workers > 0 else os.cpu_count() or 1
+            fileobj = open(output, 'wb') if isinstance(output, str) else output
+            try:
+                with open(copy_path, 'rb') as f, ParallelCompressor(fileobj, workers, codec=self.codec) as writer:
+                    shutil.copyfileobj(f, writer, 1024 * 1024)
+            finally:
+                if isinstance(output, str):
+                    fileobj.close()
+        finally:
+            os.unlink(copy_path)
+
+        elapsed = max(time.time() - started_at, 0.001)
+        self.stats = {"raw_size": writer.bytes_in, "size": writer.bytes_out, "elapsed": elapsed, "copy": copied_at - started_at, "steps": steps, "restarts": restarts}
+        print(f"Copied {writer.bytes_in / (1024 * 1024):.2f} MB of {os.path.basename(self.path)} in {steps} step(s), {elapsed:.2f}s with compression")
+        return writer.bytes_out
+
+    # Puts a dump made by export back, through the backup API too so open connections see the restored content
+    def restore(self, path: str, codec: Codec = None) -> None:
+        started_at = time.time()
+        # The codec is told by the extension of the dump
+        codec = codec or next((candidate() for candidate in CODECS.values() if path.endswith(f".{candidate.extension}")), Gzip())
+        fd, copy_path = tempfile.mkstemp(prefix='bqckup-sqlite-', suffix='.db', dir=self.tmp_path)
+        os.close(fd)
+        try:
+            result = os.system(f"{codec.decompress_command()} < '{path}' > '{copy_path}'")
+            if result != 0:
+                raise DatabaseException(f"Failed to decompress {os.path.basename(path)}")
+            source = sqlite3.connect(copy_path)
+            target = sqlite3.connect(self.path)
+            try:
+                source.backup(target, pages=PAGES_PER_STEP)
+            except sqlite3.Error as e:
+                raise DatabaseException(f"Failed to restore database {self.path}, {e}")
+            finally:
+                target.close()
+                source.close()
+        finally:
+            os.unlink(copy_path)
+        print(f"Restored {os.path.basename(self.path)} in {time.time() - started_at:.2f}s")
@@ -1,10 +1,27 @@
+import os, threading
 from classes.yml_parser import Yml_Parser
 from constant import STORAGE_CONFIG_PATH
 
 class StorageException(Exception): pass
+
+# storages.yml is parsed once per process and again only when it changes, like bqckup.cnf (see Config)
 class Storage:
+    _parsed = None
+    _version = None
+    _lock = threading.Lock()
+
     def __init__(self):
-        self.parsed_storage = Yml_Parser.parse(STORAGE_CONFIG_PATH)
+        self.parsed_storage = Storage._load()
+
+    @classmethod
+    def _load(cls) -> dict:
+        # Missing file raises, as it always did
+        st = os.stat(STORAGE_CONFIG_PATH)
+        version = (st.st_mtime_ns, st.st_size)
+        with cls._lock:
+            if cls._version != version:
+                cls._parsed, cls._version = Yml_Parser.parse(STORAGE_CONFIG_PATH), version
+            return cls._parsed
 
     def get_parsed_storage(self):
         return self.parsed_storage
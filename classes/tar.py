@@ -1,19 +1,97 @@
-import tarfile, os
+import tarfile, os, time, io
 from typing import Union
+from classes.config import Config
+from classes.compressor import ParallelCompressor
+from classes.codec import Codec, Gzip, get_codec
+from classes.archive_index import ArchiveIndex, IndexingTarFile
+
+# Member listing the files removed since the previous backup (incremental archives)
+DELETED_MEMBER = '.bqckup-deleted'
 
 class Tar:
-    def __init__(self):
-        pass
-    
-    def compress(self, source: Union[str, list, dict], output: str) -> str:
-        with tarfile.open(output, "w:gz") as tar:
-            if type(source) != str:
-                for path in source:
-                    if not os.path.exists(path):
-                        print(f"Skipped, {path} not found")
-                        continue
-                    tar.add(path, arcname=os.path.basename(path))
-            else:
+    # index builds an ArchiveIndex of the archive (self.index) for single file restores
+    def __init__(self, workers: int = None, codec: Codec = None, index: bool = False):
+        config = Config()
+        self.codec = codec or get_codec(Gzip.name, config.read_int('compression', 'level', Gzip.default_level))
+        # 0 means use every core available
+        self.workers = config.read_int('compression', 'workers', 1) if workers is None else workers
+        if self.workers <= 0:
+            self.workers = os.cpu_count() or 1
+        self.block_size = config.read_int('compression', 'block_size_mb', 8) * 1024 * 1024
+        self.indexed = index
+        self.index = None
+        self.stats = {}
+
+    @staticmethod
+    def _sources(source: Union[str, list, dict]) -> list:
+        return [source] if type(source) == str else list(source)
+
+    # Name of path inside the archive, relative to the basename of the source it belongs to
+    @staticmethod
+    def arcname(source: Union[str, list, dict], path: str) -> str:
+        for root in Tar._sources(source):
+            root = root.rstrip(os.sep)
+            if path == root:
+                return os.path.basename(root)
+            if path.startswith(root + os.sep):
+                return os.path.join(os.path.basename(root), os.path.relpath(path, root))
+        return os.path.basename(path)
+
+    def _add(self, tar: tarfile.TarFile, source: Union[str, list, dict], only: set = None, deleted: set = None):
+        for path in self._sources(source):
+            if not os.path.exists(path):
+                print(f"Skipped, {path} not found")
+                continue
+            if only is None:
                 tar.add(path, arcname=os.path.basename(path))
-            tar.close()
-        return output
\ No newline at end of file
+
+        # Incremental archive, only the given paths and the list of deleted ones
+        if only is not None:
+            for path in sorted(only):
+                if os.path.lexists(path):
+                    tar.add(path, arcname=self.arcname(source, path), recursive=False)
+
+            content = "\n".join(sorted(self.arcname(source, path) for path in deleted or ())).encode()
+            info = tarfile.TarInfo(DELETED_MEMBER)
+            info.size = len(content)
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(content))
+
+    def _compress_to(self, source: Union[str, list, dict], fileobj, only: set = None, deleted: set = None) -> ParallelCompressor:
+        with ParallelCompressor(fileobj, self.workers, self.block_size, self.codec) as writer:
+            with (IndexingTarFile if self.indexed else tarfile.TarFile).open(fileobj=writer, mode="w|") as tar:
+                self._add(tar, source, only, deleted)
+        if self.indexed:
+            self.index = ArchiveIndex.build(self.codec.name, writer.blocks, tar.entries)
+        return writer
+
+    # output is either a path or a writable file-like object (e.g. an upload stream)
+    # only/deleted turn the archive into an incremental one, see classes/manifest.py
+    def compress(self, source: Union[str, list, dict], output, only: set = None, deleted: set = None) -> str:
+        started_at = time.time()
+
+        if not isinstance(output, str):
+            writer = self._compress_to(source, output, only, deleted)
+            raw_size, compressed_size = writer.bytes_in, writer.bytes_out
+        # The index needs independent blocks, a single gzip stream can only be read from the start
+        elif self.workers > 1 or self.codec.name != Gzip.name or self.indexed:
+            with open(output, "wb") as f:
+                writer = self._compress_to(source, f, only, deleted)
+            raw_size, compressed_size = writer.bytes_in, writer.bytes_out
+        else:
+            with tarfile.open(output, "w:gz", compresslevel=self.codec.level) as tar:
+                self._add(tar, source, only, deleted)
+                raw_size = tar.offset
+            compressed_size = os.stat(output).st_size
+
+        elapsed = max(time.time() - started_at, 0.001)
+        self.stats = {
+            "raw_size": raw_size,
+            "compressed_size": compressed_size,
+            "elapsed": elapsed,
+            "throughput": raw_size / elapsed / (1024 * 1024),
+            "workers": self.workers,
+            "codec": self.codec.name,
+        }
+        print(f"Compressed {raw_size / (1024 * 1024):.2f} MB in {elapsed:.2f}s with {self.codec.name} ({self.stats['throughput']:.2f} MB/s, {self.workers} worker(s))")
+        return output
@@ -0,0 +1,92 @@
+import math, time
+from boto3.s3.transfer import TransferConfig
+from classes.multipart import MIN_PART_SIZE, MAX_PARTS
+from models.transfer_stat import TransferStat
+
+MB = 1024 * 1024
+DEFAULT_PART_SIZE = 8 * MB
+DEFAULT_CONCURRENCY = 8
+MAX_CONCURRENCY = 32
+CONCURRENCY_STEP = 2
+# Number of past uploads looked at when tuning the concurrency
+HISTORY = 20
+
+"""
+    Picks multipart settings for a storage:
+    - part size from the file size so an upload never needs more than 10,000 parts
+    - concurrency from the throughput measured by previous uploads (hill climbing)
+    Every value can be pinned per storage in storages.yml with
+    multipart_threshold_mb, multipart_chunksize_mb and max_concurrency.
+"""
+class TransferTuner:
+    def __init__(self, storage_name: str, storage: dict):
+        self.storage_name = storage_name
+        self.threshold = int(storage.get('multipart_threshold_mb') or 0) * MB or DEFAULT_PART_SIZE
+        self.part_size = int(storage.get('multipart_chunksize_mb') or 0) * MB or None
+        self.max_concurrency = int(storage.get('max_concurrency') or 0) or None
+
+    def get_part_size(self, size: int = None) -> int:
+        part_size = max(self.part_size or DEFAULT_PART_SIZE, MIN_PART_SIZE)
+        if size:
+            # Keep some parts in reserve, round up to a whole MB
+            needed = math.ceil(size / (MAX_PARTS - 100) / MB) * MB
+            part_size = max(part_size, needed)
+        return part_size
+
+    def get_concurrency(self, size: int = None) -> int:
+        if self.max_concurrency:
+            concurrency = self.max_concurrency
+        else:
+            concurrency = self._tuned_concurrency()
+
+        # No point in more threads than parts
+        if size:
+            concurrency = min(concurrency, max(math.ceil(size / self.get_part_size(size)), 1))
+        return max(concurrency, 1)
+
+    def _tuned_concurrency(self) -> int:
+        try:
+            history = list(TransferStat.select().where(TransferStat.storage == self.storage_name).order_by(TransferStat.id.desc()).limit(HISTORY))
+        except Exception:
+            return DEFAULT_CONCURRENCY
+
+        if not history:
+            return DEFAULT_CONCURRENCY
+
+        throughputs = {}
+        for stat in history:
+            throughputs.setdefault(stat.concurrency, []).append(stat.throughput)
+        averages = {concurrency: sum(values) / len(values) for concurrency, values in throughputs.items()}
+        best = max(averages, key=averages.get)
+
+        # Explore one step around the best known value until neither side pays off
+        higher, lower = best + CONCURRENCY_STEP, best - CONCURRENCY_STEP
+        if higher <= MAX_CONCURRENCY and higher not in averages:
+            return higher
+        if lower >= 1 and lower not in averages:
+            return lower
+        return best
+
+    def get_config(self, size: int) -> TransferConfig:
+        return TransferConfig(
+            multipart_threshold=self.threshold,
+            multipart_chunksize=self.get_part_size(size),
+            max_concurrency=self.get_concurrency(size),
+            use_threads=True,
+        )
+
+    def record(self, size: int, elapsed: float, concurrency: int, part_size: int) -> None:
+        # Small uploads are dominated by latency, they say nothing about the bandwidth
+        if size < self.threshold or elapsed <= 0:
+            return
+        try:
+            TransferStat.create(
+                storage=self.storage_name,
+                size=size,
+                concurrency=concurrency,
+                part_size=part_size,
+                throughput=size / elapsed,
+                created_at=int(time.time()),
+            )
+        except Exception as e:
+            print(f"Failed to record transfer throughput, {e}")
@@ -1,5 +1,8 @@
 import yaml
 
+# libyaml's loader is several times faster, the pure python one is the fallback
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
 class Yml_Parser:
     def __init__(self):
         pass
@@ -7,7 +10,7 @@ class Yml_Parser:
     def parse(path: str) -> dict:
         with open(path, "r") as stream:
             try:
-                parsed_yml = yaml.safe_load(stream)
+                parsed_yml = yaml.load(stream, Loader=Loader)
             except yaml.YAMLError as exc:
                 raise Exception(exc)
             finally:
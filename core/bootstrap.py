@@ -0,0 +1,70 @@
+import os
+from constant import BQ_PATH, STORAGE_CONFIG_PATH, SITE_CONFIG_PATH
+
+# Runs before every CLI command and the web app, so it only imports what it uses (no Flask)
+def initialization():
+    from models import database
+    from models.migrations import migrate
+    db_path = os.path.join(BQ_PATH, 'database', 'bqckup.db')
+
+    if not os.path.exists(db_path):
+        for folder in ['config', 'database', 'sites']:
+            if not os.path.exists(os.path.join(BQ_PATH, folder)):
+                os.makedirs(os.path.join(BQ_PATH, folder))
+
+        os.system(f"touch {db_path}")
+        os.system(f"chmod 755 {db_path}")
+
+    database.connect()
+    migrate()
+    database.close()
+
+    dummy_storge_config = STORAGE_CONFIG_PATH.replace('.yml', '.yml.example')
+    dummy_site_config = os.path.join(SITE_CONFIG_PATH, 'domain.yml.example')
+
+    if not os.path.exists(dummy_site_config):
+        import ruamel.yaml as rYaml
+        with open(dummy_site_config, 'w+') as stream:
+            _yaml = rYaml.YAML()
+            _yaml.indent(sequence=4, offset=2)
+            _yaml.dump({
+                "bqckup": {
+                    "name": "domain",
+                    "path": ['/var/www/html'],
+                    "database": {
+                        "type": "mysql",
+                        "host": "localhost",
+                        "port": 3306,
+                        "user": "root",
+                        "password": "root",
+                        "name": "database"
+                    },
+                    "options": {
+                        "storage": "dummy",
+                        "interval": "daily",
+                        "retention": "7",
+                        "save_locally": "no",
+                        "save_locally_path": os.path.join(BQ_PATH, 'tmp'),
+                        "notification_email": "email@example.com",
+                        "provider": "s3"
+                    }
+                }
+            }, stream)
+
+    if not os.path.exists(dummy_storge_config):
+        import ruamel.yaml as rYaml
+        with open(dummy_storge_config, 'w+') as stream:
+            _yaml = rYaml.YAML()
+            _yaml.indent(sequence=4, offset=2)
+            _yaml.dump({
+                "storages": {
+                    "dummy": {
+                        "bucket": "dummy",
+                        "access_key_id": "dummy",
+                        "secret_access_key": "dummy",
+                        "region": "dummy",
+                        "endpoint": "dummy",
+                        "primary": "no"
+                    }
+                }
+            }, stream)
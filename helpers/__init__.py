@@ -1,10 +1,11 @@
-import os, errno, datetime, logging, requests
+import os, errno, datetime, logging
 from os import path
 from datetime import date, datetime
 from pathlib import Path
 
 
 def get_server_ip():
+    import requests
     try:
         result = requests.get('http://ifconfig.me', verify=False)
         return result.text.strip()
@@ -22,9 +23,7 @@ def get_server_ip():
 def difference_in_days(date1: int, date2: int) -> int:
     date1 = datetime.fromtimestamp(date1)
     date2 = datetime.fromtimestamp(date2)
-    day1 = date1.date().day
-    day2 = date2.date().day
-    return day1 - day2
+    return (date1.date() - date2.date()).days
 
 # dt = unix format
 def time_since(dt, default="now", reverse=False):
@@ -637,7 +636,7 @@ def executeCommand(q):
 
 
 def generate_short_link(link):
-    import uuid
+    import uuid, requests
     from constant import YOURLS_SECRET_KEY, YOURLS_HOST
 
     if not YOURLS_HOST or not YOURLS_HOST:
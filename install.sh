@@ -19,7 +19,7 @@ if [[ "$DISTRO_VERSION" < "18.04" ]]; then
 	exit 1
 fi
 
-sudo apt-get install sqlite3 curl -y
+sudo apt-get install sqlite3 curl zstd lz4 -y
 wget "$DOWNLOAD_LINK/ubuntu/$DISTRO_VERSION/latest.tar.gz" -O "/tmp/bqckup.tar.gz"
 
 tar xvf /tmp/bqckup.tar.gz && \ 
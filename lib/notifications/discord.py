@@ -1,4 +1,3 @@
-import requests as req
 from classes.config import Config
 
 sender = {
@@ -8,6 +7,7 @@ sender = {
 }
 
 def send_notification(data):
+    import requests as req
     try:
         data = {**sender, **data}
         req.post(Config().read('notification', 'discord_webhook_url'), json=data)        
@@ -0,0 +1,44 @@
+from peewee import *
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from models import BaseModel
+
+# Full database dump of a binlog site and the binary log position it was taken at,
+# next_file/next_position is where the next capture starts
+class BinlogChain(BaseModel):
+    __OPEN__ = 1
+    # A newer full dump started another chain
+    __CLOSED__ = 2
+    # Binary logs were purged before being captured, restores stop at the last segment
+    __BROKEN__ = 3
+
+    class Meta:
+        db_table = 'binlog_chains'
+        indexes = (
+            (('name', 'status', 'id'), False),
+        )
+
+    id = AutoField()
+    name = CharField()
+    log_id = IntegerField()
+    start_file = CharField()
+    start_position = IntegerField()
+    next_file = CharField()
+    next_position = IntegerField()
+    status = IntegerField()
+    created_at = IntegerField()
+    updated_at = IntegerField()
+
+# Binary log file (or its end, for the first one of a chain) captured into the bundle of log_id
+class BinlogSegment(BaseModel):
+    class Meta:
+        db_table = 'binlog_segments'
+
+    id = AutoField()
+    chain = ForeignKeyField(BinlogChain, backref='segments', on_delete='CASCADE')
+    log_id = IntegerField()
+    file = CharField()
+    start_position = IntegerField()
+    end_position = IntegerField()
+    # Every event of the segment happened before this
+    captured_at = IntegerField()
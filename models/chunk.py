@@ -0,0 +1,19 @@
+from peewee import *
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from models import BaseModel
+
+# Local index of the chunks already held by a storage (see classes/repository.py)
+class Chunk(BaseModel):
+    class Meta:
+        db_table = 'chunks'
+        indexes = (
+            (('storage', 'hash'), True),
+        )
+
+    id = AutoField()
+    storage = CharField()
+    hash = CharField()
+    size = IntegerField()
+    stored_size = IntegerField()
+    created_at = IntegerField()
@@ -8,8 +8,20 @@ class Log(BaseModel):
     __SUCCESS__ = 1
     __FAILED__ = 2
     __ON_PROGRESS__ = 3
+    # Fingerprint unchanged since the last backup, nothing was made
+    __SKIPPED__ = 4
     __DATABASE__ = 'database'
     __FILES__ = 'files'
+    __FULL__ = 'full'
+    __INCREMENTAL__ = 'incremental'
+
+    class Meta:
+        indexes = (
+            # In progress checks and status listings
+            (('name', 'status', 'type', 'id'), False),
+            # Last backup of a type (status != failed, newest first)
+            (('name', 'type', 'id'), False),
+        )
     
     id = AutoField()
     name = CharField()
@@ -21,12 +33,22 @@ class Log(BaseModel):
     storage = CharField()
     object_name = TextField(null=True)
     status = IntegerField()
+    compression = CharField(null=True)
+    mode = CharField(null=True)
+    # Start of the whole site run (shared by its files and database logs) and end of this log
+    started_at = IntegerField(null=True)
+    finished_at = IntegerField(null=True)
+    # Seconds spent in each pipeline stage (compress or dump, upload), as json
+    stages = TextField(null=True)
+    run_id = IntegerField(null=True)
+    # Cheap content fingerprint taken before compressing, see classes/fingerprint.py
+    fingerprint = CharField(null=True)
     
-    # TODO: Fix this duplicate query
     def update_status(self, id: int, status: int, description=False):
-        self.update(status=status).where(self.id == id).execute()
+        fields = {"status": status, "finished_at": int(time.time()) if status != self.__ON_PROGRESS__ else None}
         if description:
-            self.update(description=description).where(self.id == id).execute()    
+            fields["description"] = description
+        self.update(**fields).where(Log.id == id).execute()
             
     def write(self, data: dict):
-        return self.create( name=data['name'], file_path=data['file_path'], description=data['description'], created_at=int(time.time()), type=data['type'], storage=data['storage'], status=self.__ON_PROGRESS__ )    
+        return self.create( name=data['name'], file_path=data['file_path'], file_size=data.get('file_size', 0), description=data['description'], created_at=int(time.time()), type=data['type'], storage=data['storage'], object_name=data.get('object_name'), status=self.__ON_PROGRESS__, compression=data.get('compression'), mode=data.get('mode'), started_at=data.get('started_at'), run_id=data.get('run_id'), fingerprint=data.get('fingerprint') )    
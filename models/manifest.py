@@ -0,0 +1,20 @@
+from peewee import *
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from models import BaseModel
+
+# One row per file seen by the last successful backup of a site
+class ManifestEntry(BaseModel):
+    class Meta:
+        db_table = 'manifests'
+        indexes = (
+            (('name', 'path'), True),
+        )
+
+    id = AutoField()
+    name = CharField()
+    path = TextField()
+    size = IntegerField()
+    mtime = IntegerField()
+    inode = IntegerField()
+    hash = CharField(null=True)
@@ -0,0 +1,73 @@
+from peewee import *
+import os, sys, time
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from playhouse.migrate import SqliteMigrator, migrate as run_operations
+from models import BaseModel, database
+from models.log import Log
+from models.notification_log import NotificationLog
+from models.manifest import ManifestEntry
+from models.chunk import Chunk
+from models.transfer_stat import TransferStat
+from models.upload import Upload, UploadPart
+from models.s3_object import S3Object, S3Prefix
+from models.run import Run, Artifact
+from models.binlog import BinlogChain, BinlogSegment
+
+class SchemaVersion(BaseModel):
+    class Meta:
+        db_table = 'schema_version'
+
+    version = IntegerField(primary_key=True)
+    applied_at = IntegerField()
+
+def _add_missing_columns(model, fields) -> None:
+    table = model._meta.table_name
+    columns = [column.name for column in database.get_columns(table)]
+    missing = [field for field in fields if field.column_name not in columns]
+    if missing:
+        migrator = SqliteMigrator(database)
+        run_operations(*[migrator.add_column(table, field.column_name, field) for field in missing])
+
+# Databases created before the migrations were tracked may already hold any of these, every step checks first
+def _baseline() -> None:
+    database.create_tables([Log, NotificationLog, ManifestEntry, Chunk, TransferStat, Upload, UploadPart, S3Object, S3Prefix], safe=True)
+    _add_missing_columns(Log, (Log.compression, Log.mode, Log.started_at, Log.finished_at, Log.stages))
+
+def _log_indexes() -> None:
+    Log._schema.create_indexes(safe=True)
+
+def _runs() -> None:
+    database.create_tables([Run, Artifact], safe=True)
+    _add_missing_columns(Log, (Log.run_id,))
+
+def _binlogs() -> None:
+    database.create_tables([BinlogChain, BinlogSegment], safe=True)
+
+def _fingerprints() -> None:
+    _add_missing_columns(Log, (Log.fingerprint,))
+
+def _storage_classes() -> None:
+    _add_missing_columns(Artifact, (Artifact.storage_class,))
+
+# Append only, a migration is never changed once released
+MIGRATIONS = (
+    (1, _baseline),
+    (2, _log_indexes),
+    (3, _runs),
+    (4, _binlogs),
+    (5, _fingerprints),
+    (6, _storage_classes),
+)
+
+def migrate() -> list:
+    database.create_tables([SchemaVersion], safe=True)
+    current = SchemaVersion.select(fn.MAX(SchemaVersion.version)).scalar() or 0
+    applied = []
+    for version, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        with database.atomic():
+            migration()
+            SchemaVersion.create(version=version, applied_at=int(time.time()))
+        applied.append(version)
+    return applied
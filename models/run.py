@@ -0,0 +1,51 @@
+from peewee import *
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from models import BaseModel
+
+# One backup of a site (a do_backup call), its files and database logs point to it through log.run_id
+class Run(BaseModel):
+    # Same values as Log
+    __SUCCESS__ = 1
+    __FAILED__ = 2
+    __ON_PROGRESS__ = 3
+
+    class Meta:
+        db_table = 'runs'
+        indexes = (
+            (('name', 'status', 'id'), False),
+        )
+
+    id = AutoField()
+    name = CharField()
+    mode = CharField(null=True)
+    status = IntegerField()
+    started_at = IntegerField()
+    finished_at = IntegerField(null=True)
+
+# Object produced by a run on a storage (archive, dump...), key is the object name or the path under the local destination
+class Artifact(BaseModel):
+    # Member index of a files archive (classes/archive_index.py), other types are the Log ones
+    __INDEX__ = 'index'
+    # Removed by the retention (classes/retention.py), other statuses are the Log ones
+    __DELETED__ = 5
+
+    class Meta:
+        db_table = 'artifacts'
+        indexes = (
+            (('run', 'type'), False),
+            (('storage', 'key'), False),
+        )
+
+    id = AutoField()
+    run = ForeignKeyField(Run, backref='artifacts', on_delete='CASCADE')
+    log_id = IntegerField(null=True)
+    type = CharField()
+    storage = CharField()
+    key = TextField()
+    size = IntegerField(default=0)
+    compression = CharField(null=True)
+    # S3 storage class the retention moved it to, None while it is still the upload one
+    storage_class = CharField(null=True)
+    status = IntegerField()
+    created_at = IntegerField()
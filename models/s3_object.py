@@ -0,0 +1,34 @@
+from peewee import *
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from models import BaseModel
+
+# Local copy of the objects of a storage, answers listings without scanning the bucket (see classes/catalog.py)
+class S3Object(BaseModel):
+    class Meta:
+        db_table = 's3_objects'
+        indexes = (
+            (('storage', 'key'), True),
+        )
+
+    id = AutoField()
+    storage = CharField()
+    key = TextField()
+    size = IntegerField()
+    last_modified = IntegerField()
+    etag = CharField(null=True)
+    # Time in ms of the listing (or upload) that last saw the object
+    synced_at = IntegerField()
+
+# Prefixes fully listed into the catalog and when
+class S3Prefix(BaseModel):
+    class Meta:
+        db_table = 's3_prefixes'
+        indexes = (
+            (('storage', 'prefix'), True),
+        )
+
+    id = AutoField()
+    storage = CharField()
+    prefix = TextField()
+    synced_at = IntegerField()
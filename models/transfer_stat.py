@@ -0,0 +1,20 @@
+from peewee import *
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from models import BaseModel
+
+# Throughput of past uploads, used to tune the concurrency of the next ones per storage
+class TransferStat(BaseModel):
+    class Meta:
+        db_table = 'transfer_stats'
+        indexes = (
+            (('storage', 'id'), False),
+        )
+
+    id = AutoField()
+    storage = CharField()
+    size = IntegerField()
+    concurrency = IntegerField()
+    part_size = IntegerField()
+    throughput = FloatField()
+    created_at = IntegerField()
@@ -0,0 +1,48 @@
+from peewee import *
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from models import BaseModel
+
+# State of a multipart upload, kept so a crashed worker can be resumed (see classes/multipart.py)
+class Upload(BaseModel):
+    __ON_PROGRESS__ = 1
+    __COMPLETED__ = 2
+    __ABORTED__ = 3
+
+    class Meta:
+        db_table = 'uploads'
+        indexes = (
+            (('status', 'storage'), False),
+            (('name', 'status'), False),
+        )
+
+    id = AutoField()
+    name = CharField(null=True)
+    log_id = IntegerField(null=True)
+    storage = CharField()
+    bucket = CharField()
+    key = TextField()
+    upload_id = TextField()
+    source = TextField()
+    size = IntegerField()
+    mtime = IntegerField()
+    part_size = IntegerField()
+    status = IntegerField()
+    pid = IntegerField()
+    hostname = CharField()
+    created_at = IntegerField()
+    updated_at = IntegerField()
+
+class UploadPart(BaseModel):
+    class Meta:
+        db_table = 'upload_parts'
+        indexes = (
+            (('upload', 'part_number'), True),
+        )
+
+    id = AutoField()
+    upload = ForeignKeyField(Upload, backref='parts', on_delete='CASCADE')
+    part_number = IntegerField()
+    etag = CharField()
+    offset = IntegerField()
+    size = IntegerField()
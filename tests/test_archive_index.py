@@ -0,0 +1,81 @@
+import os, sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from classes.archive_index import ArchiveIndex
+from classes.codec import Gzip, decompress_block
+from classes.tar import Tar
+
+# Small blocks so members start, end and straddle block boundaries
+BLOCK_SIZE = 1024
+FILES = {
+    'small.txt': b'tiny',
+    'empty.txt': b'',
+    'sub/spans.bin': bytes(range(256)) * 20,
+    'sub/aligned.bin': b'a' * BLOCK_SIZE * 2,
+    'last.bin': os.urandom(3000),
+}
+
+def _archive(tmp_path) -> tuple:
+    source = tmp_path / 'site'
+    for name, content in FILES.items():
+        path = source / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+    os.symlink('small.txt', source / 'link')
+
+    tar = Tar(workers=1, codec=Gzip(), index=True)
+    tar.block_size = BLOCK_SIZE
+    output = str(tmp_path / 'site.tar.gz')
+    tar.compress(str(source), output)
+    tar.index.save(output + '.index.gz')
+    with open(output, 'rb') as f:
+        return ArchiveIndex.load(output + '.index.gz'), f.read()
+
+# Decompressed blocks of the ranges, as restore-file fetches them
+def _fetch(index: ArchiveIndex, archive: bytes, names: list) -> dict:
+    blocks = {}
+    for start, end, first, last in index.ranges(names):
+        data = archive[start:end + 1]
+        for block in range(first, last + 1):
+            offset = index.blocks[block][1] - start
+            blocks[block] = decompress_block(index.codec, data[offset:offset + index.blocks[block][2]])
+    return blocks
+
+def test_members_are_indexed(tmp_path):
+    index, _ = _archive(tmp_path)
+    assert len(index.blocks) > 10
+    for name, content in FILES.items():
+        assert index.members[f"site/{name}"][:2] == ['file', len(content)]
+    assert index.members['site/link'][0] == 'symlink'
+    assert index.members['site/link'][6] == 'small.txt'
+    assert index.members['site/sub'][0] == 'dir'
+
+def test_read_returns_the_original_bytes(tmp_path):
+    index, archive = _archive(tmp_path)
+    for name, content in FILES.items():
+        member = f"site/{name}"
+        blocks = _fetch(index, archive, [member])
+        assert b''.join(index.read(member, blocks)) == content
+
+def test_ranges_cover_only_the_blocks_of_the_members(tmp_path):
+    index, archive = _archive(tmp_path)
+    spans = index.ranges(['site/sub/spans.bin'])
+    first, last = index.block_span('site/sub/spans.bin')
+    # 5120 bytes of 1024 byte blocks, adjacent blocks merged in a single range
+    assert len(spans) == 1 and last - first >= 4
+    start, end, span_first, span_last = spans[0]
+    assert (span_first, span_last) == (first, last)
+    assert start == index.blocks[first][1]
+    assert end == index.blocks[last][1] + index.blocks[last][2] - 1
+
+    # Nothing to fetch for empty files and links
+    assert index.ranges(['site/empty.txt', 'site/link']) == []
+
+def test_ranges_of_several_members_merge_adjacent_blocks(tmp_path):
+    index, archive = _archive(tmp_path)
+    names = [f"site/{name}" for name in FILES]
+    spans = index.ranges(names)
+    for (_, end, _, last), (start, _, first, _) in zip(spans, spans[1:]):
+        assert first > last + 1 and start > end
+    blocks = _fetch(index, archive, names)
+    for name, content in FILES.items():
+        assert b''.join(index.read(f"site/{name}", blocks)) == content
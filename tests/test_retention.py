@@ -0,0 +1,98 @@
+import os, sys, time
+from datetime import datetime, timedelta
+import pytest
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from models import database
+from models.migrations import migrate
+from models.log import Log
+from models.run import Run, Artifact
+from models.binlog import BinlogChain, BinlogSegment
+from classes.retention import Policy, Retention, RetentionException
+
+NAME = 'site'
+
+# Catalog in a throwaway database, the real one is never touched
+@pytest.fixture(autouse=True)
+def catalog(tmp_path):
+    database.init(str(tmp_path / 'bqckup.db'))
+    migrate()
+    yield
+    database.close()
+
+def _runs(days: int, end: datetime) -> list:
+    return [(days - i, (end - timedelta(days=i)).timestamp()) for i in range(days)]
+
+# One run, logs given as (type, mode, status), an artifact for every successful one
+def _run(logs: list) -> tuple:
+    now = int(time.time())
+    run = Run.create(name=NAME, mode=Log.__FULL__, status=Run.__SUCCESS__, started_at=now, finished_at=now)
+    created = []
+    for log_type, mode, status in logs:
+        log = Log.create(
+            name=NAME, file_path='', file_size=10, description='', created_at=now, type=log_type,
+            storage='local:/tmp', status=status, mode=mode, run_id=run.id
+        )
+        if status == Log.__SUCCESS__:
+            Artifact.create(run=run, log_id=log.id, type=log_type, storage='local:/tmp', key=f"{log.id}", size=10, status=Log.__SUCCESS__, created_at=now)
+        created.append(log.id)
+    return run.id, created
+
+def _expired_logs() -> set:
+    return {artifact.log_id for artifact in Retention(NAME, Policy({'last': 1})).plan()}
+
+def test_policy_number_is_the_last_runs():
+    policy = Policy('3')
+    assert policy.tiers == {'last': 3}
+    assert Policy(3).select(_runs(10, datetime(2026, 3, 1, 12))) == {10: 'last', 9: 'last', 8: 'last'}
+
+def test_policy_rejects_bad_values():
+    for value in ({'hourly': 2}, {'daily': 'x'}, {'monthly': {'keep': 2, 'storage_class': 'COLD'}}, {'yearly': {'keep': 1, 'storage_class': 'DEEP_ARCHIVE'}}):
+        with pytest.raises(RetentionException):
+            Policy(value)
+
+def test_calendar_tiers_keep_the_newest_run_of_each_period():
+    # Daily runs from 2026-01-01 to 2026-03-01 (a Sunday, end of ISO week 9)
+    runs = _runs(60, datetime(2026, 3, 1, 12))
+    ids = {datetime.fromtimestamp(started_at).date().isoformat(): run_id for run_id, started_at in runs}
+    kept = Policy({'daily': 3, 'weekly': 3, 'monthly': {'keep': 3, 'storage_class': 'standard_ia'}}).select(runs)
+    assert kept == {
+        ids['2026-03-01']: 'daily', ids['2026-02-28']: 'daily', ids['2026-02-27']: 'daily',
+        # Weeks 9 and 8 end on runs the daily tier already keeps
+        ids['2026-02-22']: 'weekly', ids['2026-02-15']: 'weekly',
+        ids['2026-01-31']: 'monthly',
+    }
+
+def test_calendar_tiers_skip_periods_without_runs():
+    # Runs on the first of three months out of five
+    runs = [(3, datetime(2026, 5, 1, 12).timestamp()), (2, datetime(2026, 3, 1, 12).timestamp()), (1, datetime(2026, 1, 1, 12).timestamp())]
+    assert Policy({'monthly': 2}).select(runs) == {3: 'monthly', 2: 'monthly'}
+
+def test_incremental_chain_is_kept_back_to_its_full_archive():
+    logs = []
+    for mode in (Log.__FULL__, Log.__INCREMENTAL__, Log.__FULL__, Log.__INCREMENTAL__, Log.__INCREMENTAL__):
+        logs.append(_run([(Log.__FILES__, mode, Log.__SUCCESS__)])[1][0])
+    assert _expired_logs() == set(logs[:2])
+
+def test_skipped_run_keeps_the_archive_it_relies_on():
+    first = _run([(Log.__FILES__, Log.__FULL__, Log.__SUCCESS__), (Log.__DATABASE__, None, Log.__SUCCESS__)])[1]
+    second = _run([(Log.__FILES__, Log.__FULL__, Log.__SUCCESS__), (Log.__DATABASE__, None, Log.__SUCCESS__)])[1]
+    # Nothing changed, the last run restores from the second one
+    _run([(Log.__FILES__, Log.__FULL__, Log.__SKIPPED__), (Log.__DATABASE__, None, Log.__SKIPPED__)])
+    assert _expired_logs() == set(first)
+    assert not set(second) & _expired_logs()
+
+def test_binlog_chain_keeps_its_dump_and_every_capture():
+    old = _run([(Log.__FILES__, Log.__FULL__, Log.__SUCCESS__), (Log.__DATABASE__, Log.__FULL__, Log.__SUCCESS__)])[1]
+    files, dump = _run([(Log.__FILES__, Log.__FULL__, Log.__SUCCESS__), (Log.__DATABASE__, Log.__FULL__, Log.__SUCCESS__)])[1]
+    now = int(time.time())
+    chain = BinlogChain.create(name=NAME, log_id=dump, start_file='bin.1', start_position=4, next_file='bin.3', next_position=4, status=BinlogChain.__OPEN__, created_at=now, updated_at=now)
+    captures = []
+    for _ in range(2):
+        captures.append(_run([(Log.__DATABASE__, Log.__INCREMENTAL__, Log.__SUCCESS__)])[1][0])
+    last_files, last_capture = _run([(Log.__FILES__, Log.__FULL__, Log.__SUCCESS__), (Log.__DATABASE__, Log.__INCREMENTAL__, Log.__SUCCESS__)])[1]
+    captures.append(last_capture)
+    for position, log_id in enumerate(captures):
+        BinlogSegment.create(chain=chain, log_id=log_id, file=f"bin.{position + 1}", start_position=4, end_position=100, captured_at=now)
+
+    # Captures don't count as runs, the last regular run restores from the chain dump and every capture
+    assert _expired_logs() == set(old) | {files}
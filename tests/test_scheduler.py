@@ -0,0 +1,105 @@
+import os, sys
+from datetime import datetime
+import pytest
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from classes.scheduler import Cron, CronException, Schedule
+
+# 2026-06-10 is a wednesday
+@pytest.mark.parametrize("expression, minutes, hours, days, months, weekdays", [
+    ('*/15 * * * *', {0, 15, 30, 45}, set(range(24)), set(range(1, 32)), set(range(1, 13)), set(range(7))),
+    ('5/20 9-17/4 1,15 * *', {5, 25, 45}, {9, 13, 17}, {1, 15}, set(range(1, 13)), set(range(7))),
+    ('0 0 * jan,JUL-aug *', {0}, {0}, set(range(1, 32)), {1, 7, 8}, set(range(7))),
+    ('0 0 * * mon-fri', {0}, {0}, set(range(1, 32)), set(range(1, 13)), {1, 2, 3, 4, 5}),
+    ('0 0 * * 5-7', {0}, {0}, set(range(1, 32)), set(range(1, 13)), {5, 6, 0}),
+    ('@weekly', {0}, {0}, set(range(1, 32)), set(range(1, 13)), {0}),
+])
+def test_cron_parses_every_field(expression, minutes, hours, days, months, weekdays):
+    cron = Cron(expression)
+    assert (cron.minutes, cron.hours, cron.days, cron.months, cron.weekdays) == (minutes, hours, days, months, weekdays)
+
+@pytest.mark.parametrize("expression", [
+    '* * * *', '60 * * * *', '*/0 * * * *', '5-1 * * * *', '0 0 0 * *', '0 0 * * funday', '@often',
+])
+def test_cron_rejects_bad_expressions(expression):
+    with pytest.raises(CronException):
+        Cron(expression)
+
+@pytest.mark.parametrize("expression, moment, expected", [
+    ('0 0 * * *', datetime(2026, 6, 10, 12, 0), datetime(2026, 6, 11, 0, 0)),
+    # Strictly after
+    ('30 2 * * *', datetime(2026, 6, 10, 2, 30, 15), datetime(2026, 6, 11, 2, 30)),
+    ('*/15 * * * *', datetime(2026, 6, 10, 23, 50), datetime(2026, 6, 11, 0, 0)),
+    ('0 0 1 * *', datetime(2026, 1, 31, 10, 0), datetime(2026, 2, 1, 0, 0)),
+    ('59 23 31 12 *', datetime(2026, 12, 31, 23, 59), datetime(2027, 12, 31, 23, 59)),
+    ('0 0 29 2 *', datetime(2026, 3, 1, 0, 0), datetime(2028, 2, 29, 0, 0)),
+    ('0 12 * * sun', datetime(2026, 6, 10, 12, 0), datetime(2026, 6, 14, 12, 0)),
+    # Both day fields restricted, either one matches: friday the 12th, then saturday the 13th
+    ('0 0 13 * fri', datetime(2026, 6, 10, 12, 0), datetime(2026, 6, 12, 0, 0)),
+    ('0 0 13 * fri', datetime(2026, 6, 12, 0, 0), datetime(2026, 6, 13, 0, 0)),
+    # A *-prefixed day field restricts nothing on its own, both have to match: the first odd monday
+    ('0 0 */2 * mon', datetime(2026, 6, 10, 12, 0), datetime(2026, 6, 15, 0, 0)),
+    ('0 0 1-31 * mon', datetime(2026, 6, 10, 12, 0), datetime(2026, 6, 11, 0, 0)),
+])
+def test_cron_next(expression, moment, expected):
+    assert Cron(expression).next(moment) == expected
+
+def test_cron_that_never_matches():
+    with pytest.raises(CronException):
+        Cron('0 0 31 2 *').next(datetime(2026, 6, 10))
+
+@pytest.mark.parametrize("window, moment, inside", [
+    ('09:00-17:00', datetime(2026, 6, 10, 9, 0), True),
+    ('09:00-17:00', datetime(2026, 6, 10, 17, 0), False),
+    ('22:00-02:00', datetime(2026, 6, 10, 23, 0), True),
+    ('22:00-02:00', datetime(2026, 6, 10, 1, 59), True),
+    ('22:00-02:00', datetime(2026, 6, 10, 2, 0), False),
+    ('22:00-02:00', datetime(2026, 6, 10, 12, 0), False),
+])
+def test_window_may_cross_midnight(window, moment, inside):
+    assert Schedule('site', {'window': window, 'jitter': 0}).in_window(moment) is inside
+
+@pytest.mark.parametrize("options, after, expected", [
+    ({'interval': 'daily'}, datetime(2026, 6, 10, 12, 0), datetime(2026, 6, 11, 0, 0)),
+    ({'interval': 'weekly'}, datetime(2026, 6, 10, 12, 0), datetime(2026, 6, 14, 0, 0)),
+    # Runs outside the window wait for it to open
+    ({'schedule': '0 * * * *', 'window': '22:00-02:00'}, datetime(2026, 6, 10, 12, 30), datetime(2026, 6, 10, 22, 0)),
+    ({'schedule': '0 * * * *', 'window': '22:00-02:00'}, datetime(2026, 6, 10, 23, 30), datetime(2026, 6, 11, 0, 0)),
+    ({'schedule': '0 * * * *', 'window': '22:00-02:00'}, datetime(2026, 6, 11, 1, 30), datetime(2026, 6, 11, 22, 0)),
+    ({'schedule': '@daily', 'window': '01:00-03:00'}, datetime(2026, 6, 10, 12, 0), datetime(2026, 6, 11, 1, 0)),
+])
+def test_next_run(options, after, expected):
+    assert Schedule('site', dict(options, jitter=0)).next_run(after.timestamp()) == expected.timestamp()
+
+def test_jitter_is_stable_per_site():
+    # Offsets of these names for a 300 seconds jitter
+    offsets = {'site': 195, 'blog': 56}
+    after = datetime(2026, 6, 10, 12, 0).timestamp()
+    for name, offset in offsets.items():
+        schedule = Schedule(name, {'schedule': '@daily', 'jitter': 300})
+        assert schedule.offset == offset
+        assert schedule.next_run(after) == datetime(2026, 6, 11, 0, 0).timestamp() + offset
+
+@pytest.mark.parametrize("name, window, expected", [
+    # 204 seconds after 01:00 is still in the window
+    ('blog', '00:00-01:05', datetime(2026, 6, 11, 1, 3, 24)),
+    # 1964 seconds would leave it, the run starts on the schedule
+    ('site', '00:00-01:05', datetime(2026, 6, 11, 1, 0)),
+])
+def test_jitter_is_clamped_into_the_window(name, window, expected):
+    schedule = Schedule(name, {'schedule': '0 1 * * *', 'window': window, 'jitter': 3600})
+    assert schedule.next_run(datetime(2026, 6, 10, 12, 0).timestamp()) == expected.timestamp()
+
+@pytest.mark.parametrize("options, last_run, now, expected", [
+    # Never ran, waits for the schedule
+    ({}, None, datetime(2026, 6, 10, 12, 0), datetime(2026, 6, 11, 0, 0)),
+    # Ran last night, the next one isn't due yet
+    ({}, datetime(2026, 6, 10, 0, 0), datetime(2026, 6, 10, 12, 0), datetime(2026, 6, 11, 0, 0)),
+    # Last night's run was missed, it happens right away
+    ({}, datetime(2026, 6, 8, 0, 0), datetime(2026, 6, 10, 12, 0), datetime(2026, 6, 10, 12, 0)),
+    # Missed, but only once the window opens again
+    ({'window': '22:00-02:00'}, datetime(2026, 6, 8, 0, 0), datetime(2026, 6, 10, 12, 0), datetime(2026, 6, 10, 22, 0)),
+    ({'window': '22:00-02:00'}, datetime(2026, 6, 8, 0, 0), datetime(2026, 6, 10, 23, 0), datetime(2026, 6, 10, 23, 0)),
+])
+def test_first_run_catches_up_missed_runs(options, last_run, now, expected):
+    schedule = Schedule('site', dict(options, schedule='@daily', jitter=0))
+    assert schedule.first_run(last_run.timestamp() if last_run else None, now.timestamp()) == expected.timestamp()